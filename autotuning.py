@@ -0,0 +1,134 @@
+import itertools
+import threading
+import time
+
+import psutil
+import torch
+import torch.optim as optim
+from torch.autograd import Variable
+
+from loaders import MetadataImageSegmentationLoader, dataloader_supports
+from steps.pytorch.architectures.unet import UNet
+from steps.pytorch.validation import segmentation_loss
+
+
+class PeakRSSMonitor:
+    """
+    Samples the resident memory of this process and all of its children (DataLoader workers)
+    in a background thread and keeps the maximum.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        process = psutil.Process()
+        while not self._stop.is_set():
+            rss = process.memory_info().rss
+            for child in process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.NoSuchProcess:
+                    pass
+            self.peak = max(self.peak, rss)
+            self._stop.wait(self.interval)
+
+
+def loader_grid(num_workers, batch_sizes, prefetch_factors, pin_memory):
+    """
+    Yields training loader params for every combination, the prefetch factor only varies when the
+    DataLoader supports it and batches are loaded by workers, pinned memory only with CUDA.
+    """
+    if not torch.cuda.is_available():
+        # pinning only speeds up host to device copies, without a GPU it just adds a copy per batch
+        pin_memory = [0]
+    for workers, batch_size, pin in itertools.product(num_workers, batch_sizes, pin_memory):
+        factors = prefetch_factors if workers > 0 and dataloader_supports('prefetch_factor') else [None]
+        for factor in factors:
+            loader_params = {'batch_size': batch_size,
+                             'shuffle': True,
+                             'num_workers': workers,
+                             'pin_memory': bool(pin),
+                             }
+            if factor is not None:
+                loader_params['prefetch_factor'] = factor
+            yield loader_params
+
+
+def run_trial(X, y, dataset_params, architecture_config, loader_params, steps, warmup_steps, placement_params=None):
+    """
+    Trains a fresh UNet for `warmup_steps + steps` batches fed by MetadataImageSegmentationLoader and
+    returns the throughput of the timed steps together with the peak RSS of the whole trial.
+    """
+    loader = MetadataImageSegmentationLoader(loader_params={'training': loader_params,
+                                                            'inference': loader_params},
+                                             dataset_params=dataset_params,
+                                             placement_params=placement_params)
+    flow, _ = loader.transform(X, y)['datagen']
+
+    model = UNet(**architecture_config.model_params)
+    if torch.cuda.is_available():
+        model = model.cuda()
+    optimizer = optim.Adam(model.parameters(), lr=architecture_config.optimizer_params.lr)
+
+    step, samples = 0, 0
+    start = time.time()
+    with PeakRSSMonitor() as monitor:
+        while step < warmup_steps + steps:
+            for X_batch, target_batch in flow:
+                if torch.cuda.is_available():
+                    X_batch, target_batch = X_batch.cuda(), target_batch.cuda()
+                optimizer.zero_grad()
+                loss = segmentation_loss(model(Variable(X_batch)), Variable(target_batch))
+                loss.backward()
+                optimizer.step()
+
+                step += 1
+                if step == warmup_steps:
+                    start = time.time()
+                elif step > warmup_steps:
+                    samples += X_batch.size(0)
+                if step == warmup_steps + steps:
+                    break
+        elapsed = time.time() - start
+
+    return {'samples_per_sec': samples / elapsed,
+            'peak_rss_mb': monitor.peak / 2 ** 20,
+            }
+
+
+def autotune_loader(X, y, config, grid, steps, warmup_steps, max_rss_mb=0, logger=None):
+    """
+    Runs a trial for every loader setting in `grid` and returns all results together with the fastest
+    setting that stays under `max_rss_mb` (no limit when 0).
+    """
+    results = []
+    for loader_params in grid:
+        try:
+            result = run_trial(X, y, config.loader.dataset_params, config.unet_network.architecture_config,
+                               loader_params, steps, warmup_steps)
+        except RuntimeError as e:
+            result = {'error': str(e)}
+        result['loader_params'] = loader_params
+        results.append(result)
+        if logger is not None:
+            logger.info('{} -> {}'.format(loader_params, {key: value for key, value in result.items()
+                                                          if key != 'loader_params'}))
+
+    candidates = [result for result in results
+                  if 'error' not in result and (not max_rss_mb or result['peak_rss_mb'] <= max_rss_mb)]
+    if not candidates:
+        raise ValueError('no loader setting finished within the {}MB peak memory budget'.format(max_rss_mb))
+    best = max(candidates, key=lambda result: result['samples_per_sec'])
+    return best, results
@@ -0,0 +1,82 @@
+"""
+Samples/sec of data-parallel UNet training on synthetic data as the number of gloo processes grows.
+
+    python -m benchmarks.distributed_scaling --processes 1,2,4,8
+"""
+import multiprocessing as mp
+import time
+
+import click
+import torch
+from torch.autograd import Variable
+import torch.optim as optim
+
+from pipeline_config import build_solution_config
+from steps.pytorch.architectures.unet import UNet
+from steps.pytorch.distributed import init_distributed, broadcast_parameters, all_reduce_gradients, is_master
+from steps.pytorch.validation import segmentation_loss
+from utils import read_params
+
+
+def _worker(rank, world_size, master_port, threads, architecture_config, batch_size, image_size, steps, warmup_steps,
+            results):
+    torch.set_num_threads(threads)
+    init_distributed(rank, world_size, '127.0.0.1', master_port)
+    torch.manual_seed(rank)
+
+    model_params = architecture_config.model_params
+    model = UNet(**model_params)
+    broadcast_parameters(model)
+    optimizer = optim.Adam(model.parameters(), lr=architecture_config.optimizer_params.lr)
+
+    X = Variable(torch.randn(batch_size, model_params.in_channels, image_size, image_size))
+    target = Variable((torch.rand(batch_size, 1, image_size, image_size) > 0.5).float())
+
+    for step in range(warmup_steps + steps):
+        if step == warmup_steps:
+            start = time.time()
+        optimizer.zero_grad()
+        loss = segmentation_loss(model(X), target)
+        loss.backward()
+        all_reduce_gradients(model)
+        optimizer.step()
+    elapsed = time.time() - start
+
+    if is_master():
+        results.put(elapsed)
+
+
+def run(world_size, master_port, architecture_config, batch_size, image_size, steps, warmup_steps):
+    threads = max(1, mp.cpu_count() // world_size)
+    results = mp.Queue()
+    processes = [mp.Process(target=_worker, args=(rank, world_size, master_port, threads, architecture_config,
+                                                  batch_size, image_size, steps, warmup_steps, results))
+                 for rank in range(world_size)]
+    for process in processes:
+        process.start()
+    elapsed = results.get()
+    for process in processes:
+        process.join()
+    return world_size * batch_size * steps / elapsed
+
+
+@click.command()
+@click.option('--processes', default='1,2,4', help='comma separated process counts')
+@click.option('--batch_size', default=8, help='per process batch size')
+@click.option('--image_size', default=128)
+@click.option('--steps', default=20)
+@click.option('--warmup_steps', default=3)
+@click.option('--master_port', default=29600)
+def main(processes, batch_size, image_size, steps, warmup_steps, master_port):
+    architecture_config = build_solution_config(read_params()).unet_network.architecture_config
+    baseline = None
+    print('{:>10} {:>14} {:>10}'.format('processes', 'samples/sec', 'scaling'))
+    for i, world_size in enumerate(int(p) for p in processes.split(',')):
+        throughput = run(world_size, master_port + i, architecture_config, batch_size, image_size, steps,
+                         warmup_steps)
+        baseline = baseline or throughput
+        print('{:>10} {:>14.2f} {:>10.2f}'.format(world_size, throughput, throughput / baseline))
+
+
+if __name__ == '__main__':
+    main()
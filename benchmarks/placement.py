@@ -0,0 +1,74 @@
+"""
+Training throughput with the default thread counts against the core placement of
+steps/pytorch/placement.py, with and without pinning. Every setting trains in a fresh process on
+synthetic data so that thread counts and affinities do not leak between them.
+
+    python -m benchmarks.placement --num_workers 4 --worker_threads 1
+"""
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import click
+
+from benchmarks.synthetic import write_dataset
+from pipeline_config import build_solution_config, X_COLUMNS, Y_COLUMNS
+from utils import read_params
+
+
+def _worker(X, y, config, loader_params, placement_params, steps, warmup_steps, results):
+    from autotuning import run_trial
+
+    results.put(run_trial(X, y, config.loader.dataset_params, config.unet_network.architecture_config,
+                          loader_params, steps, warmup_steps, placement_params=placement_params))
+
+
+def measure(*args):
+    results = mp.Queue()
+    process = mp.Process(target=_worker, args=args + (results,))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+@click.command()
+@click.option('--num_workers', default=4)
+@click.option('--worker_threads', default=1)
+@click.option('--numa_node', default=-1, help='NUMA node of the pinned setting, -1 for all nodes')
+@click.option('--batch_size', default=16)
+@click.option('--images', default=128, help='synthetic training images')
+@click.option('--steps', default=20)
+@click.option('--warmup_steps', default=3)
+def main(num_workers, worker_threads, numa_node, batch_size, images, steps, warmup_steps):
+    config = build_solution_config(read_params())
+    loader_params = dict(config.loader.loader_params.training, batch_size=batch_size, num_workers=num_workers,
+                         worker_pool=False)
+    settings = OrderedDict([('default threads', {'enabled': False}),
+                            ('placement', {'enabled': True, 'worker_threads': worker_threads}),
+                            ('placement pinned', {'enabled': True, 'worker_threads': worker_threads,
+                                                  'pin_cpus': True, 'numa_node': numa_node}),
+                            ])
+
+    dirpath = tempfile.mkdtemp(prefix='placement_benchmark_')
+    try:
+        meta = write_dataset(os.path.join(dirpath, 'data'), images, 0, seed=1234)
+        meta_train = meta[meta['is_train'] == 1]
+        X, y = meta_train[X_COLUMNS].values, meta_train[Y_COLUMNS].values
+
+        baseline = None
+        print('{:<18} {:>14} {:>14} {:>10}'.format('setting', 'samples/sec', 'peak RSS MB', 'speedup'))
+        for name, placement_params in settings.items():
+            result = measure(X, y, config, loader_params, placement_params, steps, warmup_steps)
+            baseline = baseline or result['samples_per_sec']
+            print('{:<18} {:>14.2f} {:>14.1f} {:>9.2f}x'.format(name, result['samples_per_sec'],
+                                                               result['peak_rss_mb'],
+                                                               result['samples_per_sec'] / baseline))
+    finally:
+        shutil.rmtree(dirpath)
+
+
+if __name__ == '__main__':
+    main()
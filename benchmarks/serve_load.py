@@ -0,0 +1,79 @@
+"""
+Load generator for `python main.py serve`, reports latency percentiles and throughput.
+
+    python -m benchmarks.serve_load --concurrency 16 --requests 500
+"""
+import asyncio
+import io
+import time
+
+import click
+import numpy as np
+from PIL import Image
+
+from benchmarks.synthetic import synthetic_sample
+
+
+def encode_png(image):
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+async def post(reader, writer, host, path, payload):
+    writer.write('POST {} HTTP/1.1\r\nHost: {}\r\nContent-Type: image/png\r\nContent-Length: {}\r\n\r\n'.format(
+        path, host, len(payload)).encode('latin-1') + payload)
+    await writer.drain()
+    status = await reader.readline()
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        if name.strip().lower() == 'content-length':
+            content_length = int(value)
+    await reader.readexactly(content_length)
+    return status.split(b' ')[1] == b'200'
+
+
+async def client(host, port, payloads, requests, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while requests:
+            requests.pop()
+            payload = payloads[len(requests) % len(payloads)]
+            start = time.time()
+            ok = await post(reader, writer, host, '/predict', payload)
+            latencies.append(time.time() - start)
+            if not ok:
+                errors.append(1)
+    finally:
+        writer.close()
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', default=8000)
+@click.option('--concurrency', default=16)
+@click.option('--requests', 'requests_nr', default=200)
+@click.option('--images', 'images_nr', default=16, help='distinct synthetic images to cycle through')
+def main(host, port, concurrency, requests_nr, images_nr):
+    random_state = np.random.RandomState(1234)
+    payloads = [encode_png(synthetic_sample(random_state)[0]) for _ in range(images_nr)]
+    requests, latencies, errors = list(range(requests_nr)), [], []
+
+    loop = asyncio.get_event_loop()
+    start = time.time()
+    loop.run_until_complete(asyncio.gather(*[client(host, port, payloads, requests, latencies, errors)
+                                             for _ in range(concurrency)]))
+    elapsed = time.time() - start
+
+    latencies_ms = 1000. * np.array(latencies)
+    print('requests {}  errors {}  concurrency {}'.format(len(latencies), len(errors), concurrency))
+    print('throughput {:.2f} images/sec'.format(len(latencies) / elapsed))
+    print('latency p50 {:.1f} ms  p90 {:.1f} ms  p99 {:.1f} ms'.format(*np.percentile(latencies_ms, [50, 90, 99])))
+
+
+if __name__ == '__main__':
+    main()
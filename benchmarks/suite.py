@@ -0,0 +1,418 @@
+"""
+Benchmarks of the data, model, postprocessing and metrics hot paths on synthetic data.
+
+    python -m benchmarks.suite --output bench.json
+    python -m benchmarks.suite --output bench.json --save_baseline
+    python -m benchmarks.suite --only resizer,thresholder --threshold 0.1
+
+Results are compared against benchmarks/baseline.json when it exists, the run fails when any
+benchmark median is more than `threshold` slower than its baseline or above its absolute target.
+"""
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from copy import deepcopy
+
+import click
+import numpy as np
+
+BENCHMARKS = OrderedDict()
+BASELINE_FILEPATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+REPO_DIRPATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# upper bounds on the median in seconds, enforced with or without a baseline, cli startups time two interpreters
+TARGETS = {'cli_startup_prepare_metadata': 2.0,
+           'cli_startup_prepare_masks': 2.0,
+           }
+
+
+def benchmark(name):
+    """
+    Registers a setup function. It receives the shared BenchmarkContext and returns a tuple
+    (function to time, number of items processed by one call).
+    """
+
+    def decorator(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return decorator
+
+
+class BenchmarkContext:
+    def __init__(self, train_nr=16, test_nr=8, seed=1234):
+        self.train_nr = train_nr
+        self.test_nr = test_nr
+        self.seed = seed
+        self.dirpath = tempfile.mkdtemp(prefix='dsb_benchmarks_')
+        self._meta = None
+        self._samples = None
+        self._solution_config = None
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            from benchmarks.synthetic import write_dataset
+            self._meta = write_dataset(os.path.join(self.dirpath, 'data'), self.train_nr, self.test_nr, self.seed)
+        return self._meta
+
+    @property
+    def samples(self):
+        if self._samples is None:
+            from benchmarks.synthetic import synthetic_sample
+            random_state = np.random.RandomState(self.seed)
+            self._samples = [synthetic_sample(random_state) for _ in range(self.train_nr)]
+        return self._samples
+
+    def config(self, name):
+        if self._solution_config is None:
+            from pipeline_config import build_solution_config
+            from utils import read_params
+            self._solution_config = build_solution_config(read_params())
+        config = deepcopy(self._solution_config)
+        config['env']['cache_dirpath'] = os.path.join(self.dirpath, 'experiments', name)
+        sink = {'backend': 'jsonl', 'filepath': os.path.join(self.dirpath, 'experiments', name, 'metrics.jsonl')}
+        for network in ['unet_network', 'sequential_convnet']:
+            config[network]['callbacks_config']['neptune_monitor']['sink'] = sink
+            config[network]['callbacks_config']['model_checkpoint']['filepath'] = os.path.join(
+                self.dirpath, 'experiments', name, 'checkpoints', 'best.torch')
+        return config
+
+    def close(self):
+        shutil.rmtree(self.dirpath, ignore_errors=True)
+
+
+def _cli_startup(command):
+    """
+    `--help` never runs the command group callback, so the params and the solution config every
+    command reads first are timed too. tests/test_startup.py checks which modules this imports.
+    """
+    def run():
+        subprocess.check_call([sys.executable, 'main.py', command, '--help'], cwd=REPO_DIRPATH,
+                              stdout=subprocess.DEVNULL)
+        subprocess.check_call([sys.executable, '-c', 'import main; main.get_params(); main.get_solution_config()'],
+                              cwd=REPO_DIRPATH)
+
+    return run, 1
+
+
+@benchmark('cli_startup_prepare_metadata')
+def cli_startup_prepare_metadata(context):
+    return _cli_startup('prepare_metadata')
+
+
+@benchmark('cli_startup_prepare_masks')
+def cli_startup_prepare_masks(context):
+    return _cli_startup('prepare_masks')
+
+
+def save_untrained_transformers(pipeline):
+    """
+    Persists every transformer of a freshly built pipeline so that `pipeline.transform` can run without training.
+    """
+    from steps.pytorch.models import Model
+    from steps.pytorch.utils import save_model
+
+    for step in pipeline.all_steps.values():
+        if isinstance(step.transformer, Model):
+            save_model(step.transformer.model, step.cache_filepath_step_transformer)
+        else:
+            step.transformer.save(step.cache_filepath_step_transformer)
+
+
+def _loader_train_epoch(context, uint8_transport):
+    from loaders import MetadataImageSegmentationLoader
+
+    meta_train = context.meta[context.meta['is_train'] == 1]
+    config = context.config('loader')
+    config['loader']['dataset_params']['uint8_transport'] = uint8_transport
+    loader = MetadataImageSegmentationLoader(**config.loader)
+    flow, steps = loader.transform(meta_train['file_path_image'].values, meta_train['file_path_mask'].values)[
+        'datagen']
+
+    def run():
+        for _ in flow:
+            pass
+
+    return run, len(meta_train)
+
+
+@benchmark('loader_train_epoch')
+def loader_train_epoch(context):
+    return _loader_train_epoch(context, uint8_transport=False)
+
+
+@benchmark('loader_train_epoch_uint8')
+def loader_train_epoch_uint8(context):
+    return _loader_train_epoch(context, uint8_transport=True)
+
+
+@benchmark('unet_forward')
+def unet_forward(context):
+    import torch
+    from torch.autograd import Variable
+    from steps.pytorch.architectures.unet import UNet
+
+    config = context.config('unet_forward')
+    model_params = config.unet_network.architecture_config.model_params
+    model = UNet(**model_params).eval()
+    batch_size = config.loader.loader_params.inference.batch_size
+    X = Variable(torch.randn(batch_size, model_params.in_channels, config.loader.dataset_params.h,
+                             config.loader.dataset_params.w))
+
+    def run():
+        with torch.no_grad():
+            model(X)
+
+    return run, batch_size
+
+
+@benchmark('unet_tta')
+def unet_tta(context):
+    import torch
+    from torch.autograd import Variable
+    from steps.pytorch.architectures.unet import UNet
+    from steps.pytorch.tta import get_tta_transforms, tta_predict
+
+    config = context.config('unet_tta')
+    model_params = config.unet_network.architecture_config.model_params
+    model = UNet(**model_params).eval()
+    batch_size = config.loader.loader_params.inference.batch_size
+    X = Variable(torch.randn(batch_size, model_params.in_channels, config.loader.dataset_params.h,
+                             config.loader.dataset_params.w))
+    transforms = get_tta_transforms('all')
+
+    def run():
+        with torch.no_grad():
+            tta_predict(model, X, transforms)
+
+    return run, batch_size
+
+
+def _probability_maps(context, dtype='float32'):
+    config = context.config('probability_maps')
+    random_state = np.random.RandomState(context.seed)
+    shape = (len(context.samples), config.loader.dataset_params.h, config.loader.dataset_params.w)
+    images = random_state.uniform(size=shape).astype(np.float32)
+    if dtype == 'uint8':
+        images = np.round(images * 255).astype(np.uint8)
+    target_sizes = [image.shape[:2] for image, _ in context.samples]
+    return images.astype(dtype), target_sizes
+
+
+@benchmark('resizer')
+def resizer(context):
+    from postprocessing import Resizer
+
+    images, target_sizes = _probability_maps(context)
+    return lambda: Resizer().transform(images, target_sizes), len(images)
+
+
+@benchmark('resizer_uint8')
+def resizer_uint8(context):
+    from postprocessing import Resizer
+
+    images, target_sizes = _probability_maps(context, dtype='uint8')
+    return lambda: Resizer().transform(images, target_sizes), len(images)
+
+
+@benchmark('thresholder')
+def thresholder(context):
+    from postprocessing import Resizer, Thresholder
+
+    images, target_sizes = _probability_maps(context)
+    resized_images = Resizer().transform(images, target_sizes)['resized_images']
+    transformer = Thresholder(**context.config('thresholder').thresholder)
+    return lambda: transformer.transform(resized_images), len(resized_images)
+
+
+def _ground_truth_and_predictions(context):
+    """
+    Instance label images like `read_masks` returns and binary predictions shifted off them.
+    """
+    from scipy import ndimage
+    from benchmarks.synthetic import instance_labels
+
+    ground_truth, predictions = [], []
+    for image, masks in context.samples:
+        gt = instance_labels(masks, image.shape[:2])
+        ground_truth.append(gt)
+        predictions.append(ndimage.binary_dilation(np.roll(gt > 0, 2, axis=1)).astype(np.uint8))
+    return ground_truth, predictions
+
+
+@benchmark('compute_eval_metric')
+def compute_eval_metric(context):
+    from metrics import compute_eval_metric
+
+    ground_truth, predictions = _ground_truth_and_predictions(context)
+
+    def run():
+        for gt, prediction in zip(ground_truth, predictions):
+            compute_eval_metric(gt, prediction)
+
+    return run, len(ground_truth)
+
+
+@benchmark('read_masks')
+def read_masks(context):
+    from pipeline_config import LABEL_COLUMNS
+    from utils import read_masks
+
+    meta_train = context.meta[context.meta['is_train'] == 1]
+    return lambda: read_masks(meta_train[LABEL_COLUMNS].values), len(meta_train)
+
+
+@benchmark('run_length_encoding')
+def run_length_encoding(context):
+    from utils import decompose, run_length_encoding
+
+    _, predictions = _ground_truth_and_predictions(context)
+    masks = [mask > 128. for prediction in predictions for mask in decompose(prediction)]
+
+    def run():
+        for mask in masks:
+            run_length_encoding(mask)
+
+    return run, len(masks)
+
+
+def _stacked_predictions(context, variants_nr=8):
+    config = context.config('stacked_predictions')
+    random_state = np.random.RandomState(context.seed)
+    images_nr = len(context.samples)
+    shape = (images_nr * variants_nr, config.loader.dataset_params.h, config.loader.dataset_params.w)
+    predictions = random_state.uniform(size=shape).astype(np.float32)
+    ids = np.repeat(['image_{}'.format(i) for i in range(images_nr)], variants_nr)
+    return predictions, ids
+
+
+@benchmark('prediction_average_unstack')
+def prediction_average_unstack(context):
+    from steps.postprocessing import PredictionAverageUnstack
+
+    predictions, ids = _stacked_predictions(context)
+    transformer = PredictionAverageUnstack()
+    return lambda: transformer.transform(predictions, ids), len(predictions)
+
+
+@benchmark('prediction_average_unstack_pandas')
+def prediction_average_unstack_pandas(context):
+    import pandas as pd
+
+    predictions, ids = _stacked_predictions(context)
+
+    def run():
+        df = pd.DataFrame(predictions.reshape(len(predictions), -1))
+        df['id'] = ids
+        df.groupby('id').mean().reset_index().drop(['id'], axis=1).values.reshape((-1,) + predictions.shape[1:])
+
+    return run, len(predictions)
+
+
+@benchmark('unet_inference')
+def unet_inference(context):
+    from pipeline_config import SIZE_COLUMNS
+    from pipelines import PIPELINES
+
+    meta_test = context.meta[context.meta['is_train'] == 0]
+    data = {'input': {'meta': meta_test,
+                      'meta_valid': None,
+                      'train_mode': False,
+                      'target_sizes': meta_test[SIZE_COLUMNS].values
+                      },
+            }
+    pipeline = PIPELINES['unet']['inference'](context.config('unet_inference'))
+    save_untrained_transformers(pipeline)
+    return lambda: pipeline.transform(data), len(meta_test)
+
+
+def measure(run, repeat):
+    run()
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        run()
+        timings.append(time.time() - start)
+    return timings
+
+
+def environment():
+    info = {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count()}
+    try:
+        import torch
+        info['torch'] = torch.__version__
+    except ImportError:
+        pass
+    return info
+
+
+def check_targets(results):
+    missed = []
+    for name, result in results.items():
+        if name in TARGETS and result['median_s'] > TARGETS[name]:
+            print('{:<30} {:>10.4f}s above the {:.2f}s target'.format(name, result['median_s'], TARGETS[name]))
+            missed.append(name)
+    return missed
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['median_s'] / baseline[name]['median_s']
+        status = 'REGRESSION' if ratio > 1 + threshold else 'ok'
+        print('{:<30} {:>10.4f}s {:>10.4f}s {:>8.2f}x  {}'.format(name, baseline[name]['median_s'],
+                                                                  result['median_s'], ratio, status))
+        if status != 'ok':
+            regressions.append(name)
+    return regressions
+
+
+@click.command()
+@click.option('--only', default='', help='comma separated benchmark names, all by default')
+@click.option('--repeat', default=5)
+@click.option('--output', default='bench_results.json', help='machine readable results')
+@click.option('--baseline', default=BASELINE_FILEPATH)
+@click.option('--threshold', default=0.2, help='allowed relative slowdown against the baseline')
+@click.option('--save_baseline', is_flag=True, help='store these results as the new baseline')
+def main(only, repeat, output, baseline, threshold, save_baseline):
+    names = only.split(',') if only else list(BENCHMARKS)
+    context = BenchmarkContext()
+    results = OrderedDict()
+    try:
+        for name in names:
+            run, items = BENCHMARKS[name](context)
+            timings = measure(run, repeat)
+            median = float(np.median(timings))
+            results[name] = {'median_s': median, 'min_s': float(np.min(timings)), 'repeat': repeat, 'items': items,
+                             'per_item_ms': 1000. * median / items}
+            print('{:<30} median {:>10.4f}s  per item {:>10.3f}ms'.format(name, median, results[name]['per_item_ms']))
+    finally:
+        context.close()
+
+    with open(output, 'w') as f:
+        json.dump({'environment': environment(), 'benchmarks': results}, f, indent=2)
+
+    regressions = check_targets(results)
+    if save_baseline:
+        with open(baseline, 'w') as f:
+            json.dump({'environment': environment(), 'benchmarks': results}, f, indent=2)
+    elif os.path.exists(baseline):
+        with open(baseline) as f:
+            regressions += compare(results, json.load(f)['benchmarks'], threshold)
+
+    if regressions:
+        print('regressions: {}'.format(', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
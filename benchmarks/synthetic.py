@@ -0,0 +1,80 @@
+"""
+Synthetic nuclei images and masks laid out like the stage1 data, so that benchmarks run offline.
+"""
+import os
+
+import numpy as np
+from PIL import Image
+
+from preparation import overlay_masks
+from utils import generate_metadata
+
+# most frequent stage1 image sizes (height, width)
+IMAGE_SIZES = [(256, 256), (256, 320), (520, 696), (360, 360), (1024, 1024)]
+NUCLEI_NR_RANGE = (5, 80)
+NUCLEI_RADIUS_RANGE = (4, 18)
+
+
+def generate_nuclei(image_size, nuclei_nr, random_state):
+    """
+    Returns a uint8 RGB image and a list of binary uint8 (0/255) masks, one per nucleus.
+    Nuclei are random ellipses, some of them touching, on a dark noisy background.
+    """
+    h, w = image_size
+    yy, xx = np.mgrid[:h, :w]
+    image = random_state.normal(20, 5, size=(h, w))
+    masks = []
+    for _ in range(nuclei_nr):
+        cy, cx = random_state.randint(0, h), random_state.randint(0, w)
+        ry, rx = random_state.randint(*NUCLEI_RADIUS_RANGE, size=2)
+        angle = random_state.uniform(0, np.pi)
+        dy, dx = yy - cy, xx - cx
+        u = dx * np.cos(angle) + dy * np.sin(angle)
+        v = -dx * np.sin(angle) + dy * np.cos(angle)
+        mask = (u / rx) ** 2 + (v / ry) ** 2 <= 1
+        if not mask.any():
+            continue
+        image[mask] = random_state.normal(160, 20)
+        masks.append(mask.astype(np.uint8) * 255)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    return np.stack([image] * 3, axis=-1), masks
+
+
+def synthetic_sample(random_state, image_size=None):
+    if image_size is None:
+        image_size = IMAGE_SIZES[random_state.randint(len(IMAGE_SIZES))]
+    nuclei_nr = random_state.randint(*NUCLEI_NR_RANGE)
+    return generate_nuclei(image_size, nuclei_nr, random_state)
+
+
+def instance_labels(masks, image_size):
+    labels = np.zeros(image_size, dtype=np.int32)
+    for i, mask in enumerate(masks):
+        labels[mask > 0] = i + 1
+    return labels
+
+
+def write_dataset(data_dir, train_nr, test_nr, seed=1234):
+    """
+    Writes a stage1-like directory tree, overlays the train masks and returns the metadata
+    exactly as `prepare_metadata` would.
+    """
+    random_state = np.random.RandomState(seed)
+    masks_overlayed_dir = os.path.join(data_dir, 'masks_overlayed')
+    for subdir_name, images_nr in [('stage1_train', train_nr), ('stage1_test', test_nr)]:
+        for i in range(images_nr):
+            image_id = '{}_{:04d}'.format(subdir_name, i)
+            image, masks = synthetic_sample(random_state)
+
+            image_dir = os.path.join(data_dir, subdir_name, image_id, 'images')
+            os.makedirs(image_dir, exist_ok=True)
+            Image.fromarray(image).save(os.path.join(image_dir, '{}.png'.format(image_id)))
+
+            if subdir_name == 'stage1_train':
+                masks_dir = os.path.join(data_dir, subdir_name, image_id, 'masks')
+                os.makedirs(masks_dir, exist_ok=True)
+                for j, mask in enumerate(masks):
+                    Image.fromarray(mask).save(os.path.join(masks_dir, '{}.png'.format(j)))
+
+    overlay_masks(images_dir=data_dir, subdir_name='stage1_train', target_dir=masks_overlayed_dir)
+    return generate_metadata(data_dir=data_dir, masks_overlayed_dir=masks_overlayed_dir)
@@ -0,0 +1,60 @@
+"""
+Per image cost of batched test time augmentation against plain inference and against
+running every variant as a separate forward pass.
+
+    python -m benchmarks.tta --transforms all --batch_size 8
+"""
+import time
+
+import click
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+from pipeline_config import build_solution_config
+from steps.pytorch.architectures.unet import UNet
+from steps.pytorch.tta import get_tta_transforms, tta_predict
+from utils import read_params
+
+
+def per_image_ms(run, batch_size, repeat):
+    run()
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        run()
+        timings.append(time.time() - start)
+    return 1000. * np.median(timings) / batch_size
+
+
+@click.command()
+@click.option('--transforms', default='all', help='comma separated tta transforms or all')
+@click.option('--batch_size', default=8)
+@click.option('--repeat', default=5)
+def main(transforms, batch_size, repeat):
+    config = build_solution_config(read_params())
+    model_params = config.unet_network.architecture_config.model_params
+    dataset_params = config.loader.dataset_params
+    model = UNet(**model_params).eval()
+    X = Variable(torch.randn(batch_size, model_params.in_channels, dataset_params.h, dataset_params.w))
+    tta_transforms = get_tta_transforms(transforms if transforms == 'all' else transforms.split(','))
+
+    def plain():
+        model(X)
+
+    def batched():
+        tta_predict(model, X, tta_transforms)
+
+    def looped():
+        for _, (forward, inverse) in tta_transforms:
+            inverse(model(forward(X)).data)
+
+    with torch.no_grad():
+        plain_ms = per_image_ms(plain, batch_size, repeat)
+        for name, run in [('plain', plain), ('tta batched', batched), ('tta looped', looped)]:
+            ms = plain_ms if name == 'plain' else per_image_ms(run, batch_size, repeat)
+            print('{:<12} {:>10.2f} ms/image {:>8.2f}x'.format(name, ms, ms / plain_ms))
+
+
+if __name__ == '__main__':
+    main()
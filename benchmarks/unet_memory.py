@@ -0,0 +1,86 @@
+"""
+Peak memory of one UNet forward pass against the reference forward that keeps every skip tensor,
+concatenates with torch.cat and uses out of place ReLUs. Every measurement runs in a fresh process
+and reports the growth of its peak RSS during the pass.
+
+    python -m benchmarks.unet_memory --batch_sizes 1,4,8 --image_size 512
+"""
+import multiprocessing as mp
+import resource
+
+import click
+import torch
+import torch.nn as nn
+from torch.autograd import Variable
+
+from pipeline_config import build_solution_config
+from steps.pytorch.architectures.unet import UNet
+from utils import read_params
+
+
+def reference_forward(model, x):
+    x = model.input_block(x)
+
+    down_convs_outputs = []
+    for block, down_pool in zip(model.down_convs, model.down_pools):
+        x = block(x)
+        down_convs_outputs.append(x)
+        x = down_pool(x)
+    x = model.floor_block(x)
+
+    for down_conv_output, block, up_sample in zip(reversed(down_convs_outputs),
+                                                  reversed(model.up_convs),
+                                                  reversed(model.up_samples)):
+        x = up_sample(x)
+        x = torch.cat((down_conv_output, x), dim=1)
+        x = block(x)
+
+    return model.classification_block(x)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def _worker(model_params, batch_size, image_size, reference, training, results):
+    model = UNet(**model_params)
+    model.train(training)
+    if reference:
+        for module in model.modules():
+            if isinstance(module, nn.ReLU):
+                module.inplace = False
+    X = Variable(torch.randn(batch_size, model_params['in_channels'], image_size, image_size))
+
+    start = peak_rss_mb()
+    with torch.set_grad_enabled(training):
+        output = reference_forward(model, X) if reference else model(X)
+        if training:
+            output.mean().backward()
+    results.put(peak_rss_mb() - start)
+
+
+def measure(model_params, batch_size, image_size, reference, training):
+    results = mp.Queue()
+    process = mp.Process(target=_worker, args=(model_params, batch_size, image_size, reference, training, results))
+    process.start()
+    peak_mb = results.get()
+    process.join()
+    return peak_mb
+
+
+@click.command()
+@click.option('--batch_sizes', default='1,4,8', help='comma separated batch sizes')
+@click.option('--image_size', default=256)
+@click.option('--training', is_flag=True, help='measure forward and backward with autograd')
+def main(batch_sizes, image_size, training):
+    model_params = dict(build_solution_config(read_params()).unet_network.architecture_config.model_params)
+    print('{:>10} {:>16} {:>16} {:>10}'.format('batch', 'reference MB', 'optimized MB', 'saved'))
+    for batch_size in (int(b) for b in batch_sizes.split(',')):
+        reference_mb = measure(model_params, batch_size, image_size, True, training)
+        optimized_mb = measure(model_params, batch_size, image_size, False, training)
+        print('{:>10} {:>16.1f} {:>16.1f} {:>9.1f}%'.format(batch_size, reference_mb, optimized_mb,
+                                                          100. * (1 - optimized_mb / max(reference_mb, 1e-9))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Parameters, multiply-adds and CPU latency of the lightweight UNet variants against the standard UNet
+at the n_filters and repeat_blocks of neptune.yaml.
+
+    python -m benchmarks.unet_variants --batch_size 1 --threads 4
+"""
+import time
+from collections import OrderedDict
+
+import click
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.autograd import Variable
+
+from pipeline_config import build_solution_config
+from steps.pytorch.architectures.unet import UNet
+from utils import read_params
+
+VARIANTS = OrderedDict([('standard', {}),
+                        ('separable', {'separable_convs': True}),
+                        ('bilinear', {'bilinear_upsampling': True}),
+                        ('separable+bilinear', {'separable_convs': True, 'bilinear_upsampling': True}),
+                        ('separable+bilinear x0.5', {'separable_convs': True, 'bilinear_upsampling': True,
+                                                     'width_multiplier': 0.5}),
+                        ])
+
+
+def count_parameters(model):
+    return sum(parameter.numel() for parameter in model.parameters())
+
+
+def count_multiply_adds(model, X):
+    """
+    Multiply-adds of the convolutions of one forward pass, the rest of the layers are negligible.
+    """
+    total = [0]
+
+    def hook(module, inputs, output):
+        kernel_ops = module.kernel_size[0] * module.kernel_size[1] * module.in_channels // module.groups
+        if isinstance(module, nn.ConvTranspose2d):
+            total[0] += kernel_ops * inputs[0].numel() // module.in_channels * module.out_channels
+        else:
+            total[0] += kernel_ops * output.numel()
+
+    handles = [module.register_forward_hook(hook) for module in model.modules()
+               if isinstance(module, (nn.Conv2d, nn.ConvTranspose2d))]
+    model(X)
+    for handle in handles:
+        handle.remove()
+    return total[0] // X.size(0)
+
+
+def latency_ms(model, X, repeat):
+    model(X)
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        model(X)
+        timings.append(time.time() - start)
+    return 1000. * np.median(timings) / X.size(0)
+
+
+@click.command()
+@click.option('--batch_size', default=1)
+@click.option('--threads', default=0, help='torch threads, torch default when 0')
+@click.option('--repeat', default=10)
+def main(batch_size, threads, repeat):
+    if threads:
+        torch.set_num_threads(threads)
+    config = build_solution_config(read_params())
+    model_params = dict(config.unet_network.architecture_config.model_params,
+                        separable_convs=False, bilinear_upsampling=False, width_multiplier=1.0)
+    dataset_params = config.loader.dataset_params
+    X = Variable(torch.randn(batch_size, model_params['in_channels'], dataset_params.h, dataset_params.w))
+
+    print('{:<24} {:>12} {:>12} {:>14} {:>8}'.format('variant', 'params', 'GMACs/image', 'ms/image', 'speedup'))
+    with torch.no_grad():
+        standard_ms = None
+        for name, overrides in VARIANTS.items():
+            model = UNet(**dict(model_params, **overrides)).eval()
+            ms = latency_ms(model, X, repeat)
+            standard_ms = standard_ms or ms
+            print('{:<24} {:>12,} {:>12.2f} {:>14.2f} {:>7.2f}x'.format(
+                name, count_parameters(model), count_multiply_adds(model, X) / 1e9, ms, standard_ms / ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+import json
+import os
+from copy import deepcopy
+from multiprocessing import Process
+from multiprocessing.connection import wait
+
+import numpy as np
+import pandas as pd
+from sklearn.externals import joblib
+
+from pipeline_config import X_COLUMNS, Y_COLUMNS, LABEL_COLUMNS, SIZE_COLUMNS
+from utils import get_logger, read_masks, encode_predictions
+
+logger = get_logger()
+
+
+def process_config(config, dirpath, decoded_cache_dirpath, threads):
+    """
+    Copy of the solution config for one of several concurrent training processes (cross validation folds,
+    sweep trials). Steps, checkpoints and metrics stay inside `dirpath` and decoded images are read from
+    the cache they all share.
+    """
+    config = deepcopy(config)
+    config['env']['cache_dirpath'] = dirpath
+    config['loader']['dataset_params']['decoded_cache_dirpath'] = decoded_cache_dirpath
+    for loader_params in config['loader']['loader_params'].values():
+        loader_params['num_workers'] = min(loader_params['num_workers'], threads)
+    config['metrics_sink']['filepath'] = os.path.join(dirpath, 'metrics.jsonl')
+    # concurrent processes share the cores through `threads`, placement would give each of them all cores
+    config['loader']['placement_params']['enabled'] = False
+    for network in ['unet_network', 'sequential_convnet']:
+        callbacks_config = config[network]['callbacks_config']
+        callbacks_config['model_checkpoint']['filepath'] = os.path.join(dirpath, 'checkpoints', 'best.torch')
+        callbacks_config['neptune_monitor']['sink'] = config['metrics_sink']
+    return config
+
+
+def warm_decoded_cache(meta, decoded_cache_dirpath, n_jobs):
+    from loaders import DecodedImageCache
+
+    cache = DecodedImageCache(decoded_cache_dirpath)
+    jobs = [(filepath, 'RGB') for filepath in meta[X_COLUMNS[0]].values]
+    jobs += [(filepath, 'L') for filepath in meta[Y_COLUMNS[0]].values]
+    joblib.Parallel(n_jobs=n_jobs)(joblib.delayed(cache.warm)(filepath, mode) for filepath, mode in jobs)
+
+
+def run_fold(pipeline_name, fold_id, meta_train, meta_valid, config, threads):
+    """
+    Trains the fold pipeline, predicts its held out images and writes the out of fold predictions
+    and per image IoUT scores to the fold directory.
+    """
+    import torch
+    from metrics import compute_eval_metric
+    from pipelines import PIPELINES
+
+    torch.set_num_threads(threads)
+    fold_dirpath = config.env.cache_dirpath
+
+    train_data = {'input': {'meta': meta_train,
+                            'meta_valid': meta_valid,
+                            'train_mode': True,
+                            'target_sizes': meta_train[SIZE_COLUMNS].values
+                            },
+                  }
+    PIPELINES[pipeline_name]['train'](config).fit_transform(train_data)
+
+    valid_data = {'input': {'meta': meta_valid,
+                            'meta_valid': None,
+                            'train_mode': False,
+                            'target_sizes': meta_valid[SIZE_COLUMNS].values
+                            },
+                  }
+    output = PIPELINES[pipeline_name]['inference'](config).transform(valid_data)
+    y_pred, labeled = output['y_pred'], output.get('labeled', False)
+    y_true = read_masks(meta_valid[LABEL_COLUMNS].values)
+
+    image_ids = meta_valid['ImageId'].values
+    scores = pd.DataFrame({'ImageId': image_ids,
+                           'fold': fold_id,
+                           'iout': [compute_eval_metric(gt, prediction, labeled)
+                                    for gt, prediction in zip(y_true, y_pred)]})
+    scores.to_csv(os.path.join(fold_dirpath, 'oof_scores.csv'), index=None)
+
+    predictions = encode_predictions(image_ids, y_pred, labeled)
+    predictions['fold'] = fold_id
+    predictions.to_csv(os.path.join(fold_dirpath, 'oof_predictions.csv'), index=None)
+    logger.info('fold {0} IOUT score {1}'.format(fold_id, scores['iout'].mean()))
+
+
+def run_processes(processes, parallel):
+    """
+    Runs at most `parallel` processes at a time, in order, and returns their exit codes.
+    """
+    pending, running = list(processes), []
+    while pending or running:
+        while pending and len(running) < parallel:
+            process = pending.pop(0)
+            process.start()
+            running.append(process)
+        wait([process.sentinel for process in running])
+        for process in [process for process in running if not process.is_alive()]:
+            process.join()
+            running.remove(process)
+    return [process.exitcode for process in processes]
+
+
+def cross_validate(pipeline_name, folds, config, cv_dirpath, cpu_budget, parallel_folds):
+    """
+    Trains the K fold pipelines in `parallel_folds` processes sharing `cpu_budget` cores and one decoded
+    image cache, then aggregates the out of fold predictions and IoUT scores into `cv_dirpath`.
+    """
+    decoded_cache_dirpath = os.path.join(cv_dirpath, 'decoded_cache')
+    threads = max(1, cpu_budget // parallel_folds)
+    logger.info('decoding images into {}'.format(decoded_cache_dirpath))
+    warm_decoded_cache(pd.concat([meta_valid for _, meta_valid in folds]), decoded_cache_dirpath, cpu_budget)
+
+    processes, fold_dirpaths = [], []
+    for fold_id, (meta_train, meta_valid) in enumerate(folds):
+        fold_dirpath = os.path.join(cv_dirpath, 'fold_{}'.format(fold_id))
+        fold_dirpaths.append(fold_dirpath)
+        processes.append(Process(target=run_fold,
+                                 args=(pipeline_name, fold_id, meta_train, meta_valid,
+                                       process_config(config, fold_dirpath, decoded_cache_dirpath, threads), threads)))
+
+    logger.info('training {0} folds, {1} at a time with {2} threads each'.format(len(folds), parallel_folds, threads))
+    exit_codes = run_processes(processes, parallel_folds)
+    failed = [fold_id for fold_id, exit_code in enumerate(exit_codes) if exit_code != 0]
+    if failed:
+        raise RuntimeError('cross validation folds {} failed'.format(failed))
+
+    return aggregate_folds(fold_dirpaths, cv_dirpath)
+
+
+def aggregate_folds(fold_dirpaths, cv_dirpath):
+    scores = pd.concat([pd.read_csv(os.path.join(dirpath, 'oof_scores.csv')) for dirpath in fold_dirpaths])
+    predictions = pd.concat([pd.read_csv(os.path.join(dirpath, 'oof_predictions.csv')) for dirpath in fold_dirpaths])
+    scores.to_csv(os.path.join(cv_dirpath, 'oof_scores.csv'), index=None)
+    predictions.to_csv(os.path.join(cv_dirpath, 'oof_predictions.csv'), index=None)
+
+    fold_scores = scores.groupby('fold')['iout'].agg(['mean', 'count'])
+    report = {'folds': [{'fold': int(fold_id), 'images': int(row['count']), 'iout': float(row['mean'])}
+                        for fold_id, row in fold_scores.iterrows()],
+              'fold_iout_mean': float(fold_scores['mean'].mean()),
+              'fold_iout_std': float(np.std(fold_scores['mean'].values)),
+              'oof_iout': float(scores['iout'].mean()),
+              }
+    with open(os.path.join(cv_dirpath, 'cross_validation.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
@@ -1,17 +1,33 @@
+import hashlib
+import inspect
+import itertools
+import os
+import weakref
+from collections import deque
+
 from attrdict import AttrDict
 from PIL import Image
 from math import ceil
 import numpy as np
 from sklearn.externals import joblib
 import torch
+import torch.multiprocessing as multiprocessing
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.dataloader import default_collate
+from torch.utils.data.distributed import DistributedSampler
 import torchvision.transforms as transforms
 
 from steps.base import BaseTransformer
+from steps.profiler import profiler
+from steps.pytorch.distributed import is_distributed
+from steps.pytorch.placement import Placement
+
+IMAGE_MEAN = [0.5, 0.5, 0.5]
+IMAGE_STD = [0.2, 0.2, 0.2]
 
 
 class MetadataImageSegmentationDataset(Dataset):
-    def __init__(self, X, y, train_mode, image_transform, mask_transform, image_augment):
+    def __init__(self, X, y, train_mode, image_transform, mask_transform, image_augment, decoded_cache=None):
         super().__init__()
         self.X = X
         if y is not None:
@@ -23,59 +39,94 @@ class MetadataImageSegmentationDataset(Dataset):
         self.image_transform = image_transform
         self.mask_transform = mask_transform
         self.image_augment = image_augment
+        self.decoded_cache = decoded_cache
 
     def load_image(self, img_filepath):
+        if self.decoded_cache is not None:
+            return self.decoded_cache.load(img_filepath, 'RGB')
         image = Image.open(img_filepath, 'r')
         return image.convert('RGB')
 
+    def load_mask(self, mask_filepath):
+        if self.decoded_cache is not None:
+            return self.decoded_cache.load(mask_filepath, 'L')
+        image = Image.open(mask_filepath, 'r')
+        return image.convert('L')
+
     def __len__(self):
         return self.X.shape[0]
 
     def __getitem__(self, index):
         img_filepath = self.X[index]
 
-        Xi = self.load_image(img_filepath)
-        if self.image_augment is not None:
-            Xi = self.image_augment(Xi)
+        with profiler.section('decode_image', 'dataset'):
+            Xi = self.load_image(img_filepath)
+        with profiler.section('transform_image', 'dataset'):
+            if self.image_augment is not None:
+                Xi = self.image_augment(Xi)
 
-        if self.image_transform is not None:
-            Xi = self.image_transform(Xi)
+            if self.image_transform is not None:
+                Xi = self.image_transform(Xi)
 
         if self.y is not None and self.train_mode:
             mask_filepath = self.y[index]
-            Mi = self.load_image(mask_filepath)
-            if self.image_augment is not None:
-                Mi = self.image_augment(Mi)
-            if self.mask_transform is not None:
-                Mi = self.mask_transform(Mi)
+            with profiler.section('decode_mask', 'dataset'):
+                Mi = self.load_mask(mask_filepath)
+            with profiler.section('transform_mask', 'dataset'):
+                if self.image_augment is not None:
+                    Mi = self.image_augment(Mi)
+                if self.mask_transform is not None:
+                    Mi = self.mask_transform(Mi)
             return Xi, Mi
         else:
             return Xi
 
 
 class MetadataImageSegmentationLoader(BaseTransformer):
-    def __init__(self, loader_params, dataset_params):
+    def __init__(self, loader_params, dataset_params, placement_params=None):
         super().__init__()
         self.loader_params = AttrDict(loader_params)
         self.dataset_params = AttrDict(dataset_params)
+        self.placement = self.get_placement(placement_params or {})
 
         self.dataset = MetadataImageSegmentationDataset
-        self.image_transform = transforms.Compose([transforms.Scale((self.dataset_params.h,
-                                                                     self.dataset_params.w)),
-                                                   transforms.ToTensor(),
-                                                   transforms.Normalize(mean=[0.5, 0.5, 0.5],
-                                                                        std=[0.2, 0.2, 0.2]),
-                                                   ])
-        self.mask_transform = transforms.Compose([transforms.Scale((self.dataset_params.h,
-                                                                    self.dataset_params.w)),
-                                                  transforms.Lambda(binarize),
-                                                  transforms.Lambda(to_tensor),
-                                                  ])
+        decoded_cache_dirpath = self.dataset_params.get('decoded_cache_dirpath')
+        self.decoded_cache = DecodedImageCache(decoded_cache_dirpath) if decoded_cache_dirpath else None
+        self.uint8_transport = self.dataset_params.get('uint8_transport', False)
+        if self.uint8_transport:
+            # workers ship uint8, conversion and normalization run once per batch in `normalize_batches`
+            self.image_transform = transforms.Compose([transforms.Scale((self.dataset_params.h,
+                                                                         self.dataset_params.w)),
+                                                       transforms.Lambda(to_uint8_tensor),
+                                                       ])
+            self.mask_transform = transforms.Compose([transforms.Scale((self.dataset_params.h,
+                                                                        self.dataset_params.w)),
+                                                      transforms.Lambda(binarize_uint8),
+                                                      transforms.Lambda(to_tensor),
+                                                      ])
+        else:
+            self.image_transform = transforms.Compose([transforms.Scale((self.dataset_params.h,
+                                                                         self.dataset_params.w)),
+                                                       transforms.ToTensor(),
+                                                       transforms.Normalize(mean=IMAGE_MEAN,
+                                                                            std=IMAGE_STD),
+                                                       ])
+            self.mask_transform = transforms.Compose([transforms.Scale((self.dataset_params.h,
+                                                                        self.dataset_params.w)),
+                                                      transforms.Lambda(binarize),
+                                                      transforms.Lambda(to_tensor),
+                                                      ])
         self.image_augment = None
 
     def transform(self, X, y, X_valid=None, y_valid=None, train_mode=True):
+        if self.placement is not None:
+            self.placement.apply_main()
+
+        if train_mode and y is not None and self.loader_params.training.get('worker_pool'):
+            return self.pooled_transform(X, y, X_valid, y_valid)
+
         if train_mode and y is not None:
-            flow, steps = self.get_datagen(X, y, True, self.loader_params.training)
+            flow, steps = self.get_datagen(X, y, True, self.loader_params.training, shard=is_distributed())
         else:
             flow, steps = self.get_datagen(X, None, False, self.loader_params.inference)
 
@@ -87,24 +138,87 @@ class MetadataImageSegmentationLoader(BaseTransformer):
         return {'datagen': (flow, steps),
                 'validation_datagen': (valid_flow, valid_steps)}
 
-    def get_datagen(self, X, y, train_mode, loader_params):
+    def pooled_transform(self, X, y, X_valid=None, y_valid=None):
+        """
+        Training and validation datagens backed by one WorkerPool that lives as long as they do,
+        so worker processes are started once per fit instead of once per pass over the data.
+        """
+        datasets = {'training': self.get_dataset(X, y, True)}
+        if X_valid is not None and y_valid is not None:
+            datasets['validation'] = self.get_dataset(X_valid, y_valid, True)
+        pool = WorkerPool(datasets, num_workers=self.loader_params.training.num_workers,
+                          worker_init=self.placement.worker_init_fn() if self.placement is not None else None)
+
+        training_params = self.loader_params.training
+        sampler = DistributedSampler(datasets['training']) if is_distributed() else None
+        flow = PooledDataLoader(pool, 'training', len(datasets['training']),
+                                batch_size=training_params.batch_size,
+                                shuffle=training_params.shuffle,
+                                sampler=sampler,
+                                prefetch=pool_prefetch(training_params),
+                                pin_memory=training_params.get('pin_memory', False),
+                                timeout=training_params.get('worker_pool_timeout', 600))
+        steps = len(flow)
+        flow = self.normalize_batches(flow)
+
+        if 'validation' in datasets:
+            inference_params = self.loader_params.inference
+            valid_flow = PooledDataLoader(pool, 'validation', len(datasets['validation']),
+                                          batch_size=inference_params.batch_size,
+                                          prefetch=pool_prefetch(inference_params),
+                                          pin_memory=inference_params.get('pin_memory', False),
+                                          timeout=training_params.get('worker_pool_timeout', 600))
+            valid_steps = len(valid_flow)
+            valid_flow = self.normalize_batches(valid_flow)
+        else:
+            valid_flow = None
+            valid_steps = None
+        return {'datagen': (flow, steps),
+                'validation_datagen': (valid_flow, valid_steps)}
+
+    def get_placement(self, placement_params):
+        if not placement_params.get('enabled'):
+            return None
+        num_workers = max(params.get('num_workers', 0) for params in self.loader_params.values())
+        return Placement(num_workers,
+                         worker_threads=placement_params.get('worker_threads', 1),
+                         pin_cpus=placement_params.get('pin_cpus', False),
+                         numa_node=placement_params.get('numa_node', -1))
+
+    def get_dataset(self, X, y, train_mode):
         if train_mode:
-            dataset = self.dataset(X, y,
-                                   train_mode=True,
-                                   image_augment=self.image_augment,
-                                   mask_transform=self.mask_transform,
-                                   image_transform=self.image_transform)
+            return self.dataset(X, y,
+                                train_mode=True,
+                                image_augment=self.image_augment,
+                                mask_transform=self.mask_transform,
+                                image_transform=self.image_transform,
+                                decoded_cache=self.decoded_cache)
         else:
-            dataset = self.dataset(X, y,
-                                   train_mode=False,
-                                   image_augment=None,
-                                   mask_transform=self.mask_transform,
-                                   image_transform=self.image_transform)
+            return self.dataset(X, y,
+                                train_mode=False,
+                                image_augment=None,
+                                mask_transform=self.mask_transform,
+                                image_transform=self.image_transform,
+                                decoded_cache=self.decoded_cache)
 
-        datagen = DataLoader(dataset, **loader_params)
+    def get_datagen(self, X, y, train_mode, loader_params, shard=False):
+        dataset = self.get_dataset(X, y, train_mode)
 
-        steps = ceil(X.shape[0] / loader_params.batch_size)
-        return datagen, steps
+        loader_params = dataloader_params(loader_params)
+        if self.placement is not None and loader_params.get('num_workers') and dataloader_supports('worker_init_fn'):
+            loader_params['worker_init_fn'] = self.placement.worker_init_fn()
+        if shard:
+            loader_params = {key: value for key, value in loader_params.items() if key != 'shuffle'}
+            sampler = DistributedSampler(dataset)
+            datagen = DataLoader(dataset, sampler=sampler, collate_fn=profiled_collate, **loader_params)
+            steps = ceil(len(sampler) / loader_params['batch_size'])
+        else:
+            datagen = DataLoader(dataset, collate_fn=profiled_collate, **loader_params)
+            steps = ceil(X.shape[0] / loader_params['batch_size'])
+        return self.normalize_batches(datagen), steps
+
+    def normalize_batches(self, datagen):
+        return Uint8BatchNormalizer(datagen) if self.uint8_transport else datagen
 
     def load(self, filepath):
         params = joblib.load(filepath)
@@ -116,6 +230,207 @@ class MetadataImageSegmentationLoader(BaseTransformer):
         joblib.dump(params, filepath)
 
 
+class DecodedImageCache:
+    """
+    Decoded images stored as .npy files keyed by source path, modification time and PIL mode, so that
+    several processes (e.g. cross validation folds) decode every image only once. Files are written
+    to a temporary name and renamed, readers never see a partial array.
+    """
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+
+    def filepath(self, image_filepath, mode):
+        key = '{}:{}:{}'.format(os.path.abspath(image_filepath), os.path.getmtime(image_filepath), mode)
+        digest = hashlib.md5(key.encode()).hexdigest()
+        return os.path.join(self.dirpath, digest[:2], '{}.npy'.format(digest))
+
+    def load(self, image_filepath, mode):
+        filepath = self.filepath(image_filepath, mode)
+        try:
+            return Image.fromarray(np.load(filepath))
+        except FileNotFoundError:
+            image = Image.open(image_filepath, 'r').convert(mode)
+            self.save(filepath, np.array(image))
+            return image
+
+    def save(self, filepath, array):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        tmp_filepath = '{}.{}.tmp'.format(filepath, os.getpid())
+        with open(tmp_filepath, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_filepath, filepath)
+
+    def warm(self, image_filepath, mode):
+        filepath = self.filepath(image_filepath, mode)
+        if not os.path.exists(filepath):
+            self.save(filepath, np.array(Image.open(image_filepath, 'r').convert(mode)))
+
+
+def dataloader_supports(param_name):
+    return param_name in inspect.signature(DataLoader.__init__).parameters
+
+
+def dataloader_params(loader_params):
+    """
+    Drops the settings this torch version's DataLoader does not know about, and the prefetch factor
+    when batches are loaded in the main process.
+    """
+    params = {}
+    for key, value in loader_params.items():
+        if not dataloader_supports(key):
+            continue
+        if key == 'prefetch_factor' and not loader_params.get('num_workers'):
+            continue
+        params[key] = value
+    return params
+
+
+class WorkerPool:
+    """
+    Persistent worker processes that load and collate batches of the datasets registered when the
+    pool starts. Workers are terminated once the pool is garbage collected.
+    """
+
+    def __init__(self, datasets, num_workers, worker_init=None):
+        self.pool = multiprocessing.Pool(max(1, num_workers), initializer=_register_datasets,
+                                         initargs=(datasets, worker_init))
+        self._finalizer = weakref.finalize(self, self.pool.terminate)
+
+    def submit(self, dataset_name, indices):
+        return self.pool.apply_async(_load_batch, (dataset_name, indices))
+
+    def close(self):
+        self._finalizer()
+
+
+_WORKER_DATASETS = {}
+
+
+def _register_datasets(datasets, worker_init=None):
+    if worker_init is not None:
+        worker_init()
+    _WORKER_DATASETS.update(datasets)
+
+
+def _load_batch(dataset_name, indices):
+    dataset = _WORKER_DATASETS[dataset_name]
+    return profiled_collate([dataset[index] for index in indices])
+
+
+class PooledDataLoader:
+    """
+    DataLoader-like iterable over a dataset registered in a WorkerPool, keeping `prefetch` batches in
+    flight. `prefetch_next_epoch` submits the first batches of the next pass ahead of time, e.g. while
+    the model is being validated. A batch not loaded within `timeout` seconds raises, a worker killed
+    by the OOM killer never returns its batch.
+    """
+
+    def __init__(self, pool, dataset_name, dataset_size, batch_size, shuffle=False, sampler=None, prefetch=2,
+                 pin_memory=False, timeout=600):
+        self.pool = pool
+        self.dataset_name = dataset_name
+        self.dataset_size = dataset_size
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.sampler = sampler
+        self.prefetch = prefetch
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.timeout = timeout
+        self._prefetched = None
+
+    def __len__(self):
+        samples_nr = len(self.sampler) if self.sampler is not None else self.dataset_size
+        return ceil(samples_nr / self.batch_size)
+
+    def _batches(self):
+        if self.sampler is not None:
+            indices = list(self.sampler)
+        elif self.shuffle:
+            indices = np.random.permutation(self.dataset_size).tolist()
+        else:
+            indices = list(range(self.dataset_size))
+        return enumerate([indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)])
+
+    def _start(self):
+        batches = self._batches()
+        pending = deque((batch_nr, self.pool.submit(self.dataset_name, indices))
+                        for batch_nr, indices in itertools.islice(batches, self.prefetch))
+        return batches, pending
+
+    def prefetch_next_epoch(self):
+        if self._prefetched is None:
+            self._prefetched = self._start()
+
+    def __iter__(self):
+        batches, pending = self._prefetched or self._start()
+        self._prefetched = None
+        while pending:
+            batch_nr, result = pending.popleft()
+            for next_batch_nr, indices in itertools.islice(batches, 1):
+                pending.append((next_batch_nr, self.pool.submit(self.dataset_name, indices)))
+            try:
+                batch = result.get(timeout=self.timeout)
+            except multiprocessing.TimeoutError:
+                raise RuntimeError('batch {0} of {1} dataset {2} was not loaded within {3}s, a pool worker '
+                                   'may have been killed (e.g. out of memory)'.format(
+                                       batch_nr, len(self), self.dataset_name, self.timeout)) from None
+            yield pin_batch(batch) if self.pin_memory else batch
+
+
+class Uint8BatchNormalizer:
+    """
+    Wraps a datagen of uint8 batches and turns each collated batch into normalized float images and
+    float masks in the main process. Any other attribute (sampler, prefetch_next_epoch) is the wrapped
+    datagen's.
+    """
+
+    def __init__(self, batch_gen):
+        self.batch_gen = batch_gen
+
+    def __len__(self):
+        return len(self.batch_gen)
+
+    def __getattr__(self, name):
+        if name == 'batch_gen':
+            raise AttributeError(name)
+        return getattr(self.batch_gen, name)
+
+    def __iter__(self):
+        for batch in self.batch_gen:
+            with profiler.section('normalize', 'dataset'):
+                if isinstance(batch, (list, tuple)):
+                    X, M = batch
+                    batch = normalize_images(X), M.float()
+                else:
+                    batch = normalize_images(batch)
+            yield batch
+
+
+def normalize_images(X):
+    """
+    uint8 NCHW batch to the float batch `transforms.ToTensor` and `transforms.Normalize` would give.
+    """
+    mean = torch.FloatTensor(IMAGE_MEAN).view(1, -1, 1, 1)
+    std = torch.FloatTensor(IMAGE_STD).view(1, -1, 1, 1)
+    return X.float().div_(255.).sub_(mean).div_(std)
+
+
+def pin_batch(batch):
+    if isinstance(batch, (list, tuple)):
+        return [tensor.pin_memory() for tensor in batch]
+    return batch.pin_memory()
+
+
+def pool_prefetch(loader_params):
+    return max(1, loader_params.get('num_workers', 0)) * loader_params.get('prefetch_factor', 2)
+
+
+def profiled_collate(batch):
+    with profiler.section('collate', 'dataset'):
+        return default_collate(batch)
+
+
 def binarize(x):
     x_ = x.convert('L')  # convert image to monochrome
     x_ = np.array(x_)
@@ -123,6 +438,19 @@ def binarize(x):
     return x_
 
 
+def binarize_uint8(x):
+    x_ = x.convert('L')
+    x_ = np.array(x_)
+    x_ = (x_ > 125).astype(np.uint8)
+    return x_
+
+
+def to_uint8_tensor(x):
+    x_ = np.array(x.convert('RGB'), dtype=np.uint8).transpose(2, 0, 1)
+    x_ = torch.from_numpy(np.ascontiguousarray(x_))
+    return x_
+
+
 def to_tensor(x):
     x_ = np.expand_dims(x, axis=0)
     x_ = torch.from_numpy(x_)
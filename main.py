@@ -1,28 +1,44 @@
+import multiprocessing as mp
 import os
 import shutil
+from copy import deepcopy
+from functools import lru_cache
 
 import click
-from deepsense import neptune
-import pandas as pd
 
-from pipeline_config import SOLUTION_CONFIG, Y_COLUMNS, SIZE_COLUMNS
-from pipelines import PIPELINES
-from preparation import train_valid_split, overlay_masks
-from metrics import intersection_over_union, intersection_over_union_thresholds
-from utils import init_logger, get_logger, read_masks, read_params, create_submission, generate_metadata
+from pipeline_config import build_solution_config, X_COLUMNS, Y_COLUMNS, LABEL_COLUMNS, SIZE_COLUMNS
+from utils import init_logger, get_logger, read_params
+from steps.profiler import profiler
 
+# heavy dependencies (torch, pandas, sklearn, skimage, neptune) are imported by the commands that use them,
+# parameters and the solution config are read by the first command that needs them
 logger = get_logger()
-ctx = neptune.Context()
-params = read_params()
+
+
+@lru_cache(maxsize=None)
+def get_params():
+    return read_params()
+
+
+@lru_cache(maxsize=None)
+def get_solution_config():
+    return build_solution_config(get_params())
 
 
 @click.group()
-def action():
-    pass
+@click.option('--profile', is_flag=True, help='record per-stage timings to experiment_dir/profile')
+def action(profile):
+    params = get_params()
+    if profile:
+        profiler.enable(os.path.join(params.experiment_dir, 'profile'))
+        click.get_current_context().call_on_close(profiler.report)
 
 
 @action.command()
 def prepare_metadata():
+    from utils import generate_metadata
+
+    params = get_params()
     logger.info('creating metadata')
     meta = generate_metadata(data_dir=params.data_dir, masks_overlayed_dir=params.masks_overlayed_dir)
     meta.to_csv(os.path.join(params.meta_dir, 'stage1_metadata.csv'), index=None)
@@ -30,10 +46,52 @@ def prepare_metadata():
 
 @action.command()
 def prepare_masks():
+    from preparation import overlay_masks
+
+    params = get_params()
     logger.info('overlaying masks')
     overlay_masks(images_dir=params.data_dir, subdir_name='stage1_train', target_dir=params.masks_overlayed_dir)
 
 
+@action.command()
+@click.option('--num_workers', help='comma separated worker counts', default='0,2,4,8', required=False)
+@click.option('--batch_sizes', help='comma separated training batch sizes', default='8,16,32,64', required=False)
+@click.option('--prefetch_factors', help='comma separated batches prefetched per worker', default='2,4',
+              required=False)
+@click.option('--pin_memory', help='comma separated pin memory settings', default='0,1', required=False)
+@click.option('--steps', help='timed batches per trial', default=20, required=False)
+@click.option('--warmup_steps', help='untimed batches per trial', default=3, required=False)
+@click.option('--max_rss_mb', help='skip settings with a higher peak memory, 0 for no limit', default=0,
+              required=False)
+def autotune_loader(num_workers, batch_sizes, prefetch_factors, pin_memory, steps, warmup_steps, max_rss_mb):
+    import pandas as pd
+    from autotuning import autotune_loader, loader_grid
+    from utils import machine_overrides_filepath, write_overrides
+
+    params = get_params()
+    meta = pd.read_csv(os.path.join(params.meta_dir, 'stage1_metadata.csv'))
+    meta_train = meta[meta['is_train'] == 1]
+
+    grid = loader_grid(num_workers=[int(value) for value in num_workers.split(',')],
+                       batch_sizes=[int(value) for value in batch_sizes.split(',')],
+                       prefetch_factors=[int(value) for value in prefetch_factors.split(',')],
+                       pin_memory=[int(value) for value in pin_memory.split(',')])
+    best, _ = autotune_loader(meta_train[X_COLUMNS].values, meta_train[Y_COLUMNS].values, get_solution_config(), grid,
+                              steps=steps, warmup_steps=warmup_steps, max_rss_mb=max_rss_mb, logger=logger)
+
+    loader_params = best['loader_params']
+    overrides = {'num_workers': loader_params['num_workers'],
+                 'batch_size_train': loader_params['batch_size'],
+                 'pin_memory': int(loader_params['pin_memory']),
+                 }
+    if 'prefetch_factor' in loader_params:
+        overrides['prefetch_factor'] = loader_params['prefetch_factor']
+    filepath = machine_overrides_filepath()
+    write_overrides(filepath, overrides)
+    logger.info('best loader setting {0} with {1:.1f} samples/sec and {2:.0f}MB peak RSS, saved to {3}'.format(
+        overrides, best['samples_per_sec'], best['peak_rss_mb'], filepath))
+
+
 @action.command()
 @click.option('-p', '--pipeline_name', help='pipeline to be trained', required=True)
 @click.option('-v', '--validation_size', help='percentage of training used for validation', default=0.1, required=False)
@@ -41,12 +99,21 @@ def train_pipeline(pipeline_name, validation_size):
     _train_pipeline(pipeline_name, validation_size)
 
 
-def _train_pipeline(pipeline_name, validation_size):
-    if bool(params.overwrite) and os.path.isdir(params.experiment_dir):
+def _train_pipeline(pipeline_name, validation_size, config=None, session=None):
+    from session import PipelineSession
+    from steps.pytorch.distributed import is_master, barrier
+
+    params = get_params()
+    if session is None:
+        session = PipelineSession(pipeline_name, config or get_solution_config(), params.meta_dir, validation_size)
+    elif config is not None and config is not session.config:
+        raise ValueError('pass the config either directly or through the session, not both')
+
+    if is_master() and bool(params.overwrite) and os.path.isdir(params.experiment_dir):
         shutil.rmtree(params.experiment_dir)
+    barrier()
 
-    meta = pd.read_csv(os.path.join(params.meta_dir, 'stage1_metadata.csv'))
-    meta_train_split, meta_valid_split = train_valid_split(meta, validation_size)
+    meta_train_split, meta_valid_split = session.train_valid_split
 
     data = {'input': {'meta': meta_train_split,
                       'meta_valid': meta_valid_split,
@@ -55,10 +122,56 @@ def _train_pipeline(pipeline_name, validation_size):
                       },
             }
 
-    pipeline = PIPELINES[pipeline_name]['train'](SOLUTION_CONFIG)
+    pipeline = session.train_pipeline()
     pipeline.fit_transform(data)
 
 
+@action.command()
+@click.option('-p', '--pipeline_name', help='pipeline to be trained', required=True)
+@click.option('-v', '--validation_size', help='percentage of training used for validation', default=0.1, required=False)
+@click.option('-n', '--nproc_per_node', help='number of training processes on this node', default=2, required=False)
+@click.option('--nnodes', help='number of nodes', default=1, required=False)
+@click.option('--node_rank', help='rank of this node', default=0, required=False)
+@click.option('--master_addr', help='address of the rank 0 node', default='127.0.0.1', required=False)
+@click.option('--master_port', help='free port on the rank 0 node', default=29500, required=False)
+def train_pipeline_distributed(pipeline_name, validation_size, nproc_per_node, nnodes, node_rank, master_addr,
+                               master_port):
+    world_size = nnodes * nproc_per_node
+    threads_per_process = max(1, mp.cpu_count() // nproc_per_node)
+    logger.info('training on {0} processes, {1} threads each'.format(world_size, threads_per_process))
+
+    processes = []
+    for local_rank in range(nproc_per_node):
+        rank = node_rank * nproc_per_node + local_rank
+        process = mp.Process(target=_distributed_train_worker,
+                             args=(pipeline_name, validation_size, rank, world_size, master_addr, master_port,
+                                   threads_per_process))
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        process.join()
+
+    failed = [process.exitcode for process in processes if process.exitcode != 0]
+    if failed:
+        raise RuntimeError('distributed training failed with exit codes {}'.format(failed))
+
+
+def _distributed_train_worker(pipeline_name, validation_size, rank, world_size, master_addr, master_port, threads):
+    import torch
+    from steps.pytorch.distributed import init_distributed, is_master, get_rank
+
+    params = get_params()
+    torch.set_num_threads(threads)
+    init_distributed(rank, world_size, master_addr, master_port)
+
+    config = deepcopy(get_solution_config())
+    if not is_master():
+        # only rank 0 persists the pipeline, the others keep their step artifacts out of its way
+        config['env']['cache_dirpath'] = os.path.join(params.experiment_dir, 'ranks', str(get_rank()))
+    _train_pipeline(pipeline_name, validation_size, config)
+
+
 @action.command()
 @click.option('-p', '--pipeline_name', help='pipeline to be trained', required=True)
 @click.option('-v', '--validation_size', help='percentage of training used for validation', default=0.1, required=False)
@@ -66,9 +179,16 @@ def evaluate_pipeline(pipeline_name, validation_size):
     _evaluate_pipeline(pipeline_name, validation_size)
 
 
-def _evaluate_pipeline(pipeline_name, validation_size):
-    meta = pd.read_csv(os.path.join(params.meta_dir, 'stage1_metadata.csv'))
-    meta_train_split, meta_valid_split = train_valid_split(meta, validation_size)
+def _evaluate_pipeline(pipeline_name, validation_size, session=None):
+    from metrics import intersection_over_union, intersection_over_union_thresholds
+    from session import PipelineSession
+    from steps.sinks import get_sink
+
+    params = get_params()
+    registry = _init_transformer_registry()
+    session = session or PipelineSession(pipeline_name, get_solution_config(), params.meta_dir, validation_size,
+                                         registry=registry)
+    meta_train_split, meta_valid_split = session.train_valid_split
 
     data = {'input': {'meta': meta_valid_split,
                       'meta_valid': None,
@@ -77,20 +197,78 @@ def _evaluate_pipeline(pipeline_name, validation_size):
                       },
             }
 
-    y_true = read_masks(meta_valid_split[Y_COLUMNS].values)
+    y_true = session.y_true
 
-    pipeline = PIPELINES[pipeline_name]['inference'](SOLUTION_CONFIG)
+    pipeline = session.inference_pipeline()
     output = pipeline.transform(data)
-    y_pred = output['y_pred']
+    y_pred, labeled = output['y_pred'], output.get('labeled', False)
+
+    sink = get_sink(**get_solution_config().metrics_sink)
 
     logger.info('Calculating IOU and IOUT Scores')
-    iou_score = intersection_over_union(y_true, y_pred)
+    iou_score = intersection_over_union(y_true, y_pred, labeled)
     logger.info('IOU score on validation is {}'.format(iou_score))
-    ctx.channel_send('IOU Score', 0, iou_score)
+    sink.send_scalar('IOU Score', 0, iou_score)
 
-    iout_score = intersection_over_union_thresholds(y_true, y_pred)
+    iout_score = intersection_over_union_thresholds(y_true, y_pred, labeled)
     logger.info('IOUT score on validation is {}'.format(iout_score))
-    ctx.channel_send('IOUT Score', 0, iout_score)
+    sink.send_scalar('IOUT Score', 0, iout_score)
+    sink.flush()
+
+
+@action.command()
+@click.option('-p', '--pipeline_name', help='pipeline whose threshold is tuned', required=True)
+@click.option('-v', '--validation_size', help='percentage of training used for validation', default=0.1, required=False)
+@click.option('--min_threshold', help='lowest candidate threshold', default=0.2, required=False)
+@click.option('--max_threshold', help='highest candidate threshold', default=0.8, required=False)
+@click.option('--step', help='spacing of the candidate thresholds', default=0.02, required=False)
+@click.option('--n_jobs', help='scoring processes, num_threads by default', default=0, required=False)
+def tune_threshold(pipeline_name, validation_size, min_threshold, max_threshold, step, n_jobs):
+    import numpy as np
+    import pandas as pd
+    from sklearn.externals import joblib
+    from metrics import threshold_grid_iout
+    from pipelines import PIPELINES
+    from preparation import train_valid_split
+    from utils import read_masks, tuned_overrides_filepath, write_overrides
+
+    params = get_params()
+    meta = pd.read_csv(os.path.join(params.meta_dir, 'stage1_metadata.csv'))
+    meta_train_split, meta_valid_split = train_valid_split(meta, validation_size)
+
+    # probability maps resized to the original image sizes, computed once per pipeline, validation split
+    # and trained transformers, retraining changes the modification time of the network checkpoint
+    mask_resize = PIPELINES[pipeline_name]['inference'](get_solution_config()).get_step('mask_resize')
+    trained_at = max([os.path.getmtime(step.cache_filepath_step_transformer)
+                      for step in mask_resize.all_steps.values() if step.transformer_is_cached] or [0])
+    resized_filepath = os.path.join(params.experiment_dir, 'outputs', 'mask_resize_{0}_validation_{1}_{2}'.format(
+        pipeline_name, validation_size, int(trained_at)))
+    if os.path.exists(resized_filepath):
+        probabilities = joblib.load(resized_filepath)
+    else:
+        data = {'input': {'meta': meta_valid_split,
+                          'meta_valid': None,
+                          'train_mode': False,
+                          'target_sizes': meta_valid_split[SIZE_COLUMNS].values
+                          },
+                }
+        probabilities = mask_resize.transform(data)['resized_images']
+        joblib.dump(probabilities, resized_filepath)
+
+    y_true = read_masks(meta_valid_split[LABEL_COLUMNS].values)
+    thresholds = np.arange(min_threshold, max_threshold + step / 2, step).round(6).tolist()
+    scores = joblib.Parallel(n_jobs=n_jobs or params.num_threads)(
+        joblib.delayed(threshold_grid_iout)(gt, probability, thresholds)
+        for gt, probability in zip(y_true, probabilities))
+    mean_scores = np.mean(scores, axis=0)
+
+    for threshold, score in zip(thresholds, mean_scores):
+        logger.info('threshold {0:.3f} IOUT {1:.4f}'.format(threshold, score))
+    best_threshold = thresholds[int(np.argmax(mean_scores))]
+    filepath = tuned_overrides_filepath(params.experiment_dir)
+    write_overrides(filepath, {'threshold': best_threshold})
+    logger.info('best threshold {0} with IOUT {1:.4f} (was {2}), saved to {3}'.format(
+        best_threshold, float(np.max(mean_scores)), get_solution_config().thresholder.threshold, filepath))
 
 
 @action.command()
@@ -99,9 +277,14 @@ def predict_pipeline(pipeline_name):
     _predict_pipeline(pipeline_name)
 
 
-def _predict_pipeline(pipeline_name):
-    meta = pd.read_csv(os.path.join(params.meta_dir, 'stage1_metadata.csv'))
-    meta_test = meta[meta['is_train'] == 0]
+def _predict_pipeline(pipeline_name, session=None):
+    from session import PipelineSession
+    from utils import create_submission
+
+    params = get_params()
+    registry = _init_transformer_registry()
+    session = session or PipelineSession(pipeline_name, get_solution_config(), params.meta_dir, registry=registry)
+    meta_test = session.meta_test
 
     data = {'input': {'meta': meta_test,
                       'meta_valid': None,
@@ -110,43 +293,170 @@ def _predict_pipeline(pipeline_name):
                       },
             }
 
-    pipeline = PIPELINES[pipeline_name]['inference'](SOLUTION_CONFIG)
+    pipeline = session.inference_pipeline()
     output = pipeline.transform(data)
-    y_pred = output['y_pred']
+    y_pred, labeled = output['y_pred'], output.get('labeled', False)
 
-    create_submission(params.experiment_dir, meta_test, y_pred, logger)
+    create_submission(params.experiment_dir, meta_test, y_pred, logger, labeled)
 
 
 @action.command()
 @click.option('-p', '--pipeline_name', help='pipeline to be trained', required=True)
 @click.option('-v', '--validation_size', help='percentage of training used for validation', default=0.1, required=False)
 def train_evaluate_predict_pipeline(pipeline_name, validation_size):
+    session = _start_session(pipeline_name, validation_size)
     logger.info('training')
-    _train_pipeline(pipeline_name, validation_size)
+    _train_pipeline(pipeline_name, validation_size, session=session)
     logger.info('evaluating')
-    _evaluate_pipeline(pipeline_name, validation_size)
+    _evaluate_pipeline(pipeline_name, validation_size, session=session)
     logger.info('predicting')
-    _predict_pipeline(pipeline_name)
+    _predict_pipeline(pipeline_name, session=session)
+    _end_session(session)
 
 
 @action.command()
 @click.option('-p', '--pipeline_name', help='pipeline to be trained', required=True)
 @click.option('-v', '--validation_size', help='percentage of training used for validation', default=0.1, required=False)
 def train_evaluate_pipeline(pipeline_name, validation_size):
+    session = _start_session(pipeline_name, validation_size)
     logger.info('training')
-    _train_pipeline(pipeline_name, validation_size)
+    _train_pipeline(pipeline_name, validation_size, session=session)
     logger.info('evaluating')
-    _evaluate_pipeline(pipeline_name, validation_size)
+    _evaluate_pipeline(pipeline_name, validation_size, session=session)
+    _end_session(session)
 
 
 @action.command()
 @click.option('-p', '--pipeline_name', help='pipeline to be trained', required=True)
 @click.option('-v', '--validation_size', help='percentage of training used for validation', default=0.1, required=False)
 def evaluate_predict_pipeline(pipeline_name, validation_size):
+    session = _start_session(pipeline_name, validation_size)
     logger.info('evaluating')
-    _evaluate_pipeline(pipeline_name, validation_size)
+    _evaluate_pipeline(pipeline_name, validation_size, session=session)
     logger.info('predicting')
-    _predict_pipeline(pipeline_name)
+    _predict_pipeline(pipeline_name, session=session)
+    _end_session(session)
+
+
+def _init_transformer_registry():
+    from steps.registry import transformer_registry
+
+    params = get_params()
+    transformer_registry.set_budget(params.transformer_registry_mb)
+    return transformer_registry
+
+
+def _start_session(pipeline_name, validation_size):
+    """
+    One session for all phases of a combined command, see `PipelineSession`.
+    """
+    from session import PipelineSession
+
+    params = get_params()
+    return PipelineSession(pipeline_name, get_solution_config(), params.meta_dir, validation_size,
+                           registry=_init_transformer_registry())
+
+
+def _end_session(session):
+    session.report()
+    logger.info('transformer registry {}'.format(session.registry.stats()))
+
+
+@action.command()
+@click.option('-p', '--pipeline_name', help='pipeline to be cross validated', required=True)
+@click.option('-k', '--n_folds', help='number of folds', default=5, required=False)
+@click.option('--cpu_budget', help='cores shared by all folds, all cores by default', default=0, required=False)
+@click.option('--parallel_folds', help='folds trained at the same time, as many as the budget allows by default',
+              default=0, required=False)
+def cross_validate(pipeline_name, n_folds, cpu_budget, parallel_folds):
+    import pandas as pd
+    from cross_validation import cross_validate
+    from preparation import kfold_split
+    from steps.sinks import get_sink
+
+    params = get_params()
+    cpu_budget = cpu_budget or mp.cpu_count()
+    parallel_folds = parallel_folds or min(n_folds, cpu_budget)
+    cv_dirpath = os.path.join(params.experiment_dir, 'cross_validation')
+    if bool(params.overwrite) and os.path.isdir(cv_dirpath):
+        shutil.rmtree(cv_dirpath)
+
+    meta = pd.read_csv(os.path.join(params.meta_dir, 'stage1_metadata.csv'))
+    folds = kfold_split(meta, n_folds)
+    report = cross_validate(pipeline_name, folds, get_solution_config(), cv_dirpath, cpu_budget, parallel_folds)
+
+    for fold in report['folds']:
+        logger.info('fold {fold}: IOUT {iout:.4f} on {images} images'.format(**fold))
+    logger.info('IOUT per fold {0:.4f} +- {1:.4f}, out of fold IOUT {2:.4f}, report saved to {3}'.format(
+        report['fold_iout_mean'], report['fold_iout_std'], report['oof_iout'], cv_dirpath))
+
+    sink = get_sink(**get_solution_config().metrics_sink)
+    sink.send_scalar('CV IOUT Score', 0, report['oof_iout'])
+    sink.flush()
+
+
+@action.command()
+@click.option('-p', '--pipeline_name', help='pipeline to be tuned', required=True)
+@click.option('-s', '--search_space', help='yaml file with the neptune.yaml parameters to search over', required=True)
+@click.option('-n', '--trials', help='number of sampled configurations', default=20, required=False)
+@click.option('-v', '--validation_size', help='percentage of training used for validation', default=0.1, required=False)
+@click.option('--cpu_budget', help='cores shared by all trials, all cores by default', default=0, required=False)
+@click.option('--threads_per_trial', help='cores given to each trial', default=2, required=False)
+@click.option('--memory_budget_mb', help='memory shared by all trials, 0 for no limit', default=0, required=False)
+@click.option('--trial_memory_mb', help='expected peak memory of one trial', default=4096, required=False)
+@click.option('--min_epochs', help='epochs before the first successive halving rung', default=1, required=False)
+@click.option('--reduction_factor', help='only the best 1/reduction_factor trials pass a rung', default=3,
+              required=False)
+def sweep(pipeline_name, search_space, trials, validation_size, cpu_budget, threads_per_trial, memory_budget_mb,
+          trial_memory_mb, min_epochs, reduction_factor):
+    import pandas as pd
+    from preparation import train_valid_split
+    from sweep import load_search_space, sweep
+
+    params = get_params()
+    cpu_budget = cpu_budget or mp.cpu_count()
+    parallel = min(trials, max(1, cpu_budget // threads_per_trial))
+    if memory_budget_mb:
+        parallel = min(parallel, max(1, memory_budget_mb // trial_memory_mb))
+
+    sweep_dirpath = os.path.join(params.experiment_dir, 'sweep')
+    if bool(params.overwrite) and os.path.isdir(sweep_dirpath):
+        shutil.rmtree(sweep_dirpath)
+
+    meta = pd.read_csv(os.path.join(params.meta_dir, 'stage1_metadata.csv'))
+    meta_train_split, meta_valid_split = train_valid_split(meta, validation_size)
+
+    results = sweep(pipeline_name, params, load_search_space(search_space, params), trials,
+                    meta_train_split, meta_valid_split,
+                    sweep_dirpath=sweep_dirpath,
+                    threads=threads_per_trial,
+                    parallel=parallel,
+                    min_epochs=min_epochs,
+                    reduction_factor=reduction_factor)
+
+    logger.info('sweep results saved to {}'.format(os.path.join(sweep_dirpath, 'sweep.db')))
+    for row in results:
+        logger.info('trial {trial_id:>3} {status:<10} epochs {epochs} best val loss {best_val_loss} IOUT {iout} '
+                    '{params}'.format(**row))
+
+
+@action.command()
+@click.option('--host', help='interface to bind', default='127.0.0.1', required=False)
+@click.option('--port', help='port to listen on', default=8000, required=False)
+@click.option('--max_batch_size', help='largest micro-batch sent to the network', default=16, required=False)
+@click.option('--max_wait_ms', help='longest wait for a micro-batch to fill up', default=10, required=False)
+@click.option('--postprocess_workers', help='processes resizing, thresholding and encoding masks', default=4,
+              required=False)
+def serve(host, port, max_batch_size, max_wait_ms, postprocess_workers):
+    from serving import UNetInferenceService
+
+    params = get_params()
+    transformer_filepath = os.path.join(params.experiment_dir, 'transformers', 'unet_network')
+    service = UNetInferenceService(get_solution_config(), transformer_filepath,
+                                   max_batch_size=max_batch_size,
+                                   max_wait=max_wait_ms / 1000.,
+                                   postprocess_workers=postprocess_workers)
+    service.serve(host, port)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,10 @@
 from tqdm import tqdm
 
 import numpy as np
-from sklearn.metrics.pairwise import pairwise_distances
 
-from utils import decompose
+from utils import decompose, probability_threshold
+
+IOU_THRESHOLDS = [0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95]
 
 
 def iou(gt, pred):
@@ -19,9 +20,14 @@ def iou(gt, pred):
     return intersection / union
 
 
-def compute_ious(gt, predictions):
-    gt_ = decompose(gt)
-    predictions_ = decompose(predictions)
+def compute_ious(gt, predictions, labeled=False):
+    """
+    `gt` is an instance label image as read by `read_masks`, `predictions` one too when `labeled`.
+    """
+    from sklearn.metrics.pairwise import pairwise_distances
+
+    gt_ = decompose(gt, labeled=True)
+    predictions_ = decompose(predictions, labeled)
     gt_ = np.asarray([el.flatten() for el in gt_])
     predictions_ = np.asarray([el.flatten() for el in predictions_])
     ious = pairwise_distances(X=gt_, Y=predictions_, metric=iou)
@@ -37,25 +43,93 @@ def compute_precision_at(ious, threshold):
     return float(tp) / (tp + fp + fn)
 
 
-def compute_eval_metric(gt, predictions):
-    thresholds = [0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95]
-    ious = compute_ious(gt, predictions)
-    precisions = [compute_precision_at(ious, th) for th in thresholds]
+def compute_eval_metric(gt, predictions, labeled=False):
+    ious = compute_ious(gt, predictions, labeled)
+    precisions = [compute_precision_at(ious, th) for th in IOU_THRESHOLDS]
     return sum(precisions) / len(precisions)
 
 
-def intersection_over_union(y_true, y_pred):
+def intersection_over_union(y_true, y_pred, labeled=False):
     ious = []
     for y_t, y_p in tqdm(list(zip(y_true, y_pred))):
-        iou = compute_ious(y_t, y_p)
+        iou = compute_ious(y_t, y_p, labeled)
         iou_mean = 1.0 * np.sum(iou) / iou.shape[0]
         ious.append(iou_mean)
 
     return np.mean(ious)
 
 
-def intersection_over_union_thresholds(y_true, y_pred):
+def intersection_over_union_thresholds(y_true, y_pred, labeled=False):
     iouts = []
     for y_t, y_p in tqdm(list(zip(y_true, y_pred))):
-        iouts.append(compute_eval_metric(y_t, y_p))
+        iouts.append(compute_eval_metric(y_t, y_p, labeled))
     return np.mean(iouts)
+
+
+def label_instances(mask, labeled=False):
+    """
+    Instance labels of a mask the way `decompose` sees them, returns (labels, number of instances).
+    """
+    from scipy import ndimage
+
+    if labeled:
+        return mask, int(mask.max())
+    return ndimage.label(mask)
+
+
+def contingency_ious(gt_labels, gt_nr, pred_labels, pred_nr):
+    """
+    IoU matrix of all ground truth and predicted instances from one bincount over label pairs, equal to
+    `compute_ious` including its single all-zero instance for empty masks.
+    """
+    contingency = np.bincount(gt_labels.ravel().astype(np.int64) * (pred_nr + 1) + pred_labels.ravel(),
+                              minlength=(gt_nr + 1) * (pred_nr + 1)).reshape(gt_nr + 1, pred_nr + 1)
+    intersection = contingency[1:, 1:]
+    union = contingency[1:, :].sum(axis=1)[:, None] + contingency[:, 1:].sum(axis=0)[None, :] - intersection
+    ious = intersection / np.maximum(union, 1e-9)
+    return ious if ious.size else np.zeros((max(gt_nr, 1), max(pred_nr, 1)))
+
+
+def threshold_grid_iout(gt, probability, thresholds):
+    """
+    IoUT of `probability > threshold` against `gt` for every threshold. The ground truth is labeled once and
+    so is the prediction, at the lowest threshold, higher thresholds only relabel the components they split.
+    """
+    from scipy import ndimage
+
+    gt_labels, gt_nr = label_instances(gt, labeled=True)
+    cutoffs = [probability_threshold(threshold, probability.dtype) for threshold in thresholds]
+    components, components_nr = ndimage.label(probability > min(cutoffs))
+    index = np.arange(1, components_nr + 1)
+    minima = np.asarray(ndimage.minimum(probability, components, index)).reshape(-1)
+    maxima = np.asarray(ndimage.maximum(probability, components, index)).reshape(-1)
+    slices = ndimage.find_objects(components)
+
+    scores = []
+    for cutoff in cutoffs:
+        pred_labels, pred_nr = refine_labels(components, minima, maxima, slices, probability, cutoff)
+        ious = contingency_ious(gt_labels, gt_nr, pred_labels, pred_nr)
+        scores.append(np.mean([compute_precision_at(ious, iou_threshold) for iou_threshold in IOU_THRESHOLDS]))
+    return scores
+
+
+def refine_labels(components, minima, maxima, slices, probability, cutoff):
+    """
+    Instances of `probability > cutoff` from the components of a lower cutoff: components entirely above
+    `cutoff` keep their pixels, those entirely below it vanish and only the others are labeled again.
+    """
+    from scipy import ndimage
+
+    kept = minima > cutoff
+    lookup = np.zeros(len(minima) + 1, dtype=np.int64)
+    lookup[1:][kept] = np.arange(1, np.count_nonzero(kept) + 1)
+    labels = lookup[components]
+
+    next_label = np.count_nonzero(kept) + 1
+    for i in np.flatnonzero(~kept & (maxima > cutoff)):
+        component_slice = slices[i]
+        mask = (components[component_slice] == i + 1) & (probability[component_slice] > cutoff)
+        sub_labels, sub_nr = ndimage.label(mask)
+        labels[component_slice][mask] = sub_labels[mask] + next_label - 1
+        next_label += sub_nr
+    return labels, next_label - 1
@@ -1,17 +1,20 @@
 import numpy as np
+import torch
 import torch.nn as nn
 import torch.optim as optim
 
 from steps.pytorch.architectures.unet import UNet
 from steps.pytorch.callbacks import CallbackList, TrainingMonitor, ValidationMonitor, ModelCheckpoint, \
-    NeptuneMonitorSegmentation, ExperimentTiming, ExponentialLRScheduler, EarlyStopping
+    NeptuneMonitorSegmentation, ExperimentTiming, ExponentialLRScheduler, EarlyStopping, SuccessiveHalvingPruner
 from steps.pytorch.models import Model, PyTorchBasic
+from steps.pytorch.tta import get_tta_transforms, tta_predict
 from steps.pytorch.validation import segmentation_loss
-from utils import sigmoid
+
+OUTPUT_DTYPES = ['float32', 'float16', 'uint8']
 
 
 class PyTorchUNet(Model):
-    def __init__(self, architecture_config, training_config, callbacks_config):
+    def __init__(self, architecture_config, training_config, callbacks_config, tta_config=None, output_config=None):
         super().__init__(architecture_config, training_config, callbacks_config)
         self.model = UNet(**architecture_config['model_params'])
         self.weight_regularization = weight_regularization_unet
@@ -19,11 +22,21 @@ class PyTorchUNet(Model):
                                     **architecture_config['optimizer_params'])
         self.loss_function = segmentation_loss
         self.callbacks = build_callbacks(self.callbacks_config)
+        self.tta_transforms = get_tta_transforms((tta_config or {}).get('transforms', []))
+        self.output_dtype = (output_config or {}).get('dtype', 'float32')
+        if self.output_dtype not in OUTPUT_DTYPES:
+            raise ValueError('output dtype must be one of {}, got {}'.format(OUTPUT_DTYPES, self.output_dtype))
+
+    def _predict_batch(self, X):
+        if self.tta_transforms:
+            return tta_predict(self.model, X, self.tta_transforms)
+        return self.model(X)
+
+    def _batch_output(self, output):
+        return quantize_probability(torch.sigmoid(output.data[:, 0]), self.output_dtype)
 
     def transform(self, datagen, validation_datagen=None):
-        prediction_proba = self._transform(datagen, validation_datagen)
-        prediction_proba_ = [sigmoid(np.squeeze(mask)) for mask in prediction_proba]
-        return {'predicted_masks': np.array(prediction_proba_)}
+        return {'predicted_masks': self._transform(datagen, validation_datagen)}
 
 
 class SequentialConvNet(Model):
@@ -109,7 +122,19 @@ def build_callbacks(callbacks_config):
     validation_monitor = ValidationMonitor(**callbacks_config['validation_monitor'])
     neptune_monitor = NeptuneMonitorSegmentation(**callbacks_config['neptune_monitor'])
     early_stopping = EarlyStopping(**callbacks_config['early_stopping'])
-
-    return CallbackList(
-        callbacks=[experiment_timing, model_checkpoints, lr_scheduler, training_monitor, validation_monitor,
-                   neptune_monitor, early_stopping])
+    callbacks = [experiment_timing, model_checkpoints, lr_scheduler, training_monitor, validation_monitor,
+                 neptune_monitor, early_stopping]
+    if callbacks_config.get('pruner'):
+        callbacks.append(SuccessiveHalvingPruner(**callbacks_config['pruner']))
+
+    return CallbackList(callbacks=callbacks)
+
+
+def quantize_probability(probability, dtype):
+    """
+    Moves a batch of probabilities to the host as float32, float16 or uint8 on the 0-255 scale,
+    uint8 is quantized on the device so only a quarter of the bytes are copied.
+    """
+    if dtype == 'uint8':
+        return probability.mul(255).round().byte().cpu().numpy()
+    return probability.cpu().numpy().astype(dtype)
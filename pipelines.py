@@ -1,10 +1,11 @@
 """
 Implement trainable ensemble: XGBoost, random forest, Linear Regression
 """
+from functools import partial
 
 from steps.base import Step, Dummy
 from steps.preprocessing import XYSplit
-from postprocessing import Resizer, Thresholder
+from postprocessing import Resizer, Thresholder, InstanceSeparator
 from loaders import MetadataImageSegmentationLoader
 from models import SequentialConvNet, PyTorchUNet
 from utils import squeeze_inputs
@@ -40,7 +41,7 @@ def seq_conv_train(config):
                         cache_dirpath=config.env.cache_dirpath)
 
     sequential_convnet = Step(name='sequential_convnet',
-                              transformer=SequentialConvNet(**config.sequential_convnet),
+                              transformer=partial(SequentialConvNet, **config.sequential_convnet),
                               input_steps=[loader_train],
                               cache_dirpath=config.env.cache_dirpath)
 
@@ -89,7 +90,7 @@ def seq_conv_inference(config):
                             cache_dirpath=config.env.cache_dirpath)
 
     sequential_convnet = Step(name='sequential_convnet',
-                              transformer=SequentialConvNet(**config.sequential_convnet),
+                              transformer=partial(SequentialConvNet, **config.sequential_convnet),
                               input_steps=[loader_inference],
                               cache_dirpath=config.env.cache_dirpath)
 
@@ -153,7 +154,7 @@ def unet_train(config):
                         cache_dirpath=config.env.cache_dirpath)
 
     unet_network = Step(name='unet_network',
-                        transformer=PyTorchUNet(**config.unet_network),
+                        transformer=partial(PyTorchUNet, **config.unet_network),
                         input_steps=[loader_train],
                         cache_dirpath=config.env.cache_dirpath)
 
@@ -202,7 +203,7 @@ def unet_inference(config):
                             cache_dirpath=config.env.cache_dirpath)
 
     unet_network = Step(name='unet_network',
-                        transformer=PyTorchUNet(**config.unet_network),
+                        transformer=partial(PyTorchUNet, **config.unet_network),
                         input_steps=[loader_inference],
                         cache_dirpath=config.env.cache_dirpath)
 
@@ -231,8 +232,38 @@ def unet_inference(config):
     return output
 
 
+def unet_watershed_train(config):
+    output = unet_train(config)
+    return _instance_separation(output.get_step('thresholding'), config)
+
+
+def unet_watershed_inference(config):
+    output = unet_inference(config)
+    return _instance_separation(output.get_step('thresholding'), config)
+
+
+def _instance_separation(thresholding, config):
+    instance_separation = Step(name='instance_separation',
+                               transformer=InstanceSeparator(**config.instance_separator),
+                               input_steps=[thresholding],
+                               adapter={'images': ([('thresholding', 'binarized_images')]),
+                                        },
+                               cache_dirpath=config.env.cache_dirpath)
+
+    output = Step(name='instance_output',
+                  transformer=Dummy(),
+                  input_steps=[instance_separation],
+                  adapter={'y_pred': ([('instance_separation', 'labeled_images')]),
+                           'labeled': ([('instance_separation', 'labeled')]),
+                           },
+                  cache_dirpath=config.env.cache_dirpath)
+    return output
+
+
 PIPELINES = {'hello_dsb': {'train': seq_conv_train,
                            'inference': seq_conv_inference},
              'unet': {'train': unet_train,
                       'inference': unet_inference},
+             'unet_watershed': {'train': unet_watershed_train,
+                                'inference': unet_watershed_inference},
              }
@@ -1,16 +1,20 @@
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import numpy as np
+from scipy import ndimage
 from sklearn.externals import joblib
+from skimage.feature import peak_local_max
+from skimage.morphology import watershed
 from skimage.transform import resize
 
 from steps.base import BaseTransformer
+from utils import probability_threshold
 
 class Resizer(BaseTransformer):
     def transform(self, images, target_sizes):
         resized_images = []
         for i, (image, target_size) in enumerate(tqdm(zip(images, target_sizes))):
-            resized_image = resize(image, target_size)
+            resized_image = resize_image(image, target_size)
             resized_images.append(resized_image)
         return {'resized_images': resized_images}
 
@@ -21,6 +25,17 @@ class Resizer(BaseTransformer):
         joblib.dump({}, filepath)
 
 
+def resize_image(image, target_size):
+    """
+    Resizes keeping the dtype of the image, uint8 probabilities stay on the 0-255 scale.
+    """
+    resized = resize(image.astype(np.float32) if image.dtype == np.float16 else image, target_size,
+                     preserve_range=True)
+    if image.dtype == np.uint8:
+        resized = np.round(resized)
+    return resized.astype(image.dtype)
+
+
 class Thresholder(BaseTransformer):
     def __init__(self, threshold):
         self.threshold = threshold
@@ -28,7 +43,7 @@ class Thresholder(BaseTransformer):
     def transform(self, images):
         binarized_images = []
         for i, image in enumerate(images):
-            binarized_image = (image > self.threshold).astype(np.uint8)
+            binarized_image = (image > probability_threshold(self.threshold, image.dtype)).astype(np.uint8)
             binarized_images.append(binarized_image)
 
         return {'binarized_images': binarized_images}
@@ -38,3 +53,47 @@ class Thresholder(BaseTransformer):
 
     def save(self, filepath):
         joblib.dump({}, filepath)
+
+
+class InstanceSeparator(BaseTransformer):
+    def __init__(self, min_distance, n_jobs=-1):
+        self.min_distance = min_distance
+        self.n_jobs = n_jobs
+
+    def transform(self, images):
+        labeled_images = joblib.Parallel(n_jobs=self.n_jobs)(
+            joblib.delayed(separate_instances)(image, self.min_distance) for image in images)
+        return {'labeled_images': labeled_images, 'labeled': True}
+
+    def load(self, filepath):
+        return self
+
+    def save(self, filepath):
+        joblib.dump({}, filepath)
+
+
+def separate_instances(mask, min_distance):
+    """
+    Splits touching nuclei of a binary mask with a distance transform marker watershed.
+    Every connected component is processed separately inside its bounding box.
+    Returns an int32 label image, 0 is background.
+    """
+    components, _ = ndimage.label(mask)
+    labeled = np.zeros(mask.shape, dtype=np.int32)
+    next_label = 1
+    for component_id, component_slice in enumerate(ndimage.find_objects(components), start=1):
+        if component_slice is None:
+            continue
+        component = components[component_slice] == component_id
+        distance = ndimage.distance_transform_edt(np.pad(component, 1, mode='constant'))[1:-1, 1:-1]
+        peaks = peak_local_max(distance, min_distance=min_distance, labels=component.astype(np.int32),
+                               exclude_border=False, indices=False)
+        markers, markers_nr = ndimage.label(peaks)
+        if markers_nr <= 1:
+            labeled[component_slice][component] = next_label
+            next_label += 1
+            continue
+        instances = watershed(-distance, markers, mask=component)
+        labeled[component_slice][component] = instances[component] + next_label - 1
+        next_label += markers_nr
+    return labeled
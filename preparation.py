@@ -1,11 +1,8 @@
 import os
 import glob
-import matplotlib.pyplot as plt
 
 from tqdm import tqdm
 import numpy as np
-import pandas as pd
-from sklearn.model_selection import train_test_split
 
 from utils import get_logger
 
@@ -13,18 +10,44 @@ logger = get_logger()
 
 
 def train_valid_split(meta, validation_size):
+    from sklearn.model_selection import train_test_split
+
     meta_train = meta[meta['is_train'] == 1]
     meta_train_split, meta_valid_split = train_test_split(meta_train, test_size=validation_size, random_state=1234)
     return meta_train_split, meta_valid_split
 
 
+def kfold_split(meta, n_folds):
+    from sklearn.model_selection import KFold
+
+    meta_train = meta[meta['is_train'] == 1]
+    folds = KFold(n_splits=n_folds, shuffle=True, random_state=1234)
+    return [(meta_train.iloc[train_index], meta_train.iloc[valid_index])
+            for train_index, valid_index in folds.split(meta_train)]
+
+
 def overlay_masks(images_dir, subdir_name, target_dir):
+    """
+    Writes two single channel PNGs per image: `<image_id>_labels.png`, a uint16 instance label map
+    with 0 as background, and `<image_id>.png`, the 0/255 binary mask the loader trains on.
+    """
+    from PIL import Image
+
     train_dir = os.path.join(images_dir, subdir_name)
     for mask_dirname in tqdm(glob.glob('{}/*/masks'.format(train_dir))):
-        masks = []
-        for image_filepath in glob.glob('{}/*'.format(mask_dirname)):
-            masks.append(plt.imread(image_filepath))
-        overlayed_masks = np.sum(masks, axis=0)
+        labels = None
+        for i, image_filepath in enumerate(sorted(glob.glob('{}/*'.format(mask_dirname)))):
+            mask = np.array(Image.open(image_filepath).convert('L')) > 0
+            if labels is None:
+                labels = np.zeros(mask.shape, dtype=np.uint16)
+            labels[mask] = i + 1
+        if labels is None:
+            continue
         target_filepath = '/'.join(mask_dirname.replace(images_dir, target_dir).split('/')[:-1]) + '.png'
         os.makedirs(os.path.dirname(target_filepath), exist_ok=True)
-        plt.imsave(target_filepath, overlayed_masks)
+        Image.fromarray((labels > 0).astype(np.uint8) * 255).save(target_filepath)
+        Image.fromarray(labels).save(labels_filepath(target_filepath))
+
+
+def labels_filepath(mask_filepath):
+    return mask_filepath[:-len('.png')] + '_labels.png'
@@ -0,0 +1,162 @@
+import asyncio
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from copy import deepcopy
+
+import torch
+from PIL import Image
+
+from loaders import MetadataImageSegmentationLoader, normalize_images
+from models import PyTorchUNet
+from postprocessing import Thresholder, resize_image
+from steps.pytorch.utils import no_grad, inference_variable
+from utils import get_logger, decompose, run_length_encoding
+
+logger = get_logger()
+
+
+class MicroBatcher:
+    """
+    Gathers concurrent requests into batches of at most `max_batch_size`, waiting at most `max_wait`
+    seconds after the first request of a batch, and runs `predict_batch` on them in `executor`.
+    """
+
+    def __init__(self, predict_batch, max_batch_size, max_wait, executor):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.executor = executor
+        self.queue = asyncio.Queue()
+
+    async def predict(self, item):
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            items = [item for item, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.predict_batch, items)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+class UNetInferenceService:
+    def __init__(self, config, transformer_filepath, max_batch_size, max_wait, postprocess_workers):
+        config = deepcopy(config)
+        # callbacks are only used for training, keep the serving process away from the tracking backend
+        config['unet_network']['callbacks_config']['neptune_monitor']['sink'] = {'backend': 'null'}
+        loader = MetadataImageSegmentationLoader(**config.loader)
+        self.image_transform = loader.image_transform
+        self.uint8_transport = loader.uint8_transport
+        self.threshold = config.thresholder.threshold
+        self.model = PyTorchUNet(**config.unet_network).load(transformer_filepath)
+
+        self.decode_executor = ThreadPoolExecutor(max_workers=postprocess_workers)
+        self.model_executor = ThreadPoolExecutor(max_workers=1)
+        self.postprocess_executor = ProcessPoolExecutor(max_workers=postprocess_workers)
+        self.batcher = MicroBatcher(self.predict_batch, max_batch_size, max_wait, self.model_executor)
+
+    def decode(self, payload):
+        image = Image.open(io.BytesIO(payload)).convert('RGB')
+        return self.image_transform(image), (image.size[1], image.size[0])
+
+    def predict_batch(self, tensors):
+        X = torch.stack(tensors)
+        if self.uint8_transport:
+            X = normalize_images(X)
+        with no_grad():
+            if torch.cuda.is_available():
+                X = X.cuda()
+            output = self.model._predict_batch(inference_variable(X))
+        return list(self.model._batch_output(output))
+
+    async def predict(self, payload):
+        loop = asyncio.get_event_loop()
+        tensor, target_size = await loop.run_in_executor(self.decode_executor, self.decode, payload)
+        probability = await self.batcher.predict(tensor)
+        masks = await loop.run_in_executor(self.postprocess_executor, postprocess, probability, target_size,
+                                           self.threshold)
+        return {'height': target_size[0], 'width': target_size[1], 'masks': masks}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, response = await self.route(method, path, body)
+                payload = json.dumps(response).encode()
+                writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+                    status, len(payload)).encode('latin-1') + payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return '200 OK', {'status': 'ok'}
+        if method == 'POST' and path == '/predict':
+            try:
+                return '200 OK', await self.predict(body)
+            except Exception as e:
+                logger.exception('prediction failed')
+                return '500 Internal Server Error', {'error': str(e)}
+        return '404 Not Found', {'error': 'unknown route {} {}'.format(method, path)}
+
+    def serve(self, host, port):
+        loop = asyncio.get_event_loop()
+        server = loop.run_until_complete(asyncio.start_server(self.handle_connection, host, port))
+        batcher = loop.create_task(self.batcher.run())
+        logger.info('serving on http://{}:{}/predict'.format(host, port))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            batcher.cancel()
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            self.postprocess_executor.shutdown()
+
+
+def postprocess(probability, target_size, threshold):
+    resized = resize_image(probability, target_size)
+    binarized = Thresholder(threshold).transform([resized])['binarized_images'][0]
+    if not binarized.any():
+        return []
+    return [' '.join(str(rle) for rle in run_length_encoding(mask > 128.)) for mask in decompose(binarized)]
@@ -0,0 +1,103 @@
+import os
+import time
+from collections import Counter
+
+from pipeline_config import LABEL_COLUMNS
+from utils import get_logger
+
+logger = get_logger()
+
+
+class PipelineSession:
+    """
+    State shared by the train, evaluate and predict phases run in one process: the metadata, the
+    train/validation split and the inference pipeline, whose steps keep their loaded transformers, are
+    built once and reused by every later phase. Every reuse adds the time the value took to build to
+    `saved_seconds`, weights reused through `registry` are counted too.
+    """
+
+    def __init__(self, pipeline_name, config, meta_dir, validation_size=None, registry=None):
+        self.pipeline_name = pipeline_name
+        self.config = config
+        self.meta_dir = meta_dir
+        self.validation_size = validation_size
+        self.registry = registry
+        self._registry_saved_seconds = registry.saved_seconds if registry is not None else 0.
+        self.saved_seconds = 0.
+        self.reuses = Counter()
+        self._values = {}
+
+    def _shared(self, name, build):
+        if name in self._values:
+            value, build_seconds = self._values[name]
+            self.saved_seconds += build_seconds
+            self.reuses[name] += 1
+            return value
+        return self._value(name, build)
+
+    def _value(self, name, build):
+        """
+        Built on first use like `_shared`, used by the session itself so that its own accesses are not counted.
+        """
+        if name not in self._values:
+            start = time.time()
+            value = build()
+            self._values[name] = (value, time.time() - start)
+        return self._values[name][0]
+
+    def _read_meta(self):
+        import pandas as pd
+
+        return pd.read_csv(os.path.join(self.meta_dir, 'stage1_metadata.csv'))
+
+    @property
+    def meta(self):
+        return self._shared('meta', self._read_meta)
+
+    @property
+    def meta_test(self):
+        meta = self._shared('meta', self._read_meta)
+        return meta[meta['is_train'] == 0]
+
+    def _split(self):
+        from preparation import train_valid_split
+
+        return train_valid_split(self._value('meta', self._read_meta), self.validation_size)
+
+    @property
+    def train_valid_split(self):
+        # metadata read first so that its time is not counted again in the split's
+        self._value('meta', self._read_meta)
+        return self._shared('train_valid_split', self._split)
+
+    @property
+    def y_true(self):
+        """
+        Read on every access, the evaluation needs it once.
+        """
+        from utils import read_masks
+
+        self._value('meta', self._read_meta)
+        _, meta_valid_split = self._value('train_valid_split', self._split)
+        return read_masks(meta_valid_split[LABEL_COLUMNS].values)
+
+    def train_pipeline(self):
+        from pipelines import PIPELINES
+
+        return PIPELINES[self.pipeline_name]['train'](self.config)
+
+    def inference_pipeline(self):
+        """
+        Built on first use, after training wrote the transformers it loads.
+        """
+        from pipelines import PIPELINES
+
+        return self._shared('inference_pipeline', lambda: PIPELINES[self.pipeline_name]['inference'](self.config))
+
+    def report(self):
+        saved_seconds = self.saved_seconds
+        if self.registry is not None:
+            saved_seconds += self.registry.saved_seconds - self._registry_saved_seconds
+        logger.info('session reused {0}, about {1:.1f}s saved compared with running the phases separately'.format(
+            dict(self.reuses), saved_seconds))
+        return saved_seconds
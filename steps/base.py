@@ -1,10 +1,13 @@
 import os
 import pprint
+from functools import partial
 
 import numpy as np
 from scipy import sparse
 from sklearn.externals import joblib
 
+from steps.profiler import profiler
+from steps.registry import transformer_registry
 from steps.utils import view_graph, plot_graph
 from utils import get_logger
 
@@ -13,13 +16,14 @@ logger = get_logger()
 
 class Step:
     def __init__(self, name, transformer, input_steps=[], input_data=[], adapter=None, cache_dirpath=None,
-                 cache_output=False, overwrite_transformer=False, save_graph=False):
+                 cache_output=False, overwrite_transformer=False, save_graph=False, lazy_inputs=False):
         self.name = name
-        self.transformer = transformer
+        self._transformer = transformer
 
         self.input_steps = input_steps
         self.input_data = input_data
         self.adapter = adapter
+        self.lazy_inputs = lazy_inputs
 
         self.overwrite_transformer = overwrite_transformer
         self.cache_output = cache_output
@@ -42,6 +46,21 @@ class Step:
         self.cache_filepath_step_transformer = os.path.join(self.cache_dirpath_transformers, self.name)
         self.save_filepath_step_output = os.path.join(self.save_dirpath_outputs, '{}'.format(self.name))
 
+    @property
+    def transformer(self):
+        """
+        The transformer, built on first use when the step was given a factory such as
+        `partial(PyTorchUNet, **config.unet_network)`, so steps whose outputs are cached never build it.
+        """
+        if not isinstance(self._transformer, BaseTransformer):
+            logger.info('step {} building transformer...'.format(self.name))
+            self._transformer = self._transformer()
+        return self._transformer
+
+    @transformer.setter
+    def transformer(self, transformer):
+        self._transformer = transformer
+
     @property
     def named_steps(self):
         return {step.name: step for step in self.input_steps}
@@ -60,7 +79,8 @@ class Step:
     def fit_transform(self, data):
         if self.output_is_cached and self.cache_output and not self.overwrite_transformer:
             logger.info('step {} loading output...'.format(self.name))
-            step_output_data = self._load_output()
+            with profiler.section(self.name, 'step'):
+                step_output_data = self._load_output()
         else:
             step_inputs = {}
             if self.input_data is not None:
@@ -68,19 +88,20 @@ class Step:
                     step_inputs[input_data_part] = data[input_data_part]
 
             for input_step in self.input_steps:
-                step_inputs[input_step.name] = input_step.fit_transform(data)
+                step_inputs[input_step.name] = self._input_step_output(input_step, data)
 
-            if self.adapter:
-                step_inputs = self.adapt(step_inputs)
-            else:
-                step_inputs = self.unpack(step_inputs)
-            step_output_data = self._cached_fit_transform(step_inputs)
+            with profiler.section(self.name, 'step'):
+                if self.adapter:
+                    step_inputs = self.adapt(step_inputs)
+                else:
+                    step_inputs = self.unpack(step_inputs)
+                step_output_data = self._cached_fit_transform(step_inputs)
         return step_output_data
 
     def _cached_fit_transform(self, step_inputs):
         if self.transformer_is_cached and not self.overwrite_transformer:
             logger.info('step {} loading transformer...'.format(self.name))
-            self.transformer.load(self.cache_filepath_step_transformer)
+            transformer_registry.load(self.transformer, self.cache_filepath_step_transformer)
             logger.info('step {} transforming...'.format(self.name))
             step_output_data = self.transformer.transform(**step_inputs)
             if self.cache_output:
@@ -105,7 +126,8 @@ class Step:
     def transform(self, data):
         if self.output_is_cached and self.cache_output:
             logger.info('step {} loading output...'.format(self.name))
-            step_output_data = self._load_output()
+            with profiler.section(self.name, 'step'):
+                step_output_data = self._load_output()
         else:
             step_inputs = {}
             if self.input_data is not None:
@@ -113,19 +135,20 @@ class Step:
                     step_inputs[input_data_part] = data[input_data_part]
 
             for input_step in self.input_steps:
-                step_inputs[input_step.name] = input_step.fit_transform(data)
+                step_inputs[input_step.name] = self._input_step_output(input_step, data)
 
-            if self.adapter:
-                step_inputs = self.adapt(step_inputs)
-            else:
-                step_inputs = self.unpack(step_inputs)
-            step_output_data = self._cached_transform(step_inputs)
+            with profiler.section(self.name, 'step'):
+                if self.adapter:
+                    step_inputs = self.adapt(step_inputs)
+                else:
+                    step_inputs = self.unpack(step_inputs)
+                step_output_data = self._cached_transform(step_inputs)
         return step_output_data
 
     def _cached_transform(self, step_inputs):
         if self.transformer_is_cached:
             logger.info('step {} loading transformer...'.format(self.name))
-            self.transformer.load(self.cache_filepath_step_transformer)
+            transformer_registry.load(self.transformer, self.cache_filepath_step_transformer)
             logger.info('step {} transforming...'.format(self.name))
             step_output_data = self.transformer.transform(**step_inputs)
             if self.cache_output:
@@ -135,6 +158,11 @@ class Step:
             raise ValueError('No transformer cached {}'.format(self.name))
         return step_output_data
 
+    def _input_step_output(self, input_step, data):
+        if self.lazy_inputs:
+            return LazyStepOutput(input_step, data)
+        return input_step.fit_transform(data)
+
     def adapt(self, step_inputs):
         logger.info('step {} adapting inputs'.format(self.name))
         adapted_steps = {}
@@ -149,12 +177,17 @@ class Step:
                     func = identity_inputs
                 else:
                     raise ValueError('wrong mapping specified')
+                if self.lazy_inputs and func not in LAZY_ADAPTERS:
+                    raise ValueError('step {0} has lazy inputs, {1} cannot adapt {2}, use to_tuple_inputs'.format(
+                        self.name, func.__name__, adapted_name))
 
                 raw_inputs = [step_inputs[step_name][step_var] for step_name, step_var in step_mapping]
                 adapted_steps[adapted_name] = func(raw_inputs)
         return adapted_steps
 
     def unpack(self, step_inputs):
+        if self.lazy_inputs:
+            raise ValueError('step {} has lazy inputs, they need an adapter'.format(self.name))
         logger.info('step {} unpacking inputs'.format(self.name))
         unpacked_steps = {}
         for step_name, step_dict in step_inputs.items():
@@ -202,7 +235,30 @@ class Step:
         return view_graph(self.graph_info)
 
 
+class LazyStepOutput:
+    """
+    Stands in for the output of an input step of a step with `lazy_inputs`.
+    Adapted values are callables which run the input step only when the transformer calls them,
+    so the transformer can consume input steps one at a time. Only adapter functions that pass the
+    callables through are accepted: `identity_inputs` for a single input and `to_tuple_inputs` for
+    several, e.g. `{'prediction_proba_list': ([('unet_1', 'y'), ('unet_2', 'y')], to_tuple_inputs)}`.
+    """
+
+    def __init__(self, step, data):
+        self.step = step
+        self.data = data
+
+    def __getitem__(self, key):
+        return partial(_step_output, self.step, self.data, key)
+
+
+def _step_output(step, data, key):
+    return step.fit_transform(data)[key]
+
+
 class BaseTransformer:
+    registry_cacheable = False
+
     def fit(self, *args, **kwargs):
         return self
 
@@ -286,3 +342,6 @@ def average_inputs(inputs):
 
 def exp_transform(inputs):
     return np.exp(inputs[0])
+
+
+LAZY_ADAPTERS = (identity_inputs, to_tuple_inputs)
@@ -18,18 +18,65 @@ class ClassPredictor(BaseTransformer):
 
 
 class PredictionAverage(BaseTransformer):
-    def __init__(self, weights=None):
+    """
+    Weighted sum (or plain mean without weights) of the predictions of several models, computed as a running
+    float32 sum so that only one model's predictions have to be in memory next to the accumulator.
+    Inputs are never modified.
+
+    `prediction_proba_list` holds one entry per model, either a stacked array or a sequence. An entry can be
+    an array, a callable returning the predictions (see `Step(lazy_inputs=True)`, adapted with
+    `to_tuple_inputs`) or an iterable of per-batch arrays, in which case a list of averaged batches is returned.
+    """
+
+    def __init__(self, weights=None, chunk_size=64):
         self.weights = weights
+        self.chunk_size = chunk_size
 
     def transform(self, prediction_proba_list):
         if self.weights is not None:
-            reshaped_weights = self._reshape_weights(prediction_proba_list.shape)
-            prediction_proba_list *= reshaped_weights
-            avg_pred = np.sum(prediction_proba_list, axis=0)
+            weights = self.weights
         else:
-            avg_pred = np.mean(prediction_proba_list, axis=0)
+            weights = [1.0] * len(prediction_proba_list)
+
+        avg_pred = None
+        for weight, prediction in zip(weights, prediction_proba_list):
+            if callable(prediction):
+                prediction = prediction()
+            avg_pred = self._accumulate(avg_pred, prediction, weight)
+            del prediction
+
+        if self.weights is None:
+            avg_pred = self._scale(avg_pred, 1.0 / len(prediction_proba_list))
         return {'prediction_probability': avg_pred}
 
+    def _accumulate(self, accumulator, prediction, weight):
+        if isinstance(prediction, np.ndarray):
+            if accumulator is None:
+                return self._scale(prediction.astype(np.float32), weight)
+            self._add_weighted(accumulator, prediction, weight)
+            return accumulator
+
+        if accumulator is None:
+            return [self._scale(batch.astype(np.float32), weight) for batch in prediction]
+        for accumulator_batch, batch in zip(accumulator, prediction):
+            self._add_weighted(accumulator_batch, batch, weight)
+        return accumulator
+
+    def _add_weighted(self, accumulator, prediction, weight):
+        weight = np.float32(weight)
+        for start in range(0, len(prediction), self.chunk_size):
+            accumulator[start:start + self.chunk_size] += weight * prediction[start:start + self.chunk_size]
+
+    def _scale(self, accumulator, factor):
+        if factor == 1.0:
+            return accumulator
+        if isinstance(accumulator, list):
+            for batch in accumulator:
+                batch *= np.float32(factor)
+        else:
+            accumulator *= np.float32(factor)
+        return accumulator
+
     def load(self, filepath):
         params = joblib.load(filepath)
         self.weights = params['weights']
@@ -38,18 +85,10 @@ class PredictionAverage(BaseTransformer):
     def save(self, filepath):
         joblib.dump({'weights': self.weights}, filepath)
 
-    def _reshape_weights(self, prediction_shape):
-        dim = len(prediction_shape)
-        reshape_dim = (-1,) + tuple([1] * (dim - 1))
-        reshaped_weights = np.array(self.weights).reshape(reshape_dim)
-        return reshaped_weights
-
 
 class PredictionAverageUnstack(BaseTransformer):
     def transform(self, prediction_probability, id_list):
-        df = pd.DataFrame(prediction_probability)
-        df['id'] = id_list
-        avg_pred = df.groupby('id').mean().reset_index().drop(['id'], axis=1).values
+        avg_pred = group_mean(np.asarray(prediction_probability), id_list)
         return {'prediction_probability': avg_pred}
 
     def load(self, filepath):
@@ -75,3 +114,23 @@ class ProbabilityCalibration(BaseTransformer):
 
     def save(self, filepath):
         joblib.dump({}, filepath)
+
+
+def group_mean(values, ids):
+    """
+    Mean of the rows of an N-dimensional `values` array per id, groups ordered by sorted id as in
+    pandas groupby. Contiguous ids are reduced with a single reduceat, other layouts with add.at.
+    """
+    codes, uniques = pd.factorize(np.asarray(ids), sort=True)
+    if np.any(codes < 0):
+        # missing ids are dropped, as groupby does
+        values, codes = values[codes >= 0], codes[codes >= 0]
+
+    counts = np.bincount(codes, minlength=len(uniques))
+    if np.all(codes[1:] >= codes[:-1]):
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.add.reduceat(values, starts, axis=0, dtype=np.float64)
+    else:
+        sums = np.zeros((len(uniques),) + values.shape[1:], dtype=np.float64)
+        np.add.at(sums, codes, values)
+    return sums / counts.reshape((-1,) + (1,) * (values.ndim - 1))
@@ -0,0 +1,133 @@
+import glob
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+from .utils import get_logger
+
+logger = get_logger()
+
+
+class Profiler:
+    """
+    Opt-in wall clock profiler. Sections are recorded as chrome trace events, processes other than
+    the one that enabled profiling (DataLoader workers) append their events to per-process files
+    in the profile directory so that decode and collation show up in the same report.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.dirpath = None
+        self.owner_pid = None
+        self.events = []
+        self.lock = threading.Lock()
+
+    def enable(self, dirpath):
+        self.enabled = True
+        self.dirpath = dirpath
+        self.owner_pid = os.getpid()
+        self.events = []
+        # worker files left by an earlier run would otherwise be merged into this run's report
+        for filepath in self._worker_filepaths():
+            os.remove(filepath)
+
+    def disable(self):
+        self.enabled = False
+
+    @contextmanager
+    def section(self, name, category):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, category, start, time.time() - start)
+
+    def iterate(self, iterable, name, category):
+        """
+        Yields from `iterable` recording the time spent waiting for every element.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                element = next(iterator)
+            except StopIteration:
+                return
+            if self.enabled:
+                self.record(name, category, start, time.time() - start)
+            yield element
+
+    def record(self, name, category, start, duration):
+        event = {'name': name, 'cat': category, 'ph': 'X',
+                 'ts': start * 1e6, 'dur': duration * 1e6,
+                 'pid': os.getpid(), 'tid': threading.get_ident()}
+        if os.getpid() == self.owner_pid:
+            with self.lock:
+                self.events.append(event)
+        else:
+            self._append_worker_event(event)
+
+    def _append_worker_event(self, event):
+        filepath = os.path.join(self.dirpath, 'events-{}.jsonl'.format(os.getpid()))
+        try:
+            f = open(filepath, 'a')
+        except FileNotFoundError:
+            os.makedirs(self.dirpath, exist_ok=True)
+            f = open(filepath, 'a')
+        with f:
+            f.write(json.dumps(event) + '\n')
+
+    def _worker_filepaths(self):
+        return glob.glob(os.path.join(self.dirpath, 'events-*.jsonl'))
+
+    def collect_events(self):
+        events = list(self.events)
+        for filepath in self._worker_filepaths():
+            with open(filepath) as f:
+                events.extend(json.loads(line) for line in f if line.strip())
+        return events
+
+    def summary(self, events):
+        durations = defaultdict(list)
+        for event in events:
+            durations[(event['cat'], event['name'])].append(event['dur'] / 1e3)
+
+        summary = []
+        for (category, name), values in sorted(durations.items()):
+            values = np.array(values)
+            summary.append({'category': category, 'name': name, 'count': len(values),
+                            'total_ms': float(values.sum()), 'mean_ms': float(values.mean()),
+                            'p50_ms': float(np.percentile(values, 50)), 'p90_ms': float(np.percentile(values, 90)),
+                            'p99_ms': float(np.percentile(values, 99)), 'max_ms': float(values.max())})
+        return summary
+
+    def report(self):
+        if not self.enabled:
+            return
+        os.makedirs(self.dirpath, exist_ok=True)
+        events = self.collect_events()
+        summary = self.summary(events)
+
+        with open(os.path.join(self.dirpath, 'trace.json'), 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        with open(os.path.join(self.dirpath, 'report.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+
+        header = '{:<10} {:<45} {:>8} {:>12} {:>10} {:>10} {:>10} {:>10}'.format(
+            'category', 'name', 'count', 'total_ms', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms')
+        lines = [header] + ['{category:<10} {name:<45} {count:>8} {total_ms:>12.1f} {mean_ms:>10.2f} '
+                            '{p50_ms:>10.2f} {p90_ms:>10.2f} {p99_ms:>10.2f}'.format(**row) for row in summary]
+        with open(os.path.join(self.dirpath, 'report.txt'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        logger.info('profile report saved to {}\n\n{}'.format(self.dirpath, '\n'.join(lines)))
+
+
+profiler = Profiler()
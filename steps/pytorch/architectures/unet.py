@@ -1,23 +1,29 @@
 import torch
 import torch.nn as nn
 
+from ..utils import autograd_enabled, inference_variable
+
 
 class UNet(nn.Module):
     def __init__(self, conv_kernel,
                  pool_kernel, pool_stride,
                  repeat_blocks, n_filters,
                  batch_norm, dropout,
-                 in_channels):
+                 in_channels, activation_checkpointing=False,
+                 separable_convs=False, bilinear_upsampling=False, width_multiplier=1.0):
         super(UNet, self).__init__()
 
         self.conv_kernel = conv_kernel
         self.pool_kernel = pool_kernel
         self.pool_stride = pool_stride
         self.repeat_blocks = repeat_blocks
-        self.n_filters = n_filters
+        self.n_filters = max(1, int(round(n_filters * width_multiplier)))
         self.batch_norm = batch_norm
         self.dropout = dropout
         self.in_channels = in_channels
+        self.activation_checkpointing = activation_checkpointing
+        self.separable_convs = separable_convs
+        self.bilinear_upsampling = bilinear_upsampling
 
         self.input_block = self._input_block()
         self.down_convs = self._down_convs()
@@ -31,14 +37,18 @@ class UNet(nn.Module):
         down_convs = []
         for i in range(self.repeat_blocks):
             in_channels = int(self.n_filters * 2 ** i)
-            down_convs.append(DownConv(in_channels, self.conv_kernel, self.batch_norm, self.dropout))
+            down_convs.append(DownConv(in_channels, self.conv_kernel, self.batch_norm, self.dropout,
+                                       checkpoint_activations=self.activation_checkpointing,
+                                       separable_convs=self.separable_convs))
         return nn.ModuleList(down_convs)
 
     def _up_convs(self):
         up_convs = []
         for i in range(self.repeat_blocks):
             in_channels = int(self.n_filters * 2 ** (i + 2))
-            up_convs.append(UpConv(in_channels, self.conv_kernel, self.batch_norm, self.dropout))
+            up_convs.append(UpConv(in_channels, self.conv_kernel, self.batch_norm, self.dropout,
+                                   checkpoint_activations=self.activation_checkpointing,
+                                   separable_convs=self.separable_convs))
         return nn.ModuleList(up_convs)
 
     def _down_pools(self):
@@ -54,6 +64,11 @@ class UNet(nn.Module):
         for i in range(self.repeat_blocks):
             in_channels = int(self.n_filters * 2 ** (i + 2))
             out_channels = int(self.n_filters * 2 ** (i + 1))
+            if self.bilinear_upsampling:
+                up_samples.append(nn.Sequential(nn.Upsample(scale_factor=2, mode='bilinear'),
+                                                nn.Conv2d(in_channels=in_channels, out_channels=out_channels,
+                                                          kernel_size=(1, 1), stride=1, padding=0, bias=False)))
+                continue
             up_samples.append(nn.ConvTranspose2d(in_channels=in_channels,
                                                  out_channels=out_channels,
                                                  kernel_size=2,
@@ -70,13 +85,11 @@ class UNet(nn.Module):
                                                   kernel_size=(self.conv_kernel, self.conv_kernel),
                                                   stride=1, padding=1),
                                         nn.BatchNorm2d(num_features=self.n_filters),
-                                        nn.ReLU(),
+                                        nn.ReLU(inplace=True),
 
-                                        nn.Conv2d(in_channels=self.n_filters, out_channels=self.n_filters,
-                                                  kernel_size=(self.conv_kernel, self.conv_kernel),
-                                                  stride=1, padding=1),
+                                        conv2d(self.n_filters, self.n_filters, self.conv_kernel, self.separable_convs),
                                         nn.BatchNorm2d(num_features=self.n_filters),
-                                        nn.ReLU(),
+                                        nn.ReLU(inplace=True),
 
                                         nn.Dropout(self.dropout),
                                         )
@@ -84,12 +97,10 @@ class UNet(nn.Module):
             input_block = nn.Sequential(nn.Conv2d(in_channels=self.in_channels, out_channels=self.n_filters,
                                                   kernel_size=(self.conv_kernel, self.conv_kernel),
                                                   stride=1, padding=1),
-                                        nn.ReLU(),
+                                        nn.ReLU(inplace=True),
 
-                                        nn.Conv2d(in_channels=self.n_filters, out_channels=self.n_filters,
-                                                  kernel_size=(self.conv_kernel, self.conv_kernel),
-                                                  stride=1, padding=1),
-                                        nn.ReLU(),
+                                        conv2d(self.n_filters, self.n_filters, self.conv_kernel, self.separable_convs),
+                                        nn.ReLU(inplace=True),
 
                                         nn.Dropout(self.dropout),
                                         )
@@ -97,39 +108,37 @@ class UNet(nn.Module):
 
     def _floor_block(self):
         in_channels = int(self.n_filters * 2 ** self.repeat_blocks)
-        return nn.Sequential(DownConv(in_channels, self.conv_kernel, self.batch_norm, self.dropout),
+        return nn.Sequential(DownConv(in_channels, self.conv_kernel, self.batch_norm, self.dropout,
+                                      checkpoint_activations=self.activation_checkpointing,
+                                      separable_convs=self.separable_convs),
                              )
 
     def _classification_block(self):
         in_block = int(2 * self.n_filters)
 
         if self.batch_norm:
-            classification_block = nn.Sequential(nn.Conv2d(in_channels=in_block, out_channels=self.n_filters,
-                                                           kernel_size=(self.conv_kernel, self.conv_kernel),
-                                                           stride=1, padding=1),
+            classification_block = nn.Sequential(conv2d(in_block, self.n_filters, self.conv_kernel,
+                                                        self.separable_convs),
                                                  nn.BatchNorm2d(num_features=self.n_filters),
-                                                 nn.ReLU(),
+                                                 nn.ReLU(inplace=True),
 
-                                                 nn.Conv2d(in_channels=self.n_filters, out_channels=self.n_filters,
-                                                           kernel_size=(self.conv_kernel, self.conv_kernel),
-                                                           stride=1, padding=1),
+                                                 conv2d(self.n_filters, self.n_filters, self.conv_kernel,
+                                                        self.separable_convs),
                                                  nn.BatchNorm2d(num_features=self.n_filters),
-                                                 nn.ReLU(),
+                                                 nn.ReLU(inplace=True),
 
                                                  nn.Dropout(self.dropout),
                                                  nn.Conv2d(in_channels=self.n_filters, out_channels=1,
                                                            kernel_size=(1, 1), stride=1, padding=0),
                                                  )
         else:
-            classification_block = nn.Sequential(nn.Conv2d(in_channels=in_block, out_channels=self.n_filters,
-                                                           kernel_size=(self.conv_kernel, self.conv_kernel),
-                                                           stride=1, padding=1),
-                                                 nn.ReLU(),
+            classification_block = nn.Sequential(conv2d(in_block, self.n_filters, self.conv_kernel,
+                                                        self.separable_convs),
+                                                 nn.ReLU(inplace=True),
 
-                                                 nn.Conv2d(in_channels=self.n_filters, out_channels=self.n_filters,
-                                                           kernel_size=(self.conv_kernel, self.conv_kernel),
-                                                           stride=1, padding=1),
-                                                 nn.ReLU(),
+                                                 conv2d(self.n_filters, self.n_filters, self.conv_kernel,
+                                                        self.separable_convs),
+                                                 nn.ReLU(inplace=True),
 
                                                  nn.Dropout(self.dropout),
                                                  nn.Conv2d(in_channels=self.n_filters, out_channels=1,
@@ -147,11 +156,8 @@ class UNet(nn.Module):
             x = down_pool(x)
         x = self.floor_block(x)
 
-        for down_conv_output, block, up_sample in zip(reversed(down_convs_outputs),
-                                                      reversed(self.up_convs),
-                                                      reversed(self.up_samples)):
-            x = up_sample(x)
-            x = torch.cat((down_conv_output, x), dim=1)
+        for block, up_sample in zip(reversed(self.up_convs), reversed(self.up_samples)):
+            x = concat_skip(down_convs_outputs, up_sample, x)
 
             x = block(x)
 
@@ -160,104 +166,154 @@ class UNet(nn.Module):
 
 
 class DownConv(nn.Module):
-    def __init__(self, in_channels, kernel_size, batch_norm, dropout):
+    def __init__(self, in_channels, kernel_size, batch_norm, dropout, checkpoint_activations=False,
+                 separable_convs=False):
         super(DownConv, self).__init__()
         self.in_channels = in_channels
         self.block_channels = int(in_channels * 2.)
         self.kernel_size = kernel_size
         self.batch_norm = batch_norm
         self.dropout = dropout
+        self.checkpoint_activations = checkpoint_activations
+        self.separable_convs = separable_convs
 
         self.down_conv = self._down_conv()
 
     def _down_conv(self):
         if self.batch_norm:
-            down_conv = nn.Sequential(nn.Conv2d(in_channels=self.in_channels, out_channels=self.block_channels,
-                                                kernel_size=(self.kernel_size, self.kernel_size),
-                                                stride=1, padding=1),
+            down_conv = nn.Sequential(conv2d(self.in_channels, self.block_channels, self.kernel_size,
+                                             self.separable_convs),
                                       nn.BatchNorm2d(num_features=self.block_channels),
-                                      nn.ReLU(),
+                                      nn.ReLU(inplace=True),
 
-                                      nn.Conv2d(in_channels=self.block_channels, out_channels=self.block_channels,
-                                                kernel_size=(self.kernel_size, self.kernel_size),
-                                                stride=1, padding=1),
+                                      conv2d(self.block_channels, self.block_channels, self.kernel_size,
+                                             self.separable_convs),
                                       nn.BatchNorm2d(num_features=self.block_channels),
-                                      nn.ReLU(),
+                                      nn.ReLU(inplace=True),
 
                                       nn.Dropout(self.dropout),
                                       )
         else:
-            down_conv = nn.Sequential(nn.Conv2d(in_channels=self.in_channels, out_channels=self.block_channels,
-                                                kernel_size=(self.kernel_size, self.kernel_size),
-                                                stride=1, padding=1),
-                                      nn.ReLU(),
+            down_conv = nn.Sequential(conv2d(self.in_channels, self.block_channels, self.kernel_size,
+                                             self.separable_convs),
+                                      nn.ReLU(inplace=True),
 
-                                      nn.Conv2d(in_channels=self.block_channels, out_channels=self.block_channels,
-                                                kernel_size=(self.kernel_size, self.kernel_size),
-                                                stride=1, padding=1),
-                                      nn.ReLU(),
+                                      conv2d(self.block_channels, self.block_channels, self.kernel_size,
+                                             self.separable_convs),
+                                      nn.ReLU(inplace=True),
 
                                       nn.Dropout(self.dropout),
                                       )
         return down_conv
 
     def forward(self, x):
+        if self.checkpoint_activations and self.training and x.requires_grad:
+            # torch.utils.checkpoint only exists on torch >= 0.4, imported when checkpointing is switched on
+            from torch.utils.checkpoint import checkpoint
+            return checkpoint(self.down_conv, x)
         return self.down_conv(x)
 
 
 class UpConv(nn.Module):
-    def __init__(self, in_channels, kernel_size, batch_norm, dropout):
+    def __init__(self, in_channels, kernel_size, batch_norm, dropout, checkpoint_activations=False,
+                 separable_convs=False):
         super(UpConv, self).__init__()
         self.in_channels = in_channels
         self.block_channels = int(in_channels / 2.)
         self.kernel_size = kernel_size
         self.batch_norm = batch_norm
         self.dropout = dropout
+        self.checkpoint_activations = checkpoint_activations
+        self.separable_convs = separable_convs
 
         self.up_conv = self._up_conv()
 
     def _up_conv(self):
         if self.batch_norm:
-            up_conv = nn.Sequential(nn.Conv2d(in_channels=self.in_channels, out_channels=self.block_channels,
-                                              kernel_size=(self.kernel_size, self.kernel_size),
-                                              stride=1, padding=1),
+            up_conv = nn.Sequential(conv2d(self.in_channels, self.block_channels, self.kernel_size,
+                                           self.separable_convs),
 
                                     nn.BatchNorm2d(num_features=self.block_channels),
-                                    nn.ReLU(),
+                                    nn.ReLU(inplace=True),
 
-                                    nn.Conv2d(in_channels=self.block_channels, out_channels=self.block_channels,
-                                              kernel_size=(self.kernel_size, self.kernel_size),
-                                              stride=1, padding=1),
+                                    conv2d(self.block_channels, self.block_channels, self.kernel_size,
+                                           self.separable_convs),
                                     nn.BatchNorm2d(num_features=self.block_channels),
-                                    nn.ReLU(),
+                                    nn.ReLU(inplace=True),
 
-                                    nn.Conv2d(in_channels=self.block_channels, out_channels=self.block_channels,
-                                              kernel_size=(self.kernel_size, self.kernel_size),
-                                              stride=1, padding=1),
+                                    conv2d(self.block_channels, self.block_channels, self.kernel_size,
+                                           self.separable_convs),
                                     nn.BatchNorm2d(num_features=self.block_channels),
-                                    nn.ReLU(),
+                                    nn.ReLU(inplace=True),
 
                                     nn.Dropout(self.dropout)
                                     )
         else:
-            up_conv = nn.Sequential(nn.Conv2d(in_channels=self.in_channels, out_channels=self.block_channels,
-                                              kernel_size=(self.kernel_size, self.kernel_size),
-                                              stride=1, padding=1),
-                                    nn.ReLU(),
+            up_conv = nn.Sequential(conv2d(self.in_channels, self.block_channels, self.kernel_size,
+                                           self.separable_convs),
+                                    nn.ReLU(inplace=True),
 
-                                    nn.Conv2d(in_channels=self.block_channels, out_channels=self.block_channels,
-                                              kernel_size=(self.kernel_size, self.kernel_size),
-                                              stride=1, padding=1),
-                                    nn.ReLU(),
+                                    conv2d(self.block_channels, self.block_channels, self.kernel_size,
+                                           self.separable_convs),
+                                    nn.ReLU(inplace=True),
 
-                                    nn.Conv2d(in_channels=self.block_channels, out_channels=self.block_channels,
-                                              kernel_size=(self.kernel_size, self.kernel_size),
-                                              stride=1, padding=1),
-                                    nn.ReLU(),
+                                    conv2d(self.block_channels, self.block_channels, self.kernel_size,
+                                           self.separable_convs),
+                                    nn.ReLU(inplace=True),
 
                                     nn.Dropout(self.dropout)
                                     )
         return up_conv
 
     def forward(self, x):
+        if self.checkpoint_activations and self.training and x.requires_grad:
+            # torch.utils.checkpoint only exists on torch >= 0.4, imported when checkpointing is switched on
+            from torch.utils.checkpoint import checkpoint
+            return checkpoint(self.up_conv, x)
         return self.up_conv(x)
+
+
+class SeparableConv2d(nn.Module):
+    """
+    Depthwise convolution followed by a pointwise 1x1 convolution, roughly kernel_size ** 2 times
+    fewer multiply-adds than a full convolution once the number of channels is large.
+    """
+
+    def __init__(self, in_channels, out_channels, kernel_size, padding=1):
+        super(SeparableConv2d, self).__init__()
+        self.depthwise = nn.Conv2d(in_channels=in_channels, out_channels=in_channels,
+                                   kernel_size=(kernel_size, kernel_size), stride=1, padding=padding,
+                                   groups=in_channels, bias=False)
+        self.pointwise = nn.Conv2d(in_channels=in_channels, out_channels=out_channels,
+                                   kernel_size=(1, 1), stride=1, padding=0)
+
+    def forward(self, x):
+        return self.pointwise(self.depthwise(x))
+
+
+def conv2d(in_channels, out_channels, kernel_size, separable=False):
+    if separable:
+        return SeparableConv2d(in_channels, out_channels, kernel_size)
+    return nn.Conv2d(in_channels=in_channels, out_channels=out_channels,
+                     kernel_size=(kernel_size, kernel_size), stride=1, padding=1)
+
+
+def concat_skip(skips, up_sample, x):
+    """
+    Pops the deepest skip tensor and concatenates it with the upsampled features, the popped skip is
+    then only referenced here. Without autograd it is copied into the concat buffer and released before
+    the upsampling runs, so the skip, the upsampled features and the concatenation are never all alive
+    at the same time.
+    """
+    skip = skips.pop()
+    if autograd_enabled(skip):
+        return torch.cat((skip, up_sample(x)), dim=1)
+
+    skip_channels = skip.size(1)
+    upsampled_channels = up_sample[-1].out_channels if isinstance(up_sample, nn.Sequential) \
+        else up_sample.out_channels
+    concatenated = skip.data.new(skip.size(0), skip_channels + upsampled_channels, *skip.size()[2:])
+    concatenated[:, :skip_channels].copy_(skip.data)
+    del skip
+    concatenated[:, skip_channels:].copy_(up_sample(x).data)
+    return inference_variable(concatenated)
@@ -1,11 +1,15 @@
 import os
 from datetime import datetime, timedelta
+from functools import partial
 
 from PIL import Image
 import numpy as np
-from deepsense import neptune
 from torch.optim.lr_scheduler import ExponentialLR
 
+from ..profiler import profiler
+from ..sinks import get_sink
+from ..trials import TrialStore
+from .distributed import is_master
 from .validation import score_model, get_prediction_masks
 from .utils import get_logger, Averager, save_model
 
@@ -22,6 +26,8 @@ class Callback:
         self.loss_function = None
         self.validation_datagen = None
         self.lr_scheduler = None
+        # validation losses by number of epochs trained, shared by the callbacks of a CallbackList
+        self.validation_losses = {}
 
     def set_params(self, transformer, validation_datagen):
         self.model = transformer.model
@@ -52,6 +58,16 @@ class Callback:
     def on_batch_end(self, *args, **kwargs):
         self.batch_id += 1
 
+    def epoch_validation_loss(self, epochs):
+        """
+        Validation loss of the model after `epochs` epochs, scored once and reused by the other callbacks.
+        """
+        if epochs not in self.validation_losses:
+            self.model.eval()
+            self.validation_losses[epochs] = score_model(self.model, self.loss_function, self.validation_datagen)
+            self.model.train()
+        return self.validation_losses[epochs]
+
 
 class CallbackList:
     def __init__(self, callbacks=None):
@@ -61,6 +77,9 @@ class CallbackList:
             self.callbacks = [callbacks]
         else:
             self.callbacks = callbacks
+        self.validation_losses = {}
+        for callback in self.callbacks:
+            callback.validation_losses = self.validation_losses
 
     def __len__(self):
         return len(self.callbacks)
@@ -70,32 +89,34 @@ class CallbackList:
             callback.set_params(*args, **kwargs)
 
     def on_train_begin(self, *args, **kwargs):
-        for callback in self.callbacks:
-            callback.on_train_begin(*args, **kwargs)
+        self.validation_losses.clear()
+        self._call('on_train_begin', *args, **kwargs)
 
     def on_train_end(self, *args, **kwargs):
-        for callback in self.callbacks:
-            callback.on_train_end(*args, **kwargs)
+        self._call('on_train_end', *args, **kwargs)
 
     def on_epoch_begin(self, *args, **kwargs):
-        for callback in self.callbacks:
-            callback.on_epoch_begin(*args, **kwargs)
+        self._call('on_epoch_begin', *args, **kwargs)
 
     def on_epoch_end(self, *args, **kwargs):
-        for callback in self.callbacks:
-            callback.on_epoch_end(*args, **kwargs)
+        self._call('on_epoch_end', *args, **kwargs)
 
     def training_break(self, *args, **kwargs):
-        callback_out = [callback.training_break(*args, **kwargs) for callback in self.callbacks]
+        callback_out = self._call('training_break', *args, **kwargs)
         return any(callback_out)
 
     def on_batch_begin(self, *args, **kwargs):
-        for callback in self.callbacks:
-            callback.on_batch_begin(*args, **kwargs)
+        self._call('on_batch_begin', *args, **kwargs)
 
     def on_batch_end(self, *args, **kwargs):
+        self._call('on_batch_end', *args, **kwargs)
+
+    def _call(self, hook_name, *args, **kwargs):
+        callback_out = []
         for callback in self.callbacks:
-            callback.on_batch_end(*args, **kwargs)
+            with profiler.section('{}.{}'.format(type(callback).__name__, hook_name), 'callback'):
+                callback_out.append(getattr(callback, hook_name)(*args, **kwargs))
+        return callback_out
 
 
 class TrainingMonitor(Callback):
@@ -146,9 +167,7 @@ class ValidationMonitor(Callback):
 
     def on_epoch_end(self, *args, **kwargs):
         if self.epoch_every and ((self.epoch_id % self.epoch_every) == 0):
-            self.model.eval()
-            val_loss = score_model(self.model, self.loss_function, self.validation_datagen)
-            self.model.train()
+            val_loss = self.epoch_validation_loss(self.epoch_id + 1)
             logger.info('epoch {0} validation loss:     {1:.5f}'.format(self.epoch_id, val_loss))
         self.epoch_id += 1
         self.batch_id = 0
@@ -173,9 +192,7 @@ class EarlyStopping(Callback):
         self.epoch_since_best = 0
 
     def training_break(self, *args, **kwargs):
-        self.model.eval()
-        val_loss = score_model(self.model, self.loss_function, self.validation_datagen)
-        self.model.train()
+        val_loss = self.epoch_validation_loss(self.epoch_id)
 
         if not self.best_score:
             self.best_score = val_loss
@@ -192,6 +209,44 @@ class EarlyStopping(Callback):
             return False
 
 
+class SuccessiveHalvingPruner(Callback):
+    """
+    Asynchronous successive halving across the concurrent trials of a sweep. After `min_epochs * reduction_factor ** k`
+    epochs the validation loss is reported to the shared TrialStore and training stops unless the trial is among
+    the best 1 / reduction_factor of those that reached the same rung.
+    """
+
+    def __init__(self, trial_id, store_filepath, min_epochs=1, reduction_factor=3):
+        super().__init__()
+        self.trial_id = trial_id
+        self.store = TrialStore(store_filepath)
+        self.min_epochs = min_epochs
+        self.reduction_factor = reduction_factor
+
+    def rung(self, epochs):
+        rung, rung_epochs = 0, self.min_epochs
+        while rung_epochs < epochs:
+            rung += 1
+            rung_epochs *= self.reduction_factor
+        return rung if rung_epochs == epochs else None
+
+    def on_train_end(self, *args, **kwargs):
+        self.store.update_trial(self.trial_id, epochs=self.epoch_id)
+
+    def training_break(self, *args, **kwargs):
+        rung = self.rung(self.epoch_id)
+        if rung is None:
+            return False
+
+        val_loss = self.epoch_validation_loss(self.epoch_id)
+        promoted = self.store.report_rung(self.trial_id, rung, self.epoch_id, float(val_loss), self.reduction_factor)
+        if not promoted:
+            logger.info('trial {0} pruned at epoch {1} with validation loss {2}'.format(self.trial_id, self.epoch_id,
+                                                                                         val_loss))
+            self.store.update_trial(self.trial_id, status='pruned')
+        return not promoted
+
+
 class ExponentialLRScheduler(Callback):
     def __init__(self, gamma, epoch_every=1, batch_every=None):
         super().__init__()
@@ -251,10 +306,8 @@ class ModelCheckpoint(Callback):
         os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
 
     def on_epoch_end(self, *args, **kwargs):
-        if self.epoch_every and ((self.epoch_id % self.epoch_every) == 0):
-            self.model.eval()
-            val_loss = score_model(self.model, self.loss_function, self.validation_datagen)
-            self.model.train()
+        if is_master() and self.epoch_every and ((self.epoch_id % self.epoch_every) == 0):
+            val_loss = self.epoch_validation_loss(self.epoch_id + 1)
 
             if not self.best_score:
                 self.best_score = val_loss
@@ -269,9 +322,9 @@ class ModelCheckpoint(Callback):
 
 
 class NeptuneMonitor(Callback):
-    def __init__(self):
+    def __init__(self, sink=None):
         super().__init__()
-        self.ctx = neptune.Context()
+        self.sink = get_sink(**(sink or {}))
         self.random_name = ''
         self.epoch_loss_averager = Averager()
 
@@ -280,6 +333,9 @@ class NeptuneMonitor(Callback):
         self.epoch_id = 0
         self.batch_id = 0
 
+    def on_train_end(self, *args, **kwargs):
+        self.sink.flush()
+
     def on_batch_end(self, metrics, *args, **kwargs):
         batch_loss = metrics['batch_loss']
 
@@ -287,7 +343,8 @@ class NeptuneMonitor(Callback):
 
         logs = {'epoch_id': self.epoch_id, 'batch_id': self.batch_id, 'batch_loss': batch_loss}
 
-        self.ctx.channel_send('batch_loss {}'.format(self.random_name), x=logs['batch_id'], y=logs['batch_loss'])
+        if is_master():
+            self.sink.send_scalar('batch_loss {}'.format(self.random_name), x=logs['batch_id'], y=logs['batch_loss'])
 
         self.batch_id += 1
 
@@ -295,9 +352,11 @@ class NeptuneMonitor(Callback):
         epoch_avg_loss = self.epoch_loss_averager.value
         self.epoch_loss_averager.reset()
 
-        self.model.eval()
-        val_loss = score_model(self.model, self.loss_function, self.validation_datagen)
-        self.model.train()
+        if not is_master():
+            self.epoch_id += 1
+            return
+
+        val_loss = self.epoch_validation_loss(self.epoch_id + 1)
 
         logs = {'epoch_id': self.epoch_id, 'batch_id': self.batch_id, 'epoch_loss': epoch_avg_loss,
                 'epoch_val_loss': val_loss}
@@ -305,14 +364,14 @@ class NeptuneMonitor(Callback):
         self.epoch_id += 1
 
     def _send_numeric_channels(self, logs):
-        self.ctx.channel_send('epoch_loss {}'.format(self.random_name), x=logs['epoch_id'], y=logs['epoch_loss'])
-        self.ctx.channel_send('epoch_val_loss {}'.format(self.random_name), x=logs['epoch_id'],
+        self.sink.send_scalar('epoch_loss {}'.format(self.random_name), x=logs['epoch_id'], y=logs['epoch_loss'])
+        self.sink.send_scalar('epoch_val_loss {}'.format(self.random_name), x=logs['epoch_id'],
                               y=logs['epoch_val_loss'])
 
 
 class NeptuneMonitorSegmentation(NeptuneMonitor):
-    def __init__(self, image_nr, image_resize):
-        super().__init__()
+    def __init__(self, image_nr, image_resize, sink=None):
+        super().__init__(sink)
         self.image_nr = image_nr
         self.image_resize = image_resize
 
@@ -320,8 +379,12 @@ class NeptuneMonitorSegmentation(NeptuneMonitor):
         epoch_avg_loss = self.epoch_loss_averager.value
         self.epoch_loss_averager.reset()
 
+        if not is_master():
+            self.epoch_id += 1
+            return
+
+        val_loss = self.epoch_validation_loss(self.epoch_id + 1)
         self.model.eval()
-        val_loss = score_model(self.model, self.loss_function, self.validation_datagen)
         pred_masks = get_prediction_masks(self.model, self.validation_datagen)
         self.model.train()
 
@@ -333,23 +396,26 @@ class NeptuneMonitorSegmentation(NeptuneMonitor):
 
     def _send_image_channels(self, pred_masks):
         for i, image_triplet in enumerate(pred_masks):
-            h, w = image_triplet.shape[1:]
-            image_glued = np.zeros((h, 3 * w + 20))
+            self.sink.send_image("masks",
+                                 name='epoch{}_batch{}_idx{}'.format(self.epoch_id, self.batch_id, i),
+                                 description="true and prediction masks",
+                                 image=partial(glue_image_triplet, image_triplet, self.image_resize))
 
-            image_glued[:, :w] = image_triplet[0, :, :]
-            image_glued[:, w + 10:2 * w + 10] = image_triplet[1, :, :]
-            image_glued[:, 2 * w + 20:] = image_triplet[2, :, :]
+            if i == self.image_nr: break
 
-            pill_image = Image.fromarray((image_glued * 255.).astype(np.uint8))
-            h_, w_ = image_glued.shape
-            pill_image = pill_image.resize((int(self.image_resize * w_), int(self.image_resize * h_)), Image.ANTIALIAS)
 
-            self.ctx.channel_send("masks", neptune.Image(
-                name='epoch{}_batch{}_idx{}'.format(self.epoch_id, self.batch_id, i),
-                description="true and prediction masks",
-                data=pill_image))
+def glue_image_triplet(image_triplet, image_resize):
+    h, w = image_triplet.shape[1:]
+    image_glued = np.zeros((h, 3 * w + 20))
 
-            if i == self.image_nr: break
+    image_glued[:, :w] = image_triplet[0, :, :]
+    image_glued[:, w + 10:2 * w + 10] = image_triplet[1, :, :]
+    image_glued[:, 2 * w + 20:] = image_triplet[2, :, :]
+
+    pill_image = Image.fromarray((image_glued * 255.).astype(np.uint8))
+    h_, w_ = image_glued.shape
+    pill_image = pill_image.resize((int(image_resize * w_), int(image_resize * h_)), Image.ANTIALIAS)
+    return pill_image
 
 
 class ExperimentTiming(Callback):
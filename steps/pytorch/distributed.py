@@ -0,0 +1,73 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(rank, world_size, master_addr, master_port, backend='gloo'):
+    os.environ['MASTER_ADDR'] = str(master_addr)
+    os.environ['MASTER_PORT'] = str(master_port)
+    dist.init_process_group(backend=backend, rank=rank, world_size=world_size)
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    if is_distributed():
+        return dist.get_rank()
+    return 0
+
+
+def get_world_size():
+    if is_distributed():
+        return dist.get_world_size()
+    return 1
+
+
+def is_master():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_parameters(model):
+    for tensor in model.state_dict().values():
+        dist.broadcast(tensor, src=0)
+
+
+def broadcast_buffers(model):
+    for buffer in model.buffers():
+        dist.broadcast(buffer.data, src=0)
+
+
+def all_reduce_gradients(model):
+    """
+    Averages gradients across processes with a single all-reduce over a flattened buffer,
+    which is much cheaper with gloo than one call per parameter.
+    """
+    grads = [parameter.grad.data for parameter in model.parameters() if parameter.grad is not None]
+    if not grads:
+        return
+
+    flat_grads = torch.cat([grad.contiguous().view(-1) for grad in grads])
+    dist.all_reduce(flat_grads)
+    flat_grads.div_(get_world_size())
+
+    offset = 0
+    for grad in grads:
+        numel = grad.numel()
+        grad.copy_(flat_grads[offset:offset + numel].view_as(grad))
+        offset += numel
+
+
+def any_process(flag):
+    if not is_distributed():
+        return flag
+    flag_tensor = torch.FloatTensor([float(flag)])
+    dist.all_reduce(flag_tensor)
+    return flag_tensor[0] > 0
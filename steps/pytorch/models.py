@@ -1,4 +1,5 @@
 from functools import partial
+from math import ceil
 import shutil
 
 import numpy as np
@@ -9,13 +10,18 @@ from torch.nn import init
 from tqdm import tqdm
 
 from steps.base import BaseTransformer
+from steps.profiler import profiler
+from .distributed import is_distributed, is_master, broadcast_parameters, broadcast_buffers, all_reduce_gradients, \
+    any_process
 from .validation import torch_acc_score_multi_output
-from .utils import get_logger, save_model
+from .utils import get_logger, save_model, find_micro_batch_size, no_grad, inference_variable, loss_value
 
 logger = get_logger()
 
 
 class Model(BaseTransformer):
+    registry_cacheable = True
+
     def __init__(self, architecture_config, training_config, callbacks_config):
         super().__init__()
         self.architecture_config = architecture_config
@@ -26,6 +32,7 @@ class Model(BaseTransformer):
         self.optimizer = None
         self.loss_function = None
         self.callbacks = None
+        self.micro_batch_size = None
 
     def _initialize_model_weights(self):
         logger.info('initializing model weights...')
@@ -48,20 +55,32 @@ class Model(BaseTransformer):
         else:
             self.model = self.model
 
+        if is_distributed():
+            broadcast_parameters(self.model)
+
         self.callbacks.set_params(self, validation_datagen=validation_datagen)
         self.callbacks.on_train_begin()
 
         batch_gen, steps = datagen
-        for epoch_id in range(self.training_config['epochs']):
+        epochs = self.training_config['epochs']
+        for epoch_id in range(epochs):
+            set_sampler_epoch(batch_gen, epoch_id)
             self.callbacks.on_epoch_begin()
-            for batch_id, data in enumerate(batch_gen):
+            for batch_id, data in enumerate(profiler.iterate(batch_gen, 'data_wait', 'fit')):
                 self.callbacks.on_batch_begin()
                 metrics = self._fit_loop(data)
                 self.callbacks.on_batch_end(metrics=metrics)
                 if batch_id == steps:
                     break
+            if hasattr(batch_gen, 'prefetch_next_epoch') and epoch_id + 1 < epochs:
+                # persistent workers load the first batches of the next epoch while callbacks validate
+                set_sampler_epoch(batch_gen, epoch_id + 1)
+                batch_gen.prefetch_next_epoch()
+            if is_distributed():
+                # batch norm statistics are local to each process, validation must see the same model everywhere
+                broadcast_buffers(self.model)
             self.callbacks.on_epoch_end()
-            if self.callbacks.training_break():
+            if any_process(self.callbacks.training_break()):
                 break
         self.callbacks.on_train_end()
         return self
@@ -69,44 +88,89 @@ class Model(BaseTransformer):
     def _fit_loop(self, data):
         X, target_tensor = data
 
-        if torch.cuda.is_available():
-            X, target_var = Variable(X).cuda(), Variable(target_tensor).cuda()
-        else:
-            X, target_var = Variable(X), Variable(target_tensor)
-
-        output = self.model(X)
+        batch_size = X.size(0)
+        micro_batch_size = self._get_micro_batch_size(X)
 
         self.optimizer.zero_grad()
-        batch_loss = self.loss_function(output, target_var)
-        batch_loss.backward()
-        self.optimizer.step()
+        batch_loss_ = 0.0
+        for X_micro, target_micro in zip(torch.split(X, micro_batch_size),
+                                         torch.split(target_tensor, micro_batch_size)):
+            with profiler.section('host_to_device', 'fit'):
+                if torch.cuda.is_available():
+                    X_micro, target_var = Variable(X_micro).cuda(), Variable(target_micro).cuda()
+                else:
+                    X_micro, target_var = Variable(X_micro), Variable(target_micro)
+
+            with profiler.section('forward', 'fit'):
+                output = self.model(X_micro)
+
+                # weighting by micro-batch size reproduces the full batch loss and gradients only for losses
+                # that are means over samples (BCE, MSE); for losses over the whole batch such as the Dice term
+                # of segmentation_loss, accumulation optimizes the size weighted mean of micro-batch losses
+                micro_batch_weight = X_micro.size(0) / batch_size
+                micro_batch_loss = self.loss_function(output, target_var) * micro_batch_weight
+
+            with profiler.section('backward', 'fit'):
+                micro_batch_loss.backward()
+
+            batch_loss_ += loss_value(micro_batch_loss)
+
+        if is_distributed():
+            with profiler.section('all_reduce', 'fit'):
+                all_reduce_gradients(self.model)
+
+        with profiler.section('optimizer_step', 'fit'):
+            self.optimizer.step()
 
-        batch_loss_ = batch_loss.data.cpu().numpy()[0]
         return {'batch_loss': batch_loss_}
 
+    def _get_micro_batch_size(self, X):
+        batch_size = X.size(0)
+        memory_budget_mb = self.training_config.get('memory_budget_mb')
+        if memory_budget_mb:
+            if self.micro_batch_size is None:
+                self.micro_batch_size = find_micro_batch_size(self.model, X,
+                                                              memory_budget=memory_budget_mb * 1024 ** 2,
+                                                              max_batch_size=batch_size)
+                logger.info('micro batch size {0} fits memory budget of {1} MB'.format(self.micro_batch_size,
+                                                                                        memory_budget_mb))
+            return min(self.micro_batch_size, batch_size)
+
+        accumulation_steps = self.training_config.get('accumulation_steps', 1)
+        return int(ceil(batch_size / accumulation_steps))
+
     def _transform(self, datagen, validation_datagen=None):
         self.model.eval()
         batch_gen, steps = datagen
         outputs = []
-        for batch_id, data in enumerate(batch_gen):
-            if len(data) == 2:
-                X, targets = data
-            else:
-                X = data
+        with no_grad():
+            for batch_id, data in enumerate(profiler.iterate(batch_gen, 'data_wait', 'transform')):
+                if len(data) == 2:
+                    X, targets = data
+                else:
+                    X = data
+
+                with profiler.section('host_to_device', 'transform'):
+                    if torch.cuda.is_available():
+                        X = X.cuda()
+                    X = inference_variable(X)
+                with profiler.section('forward', 'transform'):
+                    output = self._predict_batch(X)
+                with profiler.section('device_to_host', 'transform'):
+                    outputs.append(self._batch_output(output))
 
-            if torch.cuda.is_available():
-                X = Variable(X).cuda()
-            else:
-                X = Variable(X)
-            output = self.model(X)
-            outputs.append(output.data.cpu().numpy())
-
-            if batch_id == steps:
-                break
+                if batch_id == steps:
+                    break
 
         outputs = np.vstack(outputs)
         return outputs
 
+    def _predict_batch(self, X):
+        return self.model(X)
+
+    def _batch_output(self, output):
+        return output.data.cpu().numpy()
+
     def transform(self, datagen, validation_datagen=None):
         predictions = self._transform(datagen, validation_datagen)
         return NotImplementedError
@@ -122,7 +186,27 @@ class Model(BaseTransformer):
             self.model.load_state_dict(torch.load(filepath, map_location=lambda storage, loc: storage))
         return self
 
+    def loaded_state(self):
+        # a host copy, fit trains self.model in place and must not change what later loads get
+        return {name: tensor.cpu().clone() for name, tensor in self.model.state_dict().items()}
+
+    def restore_loaded_state(self, state):
+        self.model.eval()
+
+        if torch.cuda.is_available():
+            self.model.cpu()
+            self.model.load_state_dict(state)
+            self.model.cuda()
+        else:
+            self.model.load_state_dict(state)
+
+    def loaded_state_bytes(self):
+        return sum(tensor.numel() * tensor.element_size() for tensor in self.model.state_dict().values())
+
     def save(self, filepath):
+        if not is_master():
+            return
+
         checkpoint_callback = self.callbacks_config.get('model_checkpoint')
         if checkpoint_callback:
             checkpoint_filepath = checkpoint_callback['filepath']
@@ -210,3 +294,8 @@ def init_weights_xavier(model):
     if isinstance(model, nn.Conv2d):
         init.xavier_normal(model.weight)
         init.constant(model.bias, 0)
+
+
+def set_sampler_epoch(batch_gen, epoch_id):
+    if hasattr(batch_gen, 'sampler') and hasattr(batch_gen.sampler, 'set_epoch'):
+        batch_gen.sampler.set_epoch(epoch_id)
@@ -0,0 +1,99 @@
+import glob
+import os
+import re
+
+import torch
+import torch.multiprocessing as multiprocessing
+
+from .utils import get_logger
+
+logger = get_logger()
+
+NODES_GLOB = '/sys/devices/system/node/node[0-9]*'
+
+
+def parse_cpulist(cpulist):
+    """
+    '0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]
+    """
+    cpus = []
+    for chunk in cpulist.strip().split(','):
+        if not chunk:
+            continue
+        first, _, last = chunk.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def numa_nodes():
+    """
+    Cores this process may run on grouped by NUMA node, a single node when the kernel exposes no topology.
+    """
+    cpus = set(available_cpus())
+    nodes = {}
+    for dirpath in glob.glob(NODES_GLOB):
+        with open(os.path.join(dirpath, 'cpulist')) as f:
+            node_cpus = sorted(cpus.intersection(parse_cpulist(f.read())))
+        if node_cpus:
+            nodes[int(re.search(r'(\d+)$', dirpath).group(1))] = node_cpus
+    return nodes or {0: sorted(cpus)}
+
+
+class Placement:
+    """
+    Split of the cores between the training process and its loader workers: every worker gets
+    `worker_threads` cores and the training process the rest, at least one. With `pin_cpus` every
+    process is also pinned to its own cores, taken from `numa_node` only (all nodes when negative).
+    """
+
+    def __init__(self, num_workers, worker_threads=1, pin_cpus=False, numa_node=-1):
+        nodes = numa_nodes()
+        if numa_node >= 0 and numa_node not in nodes:
+            raise ValueError('NUMA node {} is not available, nodes: {}'.format(numa_node, sorted(nodes)))
+        cpus = nodes[numa_node] if numa_node >= 0 else [cpu for node in sorted(nodes) for cpu in nodes[node]]
+
+        self.pin_cpus = pin_cpus
+        self.worker_threads = max(1, worker_threads)
+        self.num_workers = num_workers
+        workers_cpu_nr = min(num_workers * self.worker_threads, len(cpus) - 1)
+        self.main_cpus = cpus[:len(cpus) - workers_cpu_nr] if num_workers else cpus
+        worker_cpus = cpus[len(self.main_cpus):] or cpus
+        self.worker_cpus = [[worker_cpus[(i * self.worker_threads + j) % len(worker_cpus)]
+                             for j in range(self.worker_threads)] for i in range(max(1, num_workers))]
+
+    def apply_main(self):
+        torch.set_num_threads(len(self.main_cpus))
+        if self.pin_cpus and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.main_cpus)
+        logger.info('training process: {0} threads{1}, {2} loader workers with {3} threads each'.format(
+            len(self.main_cpus), ' on cores {}'.format(self.main_cpus) if self.pin_cpus else '',
+            self.num_workers, self.worker_threads))
+
+    def apply_worker(self, worker_id):
+        torch.set_num_threads(self.worker_threads)
+        if self.pin_cpus and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, self.worker_cpus[worker_id % len(self.worker_cpus)])
+
+    def worker_init_fn(self):
+        return WorkerInit(self)
+
+
+class WorkerInit:
+    """
+    DataLoader `worker_init_fn` limiting the threads of a worker and pinning it, picklable unlike a closure.
+    """
+
+    def __init__(self, placement):
+        self.placement = placement
+
+    def __call__(self, worker_id=None):
+        if worker_id is None:
+            # multiprocessing.Pool initializers get no worker id, pool processes are numbered from 1
+            worker_id = multiprocessing.current_process()._identity[0] - 1
+        self.placement.apply_worker(worker_id)
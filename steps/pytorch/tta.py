@@ -0,0 +1,64 @@
+from collections import OrderedDict
+
+import torch
+from torch.autograd import Variable
+
+
+def flip(x, dim):
+    """
+    Reverses `x` along `dim`, Tensor.flip only exists from torch 0.4.1. Takes tensors and variables.
+    """
+    tensor = x.data if isinstance(x, Variable) else x
+    index = tensor.new(list(range(x.size(dim) - 1, -1, -1))).long()
+    if isinstance(x, Variable):
+        index = Variable(index)
+    return x.index_select(dim, index)
+
+
+# dihedral transforms of NCHW tensors as (forward, inverse) pairs
+DIHEDRAL_TRANSFORMS = OrderedDict([
+    ('identity', (lambda x: x, lambda x: x)),
+    ('hflip', (lambda x: flip(x, 3), lambda x: flip(x, 3))),
+    ('vflip', (lambda x: flip(x, 2), lambda x: flip(x, 2))),
+    ('rot180', (lambda x: flip(flip(x, 2), 3), lambda x: flip(flip(x, 2), 3))),
+    ('transpose', (lambda x: x.transpose(2, 3), lambda x: x.transpose(2, 3))),
+    ('rot90', (lambda x: flip(x.transpose(2, 3), 2), lambda x: flip(x, 2).transpose(2, 3))),
+    ('rot270', (lambda x: flip(x.transpose(2, 3), 3), lambda x: flip(x, 3).transpose(2, 3))),
+    ('antitranspose', (lambda x: flip(flip(x.transpose(2, 3), 2), 3),
+                       lambda x: flip(flip(x, 2), 3).transpose(2, 3))),
+])
+SHAPE_PRESERVING_TRANSFORMS = ['identity', 'hflip', 'vflip', 'rot180']
+
+
+def get_tta_transforms(names):
+    if names == 'all':
+        names = list(DIHEDRAL_TRANSFORMS)
+    for name in names:
+        if name not in DIHEDRAL_TRANSFORMS:
+            raise ValueError('unknown tta transform {}, choose from {}'.format(name, list(DIHEDRAL_TRANSFORMS)))
+    return [(name, DIHEDRAL_TRANSFORMS[name]) for name in names]
+
+
+def tta_predict(model, X, transforms):
+    """
+    Runs all variants of the batch in a single forward pass, maps the logits back with the inverse
+    transforms and averages them in place.
+    """
+    h, w = X.size(2), X.size(3)
+    if h != w and any(name not in SHAPE_PRESERVING_TRANSFORMS for name, _ in transforms):
+        raise ValueError('transposing tta transforms need square inputs, got {}x{}'.format(h, w))
+
+    batch_size = X.size(0)
+    X_tta = torch.cat([forward(X) for _, (forward, _) in transforms], dim=0)
+    outputs = model(X_tta).data
+
+    averaged = None
+    for (_, (_, inverse)), output in zip(transforms, torch.split(outputs, batch_size)):
+        output = inverse(output)
+        if averaged is None:
+            # either a view of `outputs` or a fresh tensor, safe to accumulate into in both cases
+            averaged = output.contiguous()
+        else:
+            averaged.add_(output)
+    averaged.div_(len(transforms))
+    return Variable(averaged)
@@ -1,8 +1,11 @@
 import logging
+from contextlib import suppress
+from math import ceil
 
 import cv2
 import numpy as np
 import torch
+from torch.autograd import Variable
 
 
 def init_logger():
@@ -85,6 +88,39 @@ def overlay_keypoints(img, pred_keypoints, true_keypoints, bin_nr):
     return img_overlayed
 
 
+def no_grad():
+    """
+    torch.no_grad on torch >= 0.4, a no-op on torch 0.3 where inputs are wrapped with `inference_variable`.
+    """
+    if hasattr(torch, 'no_grad'):
+        return torch.no_grad()
+    return suppress()
+
+
+def inference_variable(X):
+    if hasattr(torch, 'no_grad'):
+        return Variable(X)
+    return Variable(X, volatile=True)
+
+
+def autograd_enabled(x):
+    """
+    Whether operations on `x` are recorded for backward, checks volatile Variables on torch 0.3.
+    """
+    if hasattr(torch, 'is_grad_enabled'):
+        return torch.is_grad_enabled()
+    return not x.volatile
+
+
+def loss_value(loss):
+    """
+    Python float of a scalar loss, 0-dim on torch >= 0.4 and a 1 element Variable on torch 0.3.
+    """
+    if hasattr(loss, 'item'):
+        return loss.item()
+    return loss.data[0]
+
+
 def save_model(model, path):
     model.eval()
     if torch.cuda.is_available():
@@ -96,6 +132,54 @@ def save_model(model, path):
     model.train()
 
 
+def activation_bytes_per_sample(model, X):
+    """
+    Bytes of activations kept for the backward pass, measured with forward hooks on a single sample.
+    Modules flagged with `checkpoint_activations` only keep their output, so their children are not counted.
+    """
+    checkpointed = [name for name, module in model.named_modules() if getattr(module, 'checkpoint_activations', False)]
+    activation_sizes = []
+
+    def hook(module, inputs, output):
+        activation_sizes.append(output.data.numel() * output.data.element_size())
+
+    handles = []
+    for name, module in model.named_modules():
+        inside_checkpoint = any(name.startswith(checkpointed_name + '.') for checkpointed_name in checkpointed)
+        is_leaf = len(list(module.children())) == 0
+        if (is_leaf and not inside_checkpoint) or name in checkpointed:
+            handles.append(module.register_forward_hook(hook))
+
+    was_training = model.training
+    model.eval()
+    with no_grad():
+        if torch.cuda.is_available():
+            X = X.cuda()
+        model(inference_variable(X[:1]))
+    model.train(was_training)
+
+    for handle in handles:
+        handle.remove()
+    return sum(activation_sizes)
+
+
+def find_micro_batch_size(model, X, memory_budget, max_batch_size):
+    """
+    Largest micro-batch whose weights, optimizer state and activations fit in `memory_budget` bytes.
+    The batch is then split into equally sized chunks so that the last micro-batch is not a tiny remainder.
+    """
+    parameter_bytes = sum(p.data.numel() * p.data.element_size() for p in model.parameters())
+    static_bytes = 4 * parameter_bytes  # weights, gradients and two Adam moments
+    # activations are stored for backward and their gradients are materialized during it
+    sample_bytes = 2 * activation_bytes_per_sample(model, X)
+
+    micro_batch_size = int((memory_budget - static_bytes) // sample_bytes)
+    micro_batch_size = max(1, min(micro_batch_size, max_batch_size))
+
+    chunks_nr = ceil(max_batch_size / micro_batch_size)
+    return int(ceil(max_batch_size / chunks_nr))
+
+
 class Averager:
     """
     Todo:
@@ -0,0 +1,84 @@
+import os
+import time
+from collections import OrderedDict
+
+from steps.utils import get_logger
+
+logger = get_logger()
+
+
+class TransformerRegistry:
+    """
+    Process-wide cache of the state transformers load from their step cache files, keyed by file path
+    and modification time so that a retrained transformer is never served stale. Only transformers
+    whose class sets `registry_cacheable` take part, they expose their loaded state through
+    `loaded_state`, `restore_loaded_state` and `loaded_state_bytes`. A hit copies the cached state into
+    the transformer, so one trained after loading leaves the entry and other pipelines intact. The least
+    recently used states are evicted once they take more than `budget_mb` together, 0 disables the registry.
+    """
+
+    def __init__(self, budget_mb=1024):
+        self.budget_bytes = int(budget_mb * 2 ** 20)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_seconds = 0.
+        self.saved_seconds = 0.
+
+    def set_budget(self, budget_mb):
+        self.budget_bytes = int(budget_mb * 2 ** 20)
+        self._evict()
+
+    @property
+    def resident_bytes(self):
+        return sum(entry['bytes'] for entry in self._entries.values())
+
+    def load(self, transformer, filepath):
+        if not getattr(transformer, 'registry_cacheable', False) or not self.budget_bytes:
+            return transformer.load(filepath)
+
+        key = (os.path.abspath(filepath), os.path.getmtime(filepath))
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry['load_seconds']
+            transformer.restore_loaded_state(entry['state'])
+            return transformer
+
+        self.misses += 1
+        start = time.time()
+        transformer = transformer.load(filepath)
+        load_seconds = time.time() - start
+        self.load_seconds += load_seconds
+
+        for stale_key in [stale_key for stale_key in self._entries if stale_key[0] == key[0]]:
+            del self._entries[stale_key]
+        self._entries[key] = {'state': transformer.loaded_state(),
+                              'bytes': transformer.loaded_state_bytes(),
+                              'load_seconds': load_seconds}
+        self._evict()
+        return transformer
+
+    def _evict(self):
+        while self._entries and self.resident_bytes > self.budget_bytes:
+            key, _ = self._entries.popitem(last=False)
+            self.evictions += 1
+            logger.info('transformer registry evicting {}'.format(key[0]))
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {'entries': len(self._entries),
+                'resident_mb': self.resident_bytes / 2 ** 20,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'load_seconds': self.load_seconds,
+                'saved_seconds': self.saved_seconds,
+                }
+
+
+transformer_registry = TransformerRegistry()
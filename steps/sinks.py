@@ -0,0 +1,223 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import Counter, deque, OrderedDict
+
+from .utils import get_logger
+
+logger = get_logger()
+
+_SINKS = {}
+
+
+class MetricsSink:
+    def send_scalar(self, channel_name, x, y):
+        self.send_scalars(channel_name, [(x, y)])
+
+    def send_scalars(self, channel_name, points):
+        raise NotImplementedError
+
+    def send_image(self, channel_name, name, description, image):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class NullSink(MetricsSink):
+    """
+    Discards every point, for processes that build models with callbacks but never train them.
+    """
+
+    def send_scalars(self, channel_name, points):
+        pass
+
+    def send_image(self, channel_name, name, description, image):
+        pass
+
+
+class NeptuneSink(MetricsSink):
+    def __init__(self):
+        from deepsense import neptune
+        self.neptune = neptune
+        self.ctx = neptune.Context()
+
+    def send_scalars(self, channel_name, points):
+        for x, y in points:
+            self.ctx.channel_send(channel_name, x=x, y=y)
+
+    def send_image(self, channel_name, name, description, image):
+        self.ctx.channel_send(channel_name, self.neptune.Image(name=name, description=description, data=image))
+
+
+class JsonlSink(MetricsSink):
+    """
+    Offline replacement for Neptune: one json line per point, images saved as png files next to the log.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.image_dirpath = '{}_images'.format(os.path.splitext(filepath)[0])
+        self.file = None
+
+    def _open(self):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+            self.file = open(self.filepath, 'a')
+        return self.file
+
+    def send_scalars(self, channel_name, points):
+        timestamp = time.time()
+        lines = [json.dumps({'channel': channel_name, 'x': float(x), 'y': float(y), 'timestamp': timestamp})
+                 for x, y in points]
+        self._open().write('\n'.join(lines) + '\n')
+
+    def send_image(self, channel_name, name, description, image):
+        image_filepath = os.path.join(self.image_dirpath, channel_name, '{}.png'.format(name))
+        os.makedirs(os.path.dirname(image_filepath), exist_ok=True)
+        image.save(image_filepath)
+        self._open().write(json.dumps({'channel': channel_name, 'image': image_filepath, 'description': description,
+                                       'timestamp': time.time()}) + '\n')
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class AsyncSink(MetricsSink):
+    """
+    Sends points to the wrapped sink from a background thread so that a slow tracking backend
+    does not stall training. The queue is bounded and drops the oldest scalar point under backpressure,
+    images are only dropped when nothing else is queued, the drops are counted and logged.
+    Scalar points are sent per channel in batches, points with the same x are coalesced to the latest one.
+    Images may be passed as callables, they are then built on the background thread as well.
+    The thread only exists in the process that created the sink, a forked child gets a sink of its own
+    from `get_sink` and leaves the inherited one alone.
+    """
+
+    def __init__(self, sink, queue_size=10000, batch_size=256, flush_interval=1.0):
+        self.sink = sink
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.in_flight = False
+        self.closed = False
+        self.dropped = Counter()
+        self.pid = os.getpid()
+
+        self.thread = threading.Thread(target=self._run, name='metrics-sink', daemon=True)
+        self.thread.start()
+
+    def send_scalars(self, channel_name, points):
+        for point in points:
+            self._put(('scalar', channel_name, point))
+
+    def send_image(self, channel_name, name, description, image):
+        self._put(('image', channel_name, (name, description, image)))
+
+    def _put(self, item):
+        with self.condition:
+            if self.closed:
+                return
+            if len(self.queue) >= self.queue_size:
+                self._drop()
+            self.queue.append(item)
+            self.condition.notify_all()
+
+    def _drop(self):
+        index = next((i for i, (kind, _, _) in enumerate(self.queue) if kind == 'scalar'), 0)
+        kind, channel_name, _ = self.queue[index]
+        del self.queue[index]
+        if not self.dropped[kind]:
+            logger.warning('metrics sink queue is full, dropping {} points, first from {}'.format(kind, channel_name))
+        self.dropped[kind] += 1
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait(self.flush_interval)
+                if not self.queue and self.closed:
+                    return
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+                self.in_flight = True
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception('metrics sink failed to send {} points'.format(len(batch)))
+            with self.condition:
+                self.in_flight = False
+                self.condition.notify_all()
+
+    def _write(self, batch):
+        scalars, images = OrderedDict(), []
+        for kind, channel_name, payload in batch:
+            if kind == 'scalar':
+                x, y = payload
+                scalars.setdefault(channel_name, OrderedDict())[x] = y
+            else:
+                images.append((channel_name, payload))
+
+        for channel_name, points in scalars.items():
+            self.sink.send_scalars(channel_name, list(points.items()))
+        for channel_name, (name, description, image) in images:
+            if callable(image):
+                image = image()
+            self.sink.send_image(channel_name, name, description, image)
+
+    def flush(self):
+        if os.getpid() != self.pid:
+            return
+        with self.condition:
+            while self.queue or self.in_flight:
+                self.condition.wait(self.flush_interval)
+        self.sink.flush()
+
+    def close(self):
+        if os.getpid() != self.pid:
+            return
+        self.flush()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.sink.close()
+        if self.dropped:
+            logger.warning('metrics sink dropped {} under backpressure'.format(
+                ', '.join('{} {} points'.format(count, kind) for kind, count in sorted(self.dropped.items()))))
+
+
+def get_sink(backend='neptune', filepath=None, asynchronous=True, queue_size=10000, batch_size=256):
+    """
+    Returns the sink of this process for the given configuration, creating it on first use.
+    Keyed by pid too, a forked child does not inherit the background thread of its parent's sink.
+    """
+    key = (os.getpid(), backend, filepath, asynchronous, queue_size, batch_size)
+    if key not in _SINKS:
+        if backend == 'null':
+            return NullSink()
+        if backend == 'neptune':
+            sink = NeptuneSink()
+        elif backend == 'jsonl':
+            sink = JsonlSink(filepath)
+        else:
+            raise NotImplementedError('unknown metrics sink backend {}'.format(backend))
+
+        if asynchronous:
+            sink = AsyncSink(sink, queue_size=queue_size, batch_size=batch_size)
+        atexit.register(sink.close)
+        _SINKS[key] = sink
+    return _SINKS[key]
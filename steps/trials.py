@@ -0,0 +1,66 @@
+import json
+import sqlite3
+import time
+from contextlib import closing
+
+
+class TrialStore:
+    """
+    sqlite results table shared by the processes of a hyperparameter sweep: one row per trial and the
+    validation losses every trial reported at the successive halving rungs.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with closing(self._connect()) as connection, connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS trials (trial_id INTEGER PRIMARY KEY, params TEXT, '
+                               'status TEXT, epochs INTEGER, iout REAL, started REAL, duration_s REAL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS rungs (trial_id INTEGER, rung INTEGER, epochs INTEGER, '
+                               'val_loss REAL, PRIMARY KEY (trial_id, rung))')
+
+    def _connect(self):
+        return sqlite3.connect(self.filepath, timeout=60)
+
+    def add_trial(self, trial_id, params):
+        with closing(self._connect()) as connection, connection:
+            connection.execute('DELETE FROM rungs WHERE trial_id = ?', (trial_id,))
+            connection.execute('INSERT OR REPLACE INTO trials (trial_id, params, status) VALUES (?, ?, ?)',
+                               (trial_id, json.dumps(params, sort_keys=True), 'pending'))
+
+    def start_trial(self, trial_id):
+        self.update_trial(trial_id, status='running', started=time.time())
+
+    def finish_trial(self, trial_id, status, iout=None):
+        with closing(self._connect()) as connection, connection:
+            connection.execute('UPDATE trials SET status = ?, iout = ?, duration_s = ? - started WHERE trial_id = ?',
+                               (status, iout, time.time(), trial_id))
+
+    def update_trial(self, trial_id, **fields):
+        assignments = ', '.join('{} = ?'.format(name) for name in fields)
+        with closing(self._connect()) as connection, connection:
+            connection.execute('UPDATE trials SET {} WHERE trial_id = ?'.format(assignments),
+                               list(fields.values()) + [trial_id])
+
+    def trial_status(self, trial_id):
+        with closing(self._connect()) as connection:
+            return connection.execute('SELECT status FROM trials WHERE trial_id = ?', (trial_id,)).fetchone()[0]
+
+    def report_rung(self, trial_id, rung, epochs, val_loss, reduction_factor):
+        """
+        Records the validation loss of a trial at a rung and tells whether the trial is among the best
+        1 / reduction_factor of the trials that reached that rung so far, the best one always is.
+        """
+        with closing(self._connect()) as connection, connection:
+            connection.execute('INSERT OR REPLACE INTO rungs VALUES (?, ?, ?, ?)', (trial_id, rung, epochs, val_loss))
+            losses = sorted(row[0] for row in connection.execute('SELECT val_loss FROM rungs WHERE rung = ?', (rung,)))
+        promoted_nr = max(1, len(losses) // reduction_factor)
+        return val_loss <= losses[promoted_nr - 1]
+
+    def results(self):
+        with closing(self._connect()) as connection:
+            rows = connection.execute(
+                'SELECT trials.trial_id, params, status, trials.epochs, MIN(rungs.val_loss), iout, duration_s '
+                'FROM trials LEFT JOIN rungs ON trials.trial_id = rungs.trial_id '
+                'GROUP BY trials.trial_id ORDER BY iout IS NULL, iout DESC').fetchall()
+        columns = ['trial_id', 'params', 'status', 'epochs', 'best_val_loss', 'iout', 'duration_s']
+        return [dict(zip(columns, row), params=json.loads(row[1])) for row in rows]
@@ -1,16 +1,17 @@
 import logging
 import os
 
-import pydot_ng as pydot
-from IPython.display import Image, display
-
 
 def view_pydot(pydot_object):
+    from IPython.display import Image, display
+
     plt = Image(pydot_object.create_png())
     display(plt)
 
 
 def create_graph(graph_info):
+    import pydot_ng as pydot
+
     dot = pydot.Dot()
     for node in graph_info['nodes']:
         dot.add_node(pydot.Node(node))
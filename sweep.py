@@ -0,0 +1,118 @@
+import os
+from multiprocessing import Process
+
+import numpy as np
+
+from cross_validation import process_config, run_processes, warm_decoded_cache
+from pipeline_config import build_solution_config, LABEL_COLUMNS, SIZE_COLUMNS
+from steps.trials import TrialStore
+from utils import get_logger, read_yaml, read_masks
+
+logger = get_logger()
+
+
+def load_search_space(filepath, params):
+    """
+    Reads a search space over neptune.yaml parameters, every entry is one of
+
+        n_filters: [8, 16, 32]                  # choice
+        dropout_conv: {low: 0.0, high: 0.5}     # uniform
+        lr: {low: 0.00001, high: 0.01, log: 1}  # log uniform
+        repeat_blocks: {low: 3, high: 6, int: 1}
+    """
+    space = read_yaml(filepath)
+    unknown = [name for name in space if name not in params]
+    if unknown:
+        raise ValueError('unknown parameters in the search space: {}'.format(unknown))
+    return space
+
+
+def sample_trial_params(space, random_state):
+    trial_params = {}
+    for name, spec in sorted(space.items()):
+        if isinstance(spec, (list, tuple)):
+            trial_params[name] = spec[random_state.randint(len(spec))]
+        elif spec.get('log'):
+            trial_params[name] = float(np.exp(random_state.uniform(np.log(spec['low']), np.log(spec['high']))))
+        elif spec.get('int'):
+            trial_params[name] = int(random_state.randint(spec['low'], spec['high'] + 1))
+        else:
+            trial_params[name] = float(random_state.uniform(spec['low'], spec['high']))
+    return trial_params
+
+
+def run_trial(pipeline_name, trial_id, config, meta_train, meta_valid, threads, store_filepath):
+    """
+    Trains one trial, the pruner callback may stop it early, and stores the validation IoUT of the
+    trials that were not pruned.
+    """
+    import torch
+    from metrics import intersection_over_union_thresholds
+    from pipelines import PIPELINES
+
+    torch.set_num_threads(threads)
+    store = TrialStore(store_filepath)
+    store.start_trial(trial_id)
+
+    train_data = {'input': {'meta': meta_train,
+                            'meta_valid': meta_valid,
+                            'train_mode': True,
+                            'target_sizes': meta_train[SIZE_COLUMNS].values
+                            },
+                  }
+    PIPELINES[pipeline_name]['train'](config).fit_transform(train_data)
+    if store.trial_status(trial_id) == 'pruned':
+        store.finish_trial(trial_id, 'pruned')
+        return
+
+    valid_data = {'input': {'meta': meta_valid,
+                            'meta_valid': None,
+                            'train_mode': False,
+                            'target_sizes': meta_valid[SIZE_COLUMNS].values
+                            },
+                  }
+    output = PIPELINES[pipeline_name]['inference'](config).transform(valid_data)
+    y_true = read_masks(meta_valid[LABEL_COLUMNS].values)
+    iout = intersection_over_union_thresholds(y_true, output['y_pred'], output.get('labeled', False))
+    store.finish_trial(trial_id, 'completed', iout=float(iout))
+
+
+def sweep(pipeline_name, params, space, trials_nr, meta_train, meta_valid, sweep_dirpath, threads, parallel,
+          min_epochs, reduction_factor, seed=1234):
+    """
+    Samples `trials_nr` configurations from `space`, trains them `parallel` at a time with successive
+    halving pruning and returns the rows of the sweep results table, best first.
+    """
+    store_filepath = os.path.join(sweep_dirpath, 'sweep.db')
+    decoded_cache_dirpath = os.path.join(sweep_dirpath, 'decoded_cache')
+    os.makedirs(sweep_dirpath, exist_ok=True)
+    store = TrialStore(store_filepath)
+
+    logger.info('decoding images into {}'.format(decoded_cache_dirpath))
+    warm_decoded_cache(meta_train.append(meta_valid), decoded_cache_dirpath, threads * parallel)
+
+    random_state = np.random.RandomState(seed)
+    processes = []
+    for trial_id in range(trials_nr):
+        trial_params = sample_trial_params(space, random_state)
+        store.add_trial(trial_id, trial_params)
+
+        config = process_config(build_solution_config(params + trial_params),
+                                os.path.join(sweep_dirpath, 'trial_{}'.format(trial_id)), decoded_cache_dirpath,
+                                threads)
+        for network in ['unet_network', 'sequential_convnet']:
+            config[network]['callbacks_config']['pruner'] = {'trial_id': trial_id,
+                                                             'store_filepath': store_filepath,
+                                                             'min_epochs': min_epochs,
+                                                             'reduction_factor': reduction_factor,
+                                                             }
+        processes.append(Process(target=run_trial,
+                                 args=(pipeline_name, trial_id, config, meta_train, meta_valid, threads,
+                                       store_filepath)))
+
+    logger.info('running {0} trials, {1} at a time with {2} threads each'.format(trials_nr, parallel, threads))
+    exit_codes = run_processes(processes, parallel)
+    for trial_id, exit_code in enumerate(exit_codes):
+        if exit_code != 0:
+            store.finish_trial(trial_id, 'failed')
+    return store.results()
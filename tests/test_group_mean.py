@@ -0,0 +1,33 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('sklearn.externals.joblib')
+
+from steps.postprocessing import group_mean  # noqa: E402
+
+
+def _groupby_mean(values, ids):
+    return pd.DataFrame(values.reshape(len(values), -1)).groupby(np.asarray(ids)).mean().values.reshape(
+        (-1,) + values.shape[1:])
+
+
+@pytest.mark.parametrize('ids', [['a', 'a', 'b', 'b', 'b', 'c'],
+                                 ['c', 'a', 'b', 'a', 'c', 'b'],
+                                 [3, 1, 3, 2, 1, 3],
+                                 ['b', 'b', 'b', 'b', 'b', 'b'],
+                                 ['f', 'e', 'd', 'c', 'b', 'a'],
+                                 ['a', 'b', 'a', 'b', 'c', 'd']],
+                         ids=['sorted', 'unsorted', 'integers', 'single_group', 'single_members', 'mixed'])
+@pytest.mark.parametrize('shape', [(6,), (6, 3), (6, 2, 4, 4)])
+def test_group_mean_matches_groupby(ids, shape):
+    values = np.random.RandomState(1234).rand(*shape).astype(np.float32)
+
+    np.testing.assert_allclose(group_mean(values, ids), _groupby_mean(values, ids), rtol=1e-6)
+
+
+def test_group_mean_drops_missing_ids_like_groupby():
+    values = np.random.RandomState(1234).rand(5, 3)
+    ids = ['a', None, 'b', 'a', None]
+
+    np.testing.assert_allclose(group_mean(values, ids), _groupby_mean(values, ids))
@@ -0,0 +1,75 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+ndimage = pytest.importorskip('scipy.ndimage')
+pytest.importorskip('sklearn')
+
+from metrics import compute_eval_metric, intersection_over_union_thresholds, threshold_grid_iout  # noqa: E402
+from utils import probability_threshold  # noqa: E402
+
+THRESHOLDS = np.arange(0.1, 0.95, 0.05).round(6).tolist()
+
+
+def _label_map(random_state, shape=(64, 80), nuclei_nr=8):
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    labels = np.zeros(shape, dtype=np.uint16)
+    for i in range(nuclei_nr):
+        cy, cx = random_state.randint(0, shape[0]), random_state.randint(0, shape[1])
+        ry, rx = random_state.randint(3, 10, size=2)
+        # later nuclei overlap earlier ones, so some instances touch
+        labels[((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2 <= 1] = i + 1
+    return labels
+
+
+def _probability(random_state, labels):
+    # blurred masks with noise, touching nuclei are joined by pixels that drop out at higher thresholds
+    probability = ndimage.gaussian_filter((labels > 0).astype(np.float32), 2)
+    probability += random_state.normal(0, 0.1, size=labels.shape)
+    return np.clip(probability, 0, 1).astype(np.float32)
+
+
+def _reference(gt, probability):
+    return [compute_eval_metric(gt, (probability > probability_threshold(threshold, probability.dtype)).astype(
+        np.uint8)) for threshold in THRESHOLDS]
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_threshold_grid_matches_competition_metric(seed):
+    random_state = np.random.RandomState(seed)
+    gt = _label_map(random_state)
+    probability = _probability(random_state, gt)
+
+    np.testing.assert_allclose(threshold_grid_iout(gt, probability, THRESHOLDS), _reference(gt, probability))
+
+
+def test_threshold_grid_matches_on_uint8_probabilities():
+    random_state = np.random.RandomState(3)
+    gt = _label_map(random_state)
+    probability = (_probability(random_state, gt) * 255).round().astype(np.uint8)
+
+    np.testing.assert_allclose(threshold_grid_iout(gt, probability, THRESHOLDS), _reference(gt, probability))
+
+
+@pytest.mark.parametrize('empty', ['prediction', 'ground_truth', 'both'])
+def test_threshold_grid_matches_on_empty_masks(empty):
+    random_state = np.random.RandomState(4)
+    gt = _label_map(random_state)
+    probability = _probability(random_state, gt)
+    if empty in ('prediction', 'both'):
+        probability = np.zeros_like(probability)
+    if empty in ('ground_truth', 'both'):
+        gt = np.zeros_like(gt)
+
+    np.testing.assert_allclose(threshold_grid_iout(gt, probability, THRESHOLDS), _reference(gt, probability))
+
+
+def test_threshold_grid_mean_matches_iout_over_images():
+    random_state = np.random.RandomState(5)
+    ground_truth = [_label_map(random_state) for _ in range(3)]
+    probabilities = [_probability(random_state, gt) for gt in ground_truth]
+
+    scores = np.mean([threshold_grid_iout(gt, probability, THRESHOLDS)
+                      for gt, probability in zip(ground_truth, probabilities)], axis=0)
+    for threshold, score in zip(THRESHOLDS, scores):
+        y_pred = [(probability > threshold).astype(np.uint8) for probability in probabilities]
+        assert score == pytest.approx(intersection_over_union_thresholds(ground_truth, y_pred))
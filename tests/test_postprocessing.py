@@ -0,0 +1,65 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+pytest.importorskip('sklearn.externals.joblib')
+
+from steps.base import BaseTransformer, Step, average_inputs, stack_inputs, to_tuple_inputs  # noqa: E402
+from steps.postprocessing import PredictionAverage  # noqa: E402
+
+
+class Predictions(BaseTransformer):
+    def __init__(self, predictions):
+        self.predictions = predictions
+
+    def transform(self):
+        return {'prediction_probability': self.predictions}
+
+
+def _predictions(models_nr=3, shape=(10, 2, 8, 8), seed=1234):
+    random_state = np.random.RandomState(seed)
+    return [random_state.rand(*shape).astype(np.float32) for _ in range(models_nr)]
+
+
+def _ensemble(predictions, cache_dirpath, lazy_inputs, adapter_function):
+    models = [Step(name='model_{}'.format(i),
+                   transformer=Predictions(prediction),
+                   cache_dirpath=cache_dirpath) for i, prediction in enumerate(predictions)]
+    return Step(name='average',
+                transformer=PredictionAverage(),
+                input_steps=models,
+                adapter={'prediction_proba_list': ([(model.name, 'prediction_probability') for model in models],
+                                                   adapter_function),
+                         },
+                cache_dirpath=cache_dirpath,
+                lazy_inputs=lazy_inputs)
+
+
+def test_online_average_matches_in_memory_average(tmpdir):
+    predictions = _predictions()
+    copies = [prediction.copy() for prediction in predictions]
+
+    online = _ensemble(predictions, str(tmpdir.mkdir('online')), True, to_tuple_inputs).fit_transform({})
+    in_memory = _ensemble(predictions, str(tmpdir.mkdir('in_memory')), False, stack_inputs).fit_transform({})
+
+    np.testing.assert_allclose(online['prediction_probability'], average_inputs(predictions), rtol=1e-6)
+    np.testing.assert_allclose(online['prediction_probability'], in_memory['prediction_probability'], rtol=1e-6)
+    for prediction, copy in zip(predictions, copies):
+        np.testing.assert_array_equal(prediction, copy)
+
+
+def test_weighted_average_of_batches():
+    predictions = _predictions(models_nr=2)
+    weights = [0.3, 0.7]
+    batched = [[prediction[i:i + 4] for i in range(0, len(prediction), 4)] for prediction in predictions]
+
+    averaged = PredictionAverage(weights=weights).transform(batched)['prediction_probability']
+
+    np.testing.assert_allclose(np.concatenate(averaged), weights[0] * predictions[0] + weights[1] * predictions[1],
+                               rtol=1e-6)
+
+
+def test_lazy_inputs_reject_adapters_that_need_outputs(tmpdir):
+    ensemble = _ensemble(_predictions(), str(tmpdir), True, average_inputs)
+    with pytest.raises(ValueError):
+        ensemble.fit_transform({})
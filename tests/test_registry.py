@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from steps.pytorch.models import Model  # noqa: E402
+from steps.registry import TransformerRegistry  # noqa: E402
+
+
+class LinearModel(Model):
+    def __init__(self):
+        super().__init__(architecture_config={}, training_config={}, callbacks_config={})
+        self.model = torch.nn.Linear(4, 2)
+
+
+def _save_weights(filepath, value):
+    model = LinearModel().model
+    for tensor in model.state_dict().values():
+        tensor.fill_(value)
+    torch.save(model.state_dict(), filepath)
+
+
+def _weights(transformer):
+    return torch.cat([tensor.view(-1) for tensor in transformer.model.state_dict().values()]).cpu().numpy()
+
+
+def test_hit_is_not_changed_by_training_the_loaded_model(tmpdir):
+    filepath = str(tmpdir.join('unet_network'))
+    _save_weights(filepath, 1.)
+    registry = TransformerRegistry(budget_mb=1)
+
+    first = registry.load(LinearModel(), filepath)
+    second = registry.load(LinearModel(), filepath)
+    assert registry.hits == 1
+    assert first.model is not second.model
+
+    # what fit does to the loaded module
+    for parameter in first.model.parameters():
+        parameter.data.add_(1.)
+
+    third = registry.load(LinearModel(), filepath)
+    assert (_weights(first) == 2.).all()
+    assert (_weights(second) == 1.).all()
+    assert (_weights(third) == 1.).all()
+
+
+def test_rewritten_file_is_loaded_again(tmpdir):
+    filepath = str(tmpdir.join('unet_network'))
+    _save_weights(filepath, 1.)
+    registry = TransformerRegistry(budget_mb=1)
+    registry.load(LinearModel(), filepath)
+
+    _save_weights(filepath, 3.)
+    mtime = os.path.getmtime(filepath) + 10
+    os.utime(filepath, (mtime, mtime))
+
+    reloaded = registry.load(LinearModel(), filepath)
+    assert registry.misses == 2
+    assert registry.stats()['entries'] == 1
+    assert (_weights(reloaded) == 3.).all()
+
+
+def test_hit_places_the_model_like_a_cold_load(tmpdir):
+    filepath = str(tmpdir.join('unet_network'))
+    _save_weights(filepath, 1.)
+    registry = TransformerRegistry(budget_mb=1)
+
+    cold = registry.load(LinearModel(), filepath)
+    hit = registry.load(LinearModel(), filepath)
+    assert registry.hits == 1
+
+    def devices(transformer):
+        return {parameter.is_cuda for parameter in transformer.model.parameters()}
+
+    assert devices(hit) == devices(cold)
+    assert not hit.model.training
+    assert not any(tensor.is_cuda for entry in registry._entries.values() for tensor in entry['state'].values())
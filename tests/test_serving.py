@@ -0,0 +1,47 @@
+import io
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import numpy as np  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from pipeline_config import build_solution_config  # noqa: E402
+from steps.pytorch.architectures.unet import UNet  # noqa: E402
+from utils import read_params  # noqa: E402
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def config(monkeypatch):
+    monkeypatch.chdir(REPO_DIR)
+    return build_solution_config(read_params())
+
+
+def test_service_starts_and_predicts(config, tmpdir):
+    from serving import UNetInferenceService
+
+    transformer_filepath = str(tmpdir.join('unet_network'))
+    torch.save(UNet(**config.unet_network.architecture_config['model_params']).state_dict(), transformer_filepath)
+
+    service = UNetInferenceService(config, transformer_filepath, max_batch_size=2, max_wait=0.01,
+                                   postprocess_workers=1)
+    try:
+        payload = io.BytesIO()
+        Image.fromarray(np.random.RandomState(1234).randint(0, 256, (40, 60, 3)).astype(np.uint8)).save(
+            payload, format='PNG')
+        tensor, target_size = service.decode(payload.getvalue())
+        probabilities = service.predict_batch([tensor, tensor])
+    finally:
+        service.decode_executor.shutdown()
+        service.model_executor.shutdown()
+        service.postprocess_executor.shutdown()
+
+    assert target_size == (40, 60)
+    assert len(probabilities) == 2
+    assert probabilities[0].shape == (config.loader.dataset_params.h, config.loader.dataset_params.w)
+    # the training sink of the caller's config is left alone
+    assert config.unet_network.callbacks_config['neptune_monitor']['sink']['backend'] != 'null'
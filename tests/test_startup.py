@@ -0,0 +1,26 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+for module in ['click', 'numpy', 'yaml', 'attrdict']:
+    pytest.importorskip(module)
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# none of these may be imported just to start the command line
+HEAVY_MODULES = ['torch', 'torchvision', 'deepsense', 'sklearn', 'skimage', 'matplotlib', 'pandas', 'scipy',
+                 'pipelines', 'IPython']
+
+
+def _imported_heavy_modules(statements):
+    script = '{}\nimport sys\nprint(",".join(m for m in {} if m in sys.modules))'.format(statements, HEAVY_MODULES)
+    return subprocess.check_output([sys.executable, '-c', script], cwd=REPO_DIR).decode().strip()
+
+
+def test_importing_main_skips_heavy_modules():
+    assert _imported_heavy_modules('import main') == ''
+
+
+def test_reading_the_config_skips_heavy_modules():
+    assert _imported_heavy_modules('import main\nmain.get_solution_config()') == ''
@@ -0,0 +1,28 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import numpy as np  # noqa: E402
+
+from steps.pytorch.tta import DIHEDRAL_TRANSFORMS  # noqa: E402
+
+NUMPY_TRANSFORMS = {'identity': lambda x: x,
+                    'hflip': lambda x: x[..., ::-1],
+                    'vflip': lambda x: x[..., ::-1, :],
+                    'rot180': lambda x: np.rot90(x, 2, axes=(2, 3)),
+                    'transpose': lambda x: x.transpose(0, 1, 3, 2),
+                    'rot90': lambda x: np.rot90(x, 1, axes=(2, 3)),
+                    'rot270': lambda x: np.rot90(x, 3, axes=(2, 3)),
+                    'antitranspose': lambda x: np.rot90(x, 2, axes=(2, 3)).transpose(0, 1, 3, 2),
+                    }
+
+
+@pytest.mark.parametrize('name', list(DIHEDRAL_TRANSFORMS))
+@pytest.mark.parametrize('shape', [(2, 3, 4, 4), (2, 3, 3, 5)])
+def test_inverse_undoes_forward(name, shape):
+    forward, inverse = DIHEDRAL_TRANSFORMS[name]
+    x = torch.arange(0, int(np.prod(shape))).view(*shape)
+
+    transformed = forward(x)
+    np.testing.assert_array_equal(transformed.numpy(), NUMPY_TRANSFORMS[name](x.numpy()))
+    np.testing.assert_array_equal(inverse(transformed).numpy(), x.numpy())
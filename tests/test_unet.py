@@ -0,0 +1,53 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+import numpy as np  # noqa: E402
+
+from benchmarks.unet_memory import reference_forward  # noqa: E402
+from steps.pytorch.architectures.unet import UNet  # noqa: E402
+from steps.pytorch.utils import no_grad, inference_variable  # noqa: E402
+
+MODEL_PARAMS = {'n_filters': 4,
+                'conv_kernel': 3,
+                'pool_kernel': 3,
+                'pool_stride': 2,
+                'repeat_blocks': 2,
+                'batch_norm': True,
+                'dropout': 0.5,
+                'in_channels': 3,
+                }
+
+
+def _out_of_place(model):
+    for module in model.modules():
+        if isinstance(module, torch.nn.ReLU):
+            module.inplace = False
+    return model
+
+
+@pytest.mark.parametrize('variant', [{},
+                                     {'separable_convs': True},
+                                     {'bilinear_upsampling': True, 'width_multiplier': 0.5}])
+def test_inference_forward_matches_reference_forward(variant):
+    torch.manual_seed(0)
+    model = UNet(**dict(MODEL_PARAMS, **variant)).eval()
+    X = torch.randn(2, 3, 32, 32)
+
+    with no_grad():
+        output = model(inference_variable(X)).data.numpy()
+        expected = reference_forward(_out_of_place(model), inference_variable(X)).data.numpy()
+
+    np.testing.assert_allclose(output, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_inference_forward_matches_autograd_forward():
+    torch.manual_seed(0)
+    model = UNet(**MODEL_PARAMS).eval()
+    X = torch.randn(2, 3, 32, 32)
+
+    with_autograd = model(torch.autograd.Variable(X)).data.numpy()
+    with no_grad():
+        without_autograd = model(inference_variable(X)).data.numpy()
+
+    np.testing.assert_allclose(without_autograd, with_autograd, rtol=1e-5, atol=1e-6)
@@ -1,15 +1,15 @@
 import logging
 import os
+import socket
 
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 import yaml
-from PIL import Image
-from scipy import ndimage
 from attrdict import AttrDict
 
 
+OVERRIDES_DIR = 'overrides'
+
+
 def read_yaml(filepath):
     with open(filepath) as f:
         config = yaml.load(f)
@@ -36,11 +36,20 @@ def get_logger():
     return logging.getLogger('dsb-2018')
 
 
-def decompose(mask):
-    labeled, nr_true = ndimage.label(mask)
+def decompose(mask, labeled=False):
+    """
+    One 0/255 mask per instance. A `labeled` mask already holds instance labels, touching instances
+    must not be merged again, otherwise instances are its connected components.
+    """
+    from scipy import ndimage
+
+    if labeled:
+        labels, nr_true = mask, int(mask.max())
+    else:
+        labels, nr_true = ndimage.label(mask)
     masks = []
     for i in range(1, nr_true + 1):
-        msk = labeled.copy()
+        msk = labels.copy()
         msk[msk != i] = 0.
         msk[msk == i] = 255.
         masks.append(msk)
@@ -51,14 +60,19 @@ def decompose(mask):
         return masks
 
 
-def create_submission(experiments_dir, meta, predictions, logger):
-    image_ids, encodings = [], []
-    for image_id, prediction in zip(meta['ImageId'].values, predictions):
-        for mask in decompose(prediction):
-            image_ids.append(image_id)
+def encode_predictions(image_ids, predictions, labeled=False):
+    import pandas as pd
+
+    encoded_image_ids, encodings = [], []
+    for image_id, prediction in zip(image_ids, predictions):
+        for mask in decompose(prediction, labeled):
+            encoded_image_ids.append(image_id)
             encodings.append(' '.join(str(rle) for rle in run_length_encoding(mask > 128.)))
+    return pd.DataFrame({'ImageId': encoded_image_ids, 'EncodedPixels': encodings})
 
-    submission = pd.DataFrame({'ImageId': image_ids, 'EncodedPixels': encodings})
+
+def create_submission(experiments_dir, meta, predictions, logger, labeled=False):
+    submission = encode_predictions(meta['ImageId'].values, predictions, labeled)
     submission_filepath = os.path.join(experiments_dir, 'submission.csv')
     submission.to_csv(submission_filepath, index=None)
 
@@ -67,11 +81,14 @@ def create_submission(experiments_dir, meta, predictions, logger):
 
 
 def read_masks(mask_filepaths):
+    """
+    Reads the uint16 instance label maps written by `preparation.overlay_masks`, 0 is background.
+    """
+    from PIL import Image
+
     masks = []
     for mask_filepath in mask_filepaths:
-        mask = plt.imread(mask_filepath[0])[:, :, 0]
-        mask_binarized = (mask > 0.5).astype(np.uint8)
-        masks.append(mask_binarized)
+        masks.append(np.array(Image.open(mask_filepath[0]), dtype=np.uint16))
     return masks
 
 
@@ -91,15 +108,49 @@ def run_length_encoding(x):
 
 
 def read_params():
+    """
+    neptune.yaml parameters with the machine specific overrides (see `autotune_loader`) and then the
+    overrides tuned for the current experiment (see `tune_threshold`) merged over them.
+    """
     neptune_config = read_yaml('neptune.yaml')
     params = neptune_config.parameters
+    params = merge_overrides(params, machine_overrides_filepath())
+    params = merge_overrides(params, tuned_overrides_filepath(params.experiment_dir))
+    return params
+
+
+def merge_overrides(params, filepath):
+    if os.path.exists(filepath):
+        params = params + read_yaml(filepath)
     return params
 
 
+def machine_overrides_filepath():
+    return os.path.join(OVERRIDES_DIR, 'machine-{}.yaml'.format(socket.gethostname()))
+
+
+def tuned_overrides_filepath(experiment_dir):
+    return os.path.join(experiment_dir, 'tuned_params.yaml')
+
+
+def write_overrides(filepath, overrides):
+    """
+    Updates the parameter overrides stored in `filepath`, keeping the ones it already holds.
+    """
+    merged = dict(read_yaml(filepath)) if os.path.exists(filepath) else {}
+    merged.update(overrides)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, 'w') as f:
+        yaml.dump(merged, f, default_flow_style=False)
+
+
 def generate_metadata(data_dir, masks_overlayed_dir):
+    import pandas as pd
+    from PIL import Image
+
     def stage1_generate_metadata(train):
         df_metadata = pd.DataFrame(columns=['ImageId', 'file_path_image', 'file_path_masks', 'file_path_mask',
-                                            'is_train', 'width', 'height', 'n_nuclei'])
+                                            'file_path_labels', 'is_train', 'width', 'height', 'n_nuclei'])
         if train:
             tr_te = 'stage1_train'
         else:
@@ -117,11 +168,13 @@ def generate_metadata(data_dir, masks_overlayed_dir):
                 is_train = 1
                 file_path_masks = os.path.join(data_dir, tr_te, image_id, 'masks')
                 file_path_mask = os.path.join(masks_overlayed_dir, tr_te, image_id + '.png')
+                file_path_labels = os.path.join(masks_overlayed_dir, tr_te, image_id + '_labels.png')
                 n_nuclei = len(os.listdir(file_path_masks))
             else:
                 is_train = 0
                 file_path_masks = None
                 file_path_mask = None
+                file_path_labels = None
                 n_nuclei = None
 
             img = Image.open(file_path_image)
@@ -134,6 +187,7 @@ def generate_metadata(data_dir, masks_overlayed_dir):
                                               'file_path_image': file_path_image,
                                               'file_path_masks': file_path_masks,
                                               'file_path_mask': file_path_mask,
+                                              'file_path_labels': file_path_labels,
                                               'is_train': is_train,
                                               'width': width,
                                               'height': height,
@@ -150,5 +204,12 @@ def squeeze_inputs(inputs):
     return np.squeeze(inputs[0], axis=1)
 
 
+def probability_threshold(threshold, dtype):
+    """
+    Threshold on the scale of probability maps of `dtype`, uint8 maps store probabilities as 0-255.
+    """
+    return threshold * 255 if dtype == np.uint8 else threshold
+
+
 def sigmoid(x):
     return 1. / (1 + np.exp(-x))